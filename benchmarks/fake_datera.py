@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+"""
+In-process fake of the Datera v2.2 REST API for benchmarking dbmp.
+
+Serves just enough of the API for dbmp's control path: the /api schema the
+SDK reads at login, login, app_instances, storage_instances (with access info
+and ACL policies), volumes and their performance policies, initiators, system
+info and io metrics.  Responses use the v2.2 envelope ({"data": ...,
+"version": ..., "tenant": ...}), lists embed their children and entity paths
+are built from ids (UUIDs), not names, the way the real API does.
+
+Every request can be delayed by a fixed latency and is counted per endpoint
+(ids and names folded to '*') so benchmarks can report round trips.
+
+    server = FakeDatera(latency=0.002, online_delay=0.5)
+    server.start()   # listens on http://127.0.0.1:7717
+    ...
+    server.counts()  # {'GET /app_instances': 3, ...}
+    server.stop()
+
+Running this file directly serves until interrupted.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import copy
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src')
+if SRC not in sys.path:
+    sys.path.insert(0, SRC)
+
+from dbmp.tracing import api_name  # noqa
+
+VERSION = 'v2.2'
+TENANT = '/root'
+PORT = 7717
+PORTALS = ['127.0.0.1']
+_MATCH = re.compile(r'^match\(name,(.*)\)$')
+IO_METRICS = ('reads', 'writes', 'bytes_read', 'bytes_written', 'iops_read',
+              'iops_write', 'thpt_read', 'thpt_write', 'lat_avg_read',
+              'lat_avg_write', 'lat_50_read', 'lat_90_read', 'lat_100_read',
+              'lat_50_write', 'lat_90_write', 'lat_100_write')
+_AI = '/app_instances/:app_instance_id'
+_SI = _AI + '/storage_instances/:storage_instance_id'
+_VOL = _SI + '/volumes/:volume_id'
+# Endpoints of the /api schema, the SDK refuses (strict) any attribute that
+# isn't an endpoint or metric named in it
+SCHEMA_PATHS = (
+    '/system', '/storage_nodes', '/tenants', '/initiator_groups',
+    '/initiators', '/initiators/:initiator_id', '/app_templates',
+    '/app_templates/:app_template_id', '/app_instances', _AI,
+    _AI + '/storage_instances', _SI, _SI + '/acl_policy',
+    _SI + '/acl_policy/initiators', _SI + '/acl_policy/initiator_groups',
+    _SI + '/volumes', _VOL, _VOL + '/performance_policy', '/metrics',
+    '/metrics/io', '/metrics/io/:metric', '/metrics/io/:metric/latest',
+    '/metrics/hw', '/metrics/hw/:metric')
+
+
+def api_schema():
+    """ Minimal /api schema, a read verb for every path in SCHEMA_PATHS """
+    schema = {}
+    for path in SCHEMA_PATHS:
+        schema[path] = {'name': path, 'read': {'urlParamSchema': {}}}
+    schema['/metrics/io/:metric']['read']['urlParamSchema']['metric'] = {
+        'enum': list(IO_METRICS)}
+    schema['/metrics/hw/:metric']['read']['urlParamSchema']['metric'] = {
+        'enum': []}
+    return schema
+
+
+class NotFound(Exception):
+    pass
+
+
+class Conflict(Exception):
+    pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeDatera(object):
+
+    """
+    Fake Datera cluster.  `latency` seconds are added to every request and
+    storage_instances only become available `online_delay` seconds after
+    their app_instance is onlined
+    """
+
+    def __init__(self, host='127.0.0.1', port=PORT, latency=0,
+                 online_delay=0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.online_delay = online_delay
+        self.lock = threading.Lock()
+        self.server = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.ais = {}
+            self.initiators = {}
+            self.requests = {}
+
+    def counts(self):
+        with self.lock:
+            return dict(self.requests)
+
+    def clear_counts(self):
+        with self.lock:
+            self.requests = {}
+
+    def start(self):
+        fake = self
+
+        class Handler(_Handler):
+            datera = fake
+        self.server = _Server((self.host, self.port), Handler)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    # Serialization
+
+    def _public(self, obj):
+        if isinstance(obj, dict):
+            out = {k: self._public(v) for k, v in obj.items()
+                   if not k.startswith('_')}
+            if '_ready_at' in obj:
+                ready = obj['_ready_at']
+                out['op_state'] = ('available' if ready is not None and
+                                   time.time() >= ready else 'unavailable')
+            return out
+        if isinstance(obj, list):
+            return [self._public(v) for v in obj]
+        return copy.deepcopy(obj)
+
+    # Lookups
+
+    def _ai(self, name):
+        ai = self.ais.get(name)
+        if ai is None:
+            for a in self.ais.values():
+                if a['id'] == name:
+                    return a
+            raise NotFound('app_instance {}'.format(name))
+        return ai
+
+    @staticmethod
+    def _child(items, name, kind):
+        for item in items:
+            if item['name'] == name or item.get('id') == name:
+                return item
+        raise NotFound('{} {}'.format(kind, name))
+
+    # Request dispatch, returns the (public) response data
+
+    def handle(self, method, segs, query, body):
+        with self.lock:
+            if segs == ['login']:
+                return {'key': uuid.uuid4().hex}
+            if segs == ['api']:
+                return api_schema()
+            if segs[0] == 'system':
+                return {'name': 'fake-datera', 'sw_version': '3.3.0',
+                        'network_paths': [{'name': 'vip', 'ip': p}
+                                          for p in PORTALS]}
+            if segs[0] == 'initiators':
+                return self._initiators(method, segs[1:], body)
+            if segs[0] == 'metrics':
+                return self._metrics(segs, query)
+            if segs[0] == 'app_instances':
+                return self._app_instances(method, segs[1:], query, body)
+        raise NotFound('/'.join(segs))
+
+    @staticmethod
+    def _metrics(segs, query):
+        if segs[-1] != 'latest' and 'start_time' in query:
+            # One point per second of the requested range
+            start = int(query['start_time'][0]) // 1000
+            end = int(query['end_time'][0]) // 1000
+            return [{'points': [{'value': t % 1000, 'time': t * 1000}
+                                for t in range(start, end + 1)]}]
+        return [{'point': {'value': int(time.time()) % 1000,
+                           'time': int(time.time() * 1000)}}]
+
+    def _initiators(self, method, segs, body):
+        if not segs:
+            if method == 'POST':
+                iid = body['id']
+                if iid in self.initiators:
+                    raise Conflict('initiator {}'.format(iid))
+                self.initiators[iid] = {
+                    'id': iid, 'name': body.get('name', iid),
+                    'path': '/initiators/{}'.format(iid), 'tenant': TENANT}
+                return self._public(self.initiators[iid])
+            return self._public(list(self.initiators.values()))
+        if segs[0] not in self.initiators:
+            raise NotFound('initiator {}'.format(segs[0]))
+        return self._public(self.initiators[segs[0]])
+
+    def _app_instances(self, method, segs, query, body):
+        if not segs:
+            if method == 'POST':
+                return self._public(self._create_ai(body))
+            ais = sorted(self.ais.values(), key=lambda x: x['name'])
+            match = _MATCH.match(query.get('filter', [''])[0])
+            if match:
+                pattern = re.compile(match.group(1))
+                ais = [a for a in ais if pattern.match(a['name'])]
+            return self._public(ais)
+        ai = self._ai(segs[0])
+        if len(segs) == 1:
+            if method == 'DELETE':
+                del self.ais[ai['name']]
+                return self._public(ai)
+            if method == 'PUT':
+                self._set_ai(ai, body)
+            return self._public(ai)
+        if segs[1] != 'storage_instances':
+            raise NotFound('/'.join(segs))
+        sis = ai['storage_instances']
+        if len(segs) == 2:
+            if method == 'POST':
+                return self._public(self._create_si(ai, body['name']))
+            return self._public(sis)
+        si = self._child(sis, segs[2], 'storage_instance')
+        if len(segs) == 3:
+            if method == 'DELETE':
+                sis.remove(si)
+            return self._public(si)
+        if segs[3] == 'acl_policy':
+            inits = si['acl_policy']['initiators']
+            if len(segs) > 4 and method in ('PUT', 'POST'):
+                path = body.get('path')
+                if body.get('op') == 'remove':
+                    si['acl_policy']['initiators'] = [
+                        i for i in inits if i['path'] != path]
+                elif path not in [i['path'] for i in inits]:
+                    inits.append({'path': path})
+                # Linking returns the linked entity
+                return {'path': path}
+            elif method == 'PUT':
+                si['acl_policy'].update(body)
+            return self._public(si['acl_policy'] if len(segs) == 4
+                                else si['acl_policy']['initiators'])
+        if segs[3] != 'volumes':
+            raise NotFound('/'.join(segs))
+        vols = si['volumes']
+        if len(segs) == 4:
+            if method == 'POST':
+                return self._public(self._create_vol(si, body))
+            return self._public(vols)
+        vol = self._child(vols, segs[4], 'volume')
+        if len(segs) == 5:
+            if method == 'PUT':
+                vol.update(body)
+            elif method == 'DELETE':
+                vols.remove(vol)
+            return self._public(vol)
+        if segs[5] == 'performance_policy':
+            policy = vol.get('performance_policy')
+            if method == 'POST':
+                if policy is not None:
+                    raise Conflict('performance_policy')
+                vol['performance_policy'] = policy = dict(body)
+            elif policy is None:
+                raise NotFound('performance_policy')
+            elif method == 'PUT':
+                policy.update(body)
+            elif method == 'DELETE':
+                vol['performance_policy'] = None
+            return self._public(policy)
+        raise NotFound('/'.join(segs))
+
+    def _create_ai(self, body):
+        name = body['name']
+        if name in self.ais:
+            raise Conflict('app_instance {}'.format(name))
+        aid = str(uuid.uuid4())
+        ai = {'name': name, 'id': aid,
+              'path': '/app_instances/{}'.format(aid),
+              'admin_state': 'offline', 'tenant': TENANT,
+              'storage_instances': []}
+        self.ais[name] = ai
+        if body.get('app_template'):
+            si = self._create_si(ai, 'storage-1')
+            self._create_vol(si, {'name': 'volume-1', 'size': 1})
+        return ai
+
+    def _set_ai(self, ai, body):
+        state = body.get('admin_state')
+        if state:
+            ai['admin_state'] = state
+            ready = (time.time() + self.online_delay
+                     if state == 'online' else None)
+            for si in ai['storage_instances']:
+                si['_ready_at'] = ready
+
+    def _create_si(self, ai, name):
+        sid = str(uuid.uuid4())
+        si = {'name': name, 'id': sid,
+              'path': '{}/storage_instances/{}'.format(ai['path'], sid),
+              'admin_state': ai['admin_state'], '_ready_at': None,
+              'access': {'iqn': 'iqn.2013-05.com.daterainc:tc:01:sn:{}'
+                                .format(uuid.uuid4().hex[:16]),
+                         'ips': list(PORTALS)},
+              'acl_policy': {'initiators': [], 'initiator_groups': []},
+              'volumes': []}
+        ai['storage_instances'].append(si)
+        return si
+
+    def _create_vol(self, si, body):
+        vid = str(uuid.uuid4())
+        vol = {'name': body['name'], 'id': vid,
+               'path': '{}/volumes/{}'.format(si['path'], vid),
+               'size': body.get('size', 1),
+               'replica_count': body.get('replica_count', 3),
+               'placement_mode': body.get('placement_mode', 'hybrid'),
+               'performance_policy': None}
+        si['volumes'].append(vol)
+        return vol
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    datera = None
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, code, payload):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self):
+        datera = self.datera
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        try:
+            body = json.loads(raw.decode('utf-8')) if raw else {}
+        except ValueError:
+            body = {}
+        query = parse_qs(url.query)
+        body.update({k: v[0] for k, v in query.items()
+                     if k not in ('filter', 'offset', 'limit')})
+        segs = [s for s in url.path.split('/') if s]
+        if segs and segs[0] == VERSION:
+            segs = segs[1:]
+        key = api_name(self.command, 'http://fake/' + '/'.join(segs))
+        with datera.lock:
+            datera.requests[key] = datera.requests.get(key, 0) + 1
+        if datera.latency:
+            time.sleep(datera.latency)
+        if not segs:
+            return self._respond(404, {'message': 'Not found'})
+        try:
+            data = datera.handle(self.command, segs, query, body)
+        except NotFound as e:
+            return self._respond(404, {'name': 'NotFoundError', 'code': 404,
+                                       'message': 'Not found: {}'.format(e)})
+        except Conflict as e:
+            return self._respond(409, {'name': 'ConflictError', 'code': 409,
+                                       'message': 'Conflict: {}'.format(e)})
+        payload = {'data': data, 'version': VERSION, 'tenant': TENANT,
+                   'path': '/' + '/'.join(segs)}
+        if segs == ['login']:
+            payload = data
+        elif isinstance(data, list):
+            payload['metadata'] = {'total_count': len(data), 'offset': 0,
+                                   'limit': len(data)}
+        self._respond(200, payload)
+
+    do_GET = do_PUT = do_POST = do_DELETE = _dispatch
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds added to every request')
+    parser.add_argument('--online-delay', type=float, default=0,
+                        help='Seconds before onlined storage_instances '
+                             'become available')
+    args = parser.parse_args()
+    server = FakeDatera(args.host, args.port, args.latency,
+                        args.online_delay).start()
+    print("Fake Datera listening on http://{}:{}".format(args.host, args.port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
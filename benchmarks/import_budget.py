@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Cold start import budget for dbmp entry points.
+
+Each subcommand is mapped to the dbmp modules its code path imports (main.py
+and the remote scripts import feature modules lazily).  Every subcommand is
+imported in a fresh interpreter under ``python -X importtime`` and the total
+import time is checked against its budget.  Modules in FORBIDDEN must never
+be loaded at import time by any entry point.
+
+Usage:
+    python benchmarks/import_budget.py [--runs 5] [--scale 1.0] [--json]
+
+Exits nonzero if any subcommand is over budget or imports a forbidden module.
+Requires Python 3.7+ for -X importtime.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src')
+
+MAIN = ['dbmp.main']
+VOLUME_PATH = MAIN + ['dbmp.mount', 'dbmp.volume']
+
+# Subcommand: (modules imported on that code path, budget in ms)
+SUBCOMMANDS = {
+    'health': (MAIN, 250),
+    'list-templates': (MAIN + ['dbmp.volume'], 250),
+    'list-volumes': (MAIN + ['dbmp.volume'], 250),
+    'list-mounts': (MAIN + ['dbmp.mount'], 300),
+    'bootstrap': (MAIN + ['dbmp.bundle', 'dbmp.topology'], 300),
+    'create-mount-clean': (VOLUME_PATH, 300),
+    'fio': (VOLUME_PATH + ['dbmp.fio'], 300),
+    'metrics': (VOLUME_PATH + ['dbmp.metrics'], 300),
+    'remote-mount': (['dbmp.remote.mount', 'dbmp.mount'], 300),
+    'remote-clean': (['dbmp.remote.clean_mount', 'dbmp.mount'], 300),
+    'remote-fio': (['dbmp.remote.fio', 'dbmp.fio'], 300),
+    'remote-agent': (['dbmp.remote.agent'], 350),
+}
+
+# Heavy dependencies that must only be imported when actually used
+FORBIDDEN = ('paramiko', 'asyncssh', 'cryptography', 'tabulate')
+
+
+def measure(modules):
+    code = '; '.join('import {}'.format(m) for m in modules)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, (SRC, os.environ.get('PYTHONPATH')))))
+    proc = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, cwd=SRC)
+    _, err = proc.communicate()
+    if proc.returncode:
+        raise EnvironmentError("Importing {} failed:\n{}".format(
+            modules, err.decode('utf-8')))
+    total, loaded = 0, {}
+    for line in err.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative, name = line.split(':', 1)[1].split('|')
+        total += int(self_us)
+        loaded[name.strip()] = int(cumulative)
+    return total / 1000.0, loaded
+
+
+def main(args):
+    results = {}
+    failed = False
+    for name, (modules, budget) in sorted(SUBCOMMANDS.items()):
+        budget = budget * args.scale
+        runs = [measure(modules) for _ in range(args.runs)]
+        ms, loaded = min(runs, key=lambda x: x[0])
+        forbidden = sorted(m for m in loaded
+                           if m.split('.')[0] in FORBIDDEN)
+        ok = ms <= budget and not forbidden
+        failed = failed or not ok
+        slowest = sorted(loaded.items(), key=lambda x: -x[1])[:5]
+        results[name] = {'ms': round(ms, 2),
+                         'budget_ms': budget,
+                         'forbidden': forbidden,
+                         'slowest': [m for m, _ in slowest],
+                         'ok': ok}
+    if args.json:
+        print(json.dumps(results, indent=4, sort_keys=True))
+    else:
+        for name, r in sorted(results.items()):
+            print("{:<20} {:>8.1f}ms / {:>6.0f}ms {}{}".format(
+                name, r['ms'], r['budget_ms'], 'ok' if r['ok'] else 'FAIL',
+                ' forbidden: {}'.format(','.join(r['forbidden']))
+                if r['forbidden'] else ''))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Runs per subcommand, the fastest is used')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiply every budget, eg for slow machines')
+    parser.add_argument('--json', action='store_true')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+Benchmark of dbmp's own orchestration overhead.
+
+dbmp's control path (create_volumes, list_volumes, mount_volumes,
+get_metrics, teardown and clean_volumes) is run in-process against the fake
+Datera REST server in fake_datera.py, with fake sudo, iscsiadm, mkfs, mount,
+umount, tee, cat, multipath and fio binaries first on PATH, so what is
+measured is dbmp itself: Parallel overhead, REST round trips and forked
+commands.  The fake iscsiadm links each logged in target into a temporary
+directory standing in for /dev/disk/by-path.
+
+For every volume count (default 10, 100 and 1000) each operation reports its
+wall time, REST round trips per endpoint and the number of shell commands and
+fake binaries it ran.  A Parallel no-op microbenchmark is included.  Results
+are printed as JSON, save them per commit and diff them to catch
+regressions.
+
+Usage:
+    python benchmarks/orchestration.py [--sizes 10,100,1000] [--workers 5]
+        [--latency 0.001] [--online-delay 0] [--out results.json]
+
+Requires the Datera SDK (dfs_sdk) and the fake server's port (7717) free.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_datera import FakeDatera, PORT  # noqa
+
+# name: shell script body, every invocation is logged first.  @DEVDIR@ is
+# replaced with the fake /dev/disk/by-path directory
+FAKE_BINS = {
+    'sudo': '[ "$1" = "-n" ] && shift\nexec "$@"',
+    'iscsiadm': ('while [ $# -gt 0 ]; do case "$1" in -T) iqn=$2;; '
+                 '-p) portal=$2;; --login) login=1;; esac; shift; done\n'
+                 '[ -n "$login" ] && '
+                 'ln -sf @DEVDIR@/sdz "@DEVDIR@/ip-$portal-iscsi-$iqn-lun-0"\n'
+                 'exit 0'),
+    'multipath': 'exit 0',
+    'mkfs.xfs': 'exit 0',
+    'mkfs.ext4': 'exit 0',
+    'mount': 'exit 0',
+    'umount': 'exit 0',
+    'blkid': 'echo xfs',
+    'fio': 'echo "fake fio"',
+    'tee': 'exec /bin/cat > /dev/null',
+    'cat': ('case "$1" in *initiatorname.iscsi) '
+            'echo "InitiatorName=iqn.1993-08.org.debian:01:dbmpbench";; '
+            '*) exec /bin/cat "$@";; esac'),
+}
+
+
+def make_fake_bins(directory, log, devdir):
+    for name, body in FAKE_BINS.items():
+        path = os.path.join(directory, name)
+        with io.open(path, 'w') as f:
+            f.write('#!/bin/sh\necho {} >> {}\n{}\n'.format(
+                name, log, body.replace('@DEVDIR@', devdir)))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+def read_bin_counts(log):
+    counts = {}
+    if os.path.exists(log):
+        with io.open(log) as f:
+            for line in f:
+                counts[line.strip()] = counts.get(line.strip(), 0) + 1
+        os.remove(log)
+    return counts
+
+
+def bench_parallel(n, workers):
+    from dbmp.utils import Parallel
+
+    def noop():
+        pass
+    start = time.time()
+    p = Parallel([noop] * n, max_workers=workers)
+    p.run_threads()
+    dur = time.time() - start
+    return {'seconds': round(dur, 4), 'us_per_task': round(dur / n * 1e6, 1)}
+
+
+@contextlib.contextmanager
+def _redirect(out):
+    orig = sys.stdout
+    sys.stdout = out
+    try:
+        yield
+    finally:
+        sys.stdout = orig
+
+
+def measure(server, log, func, *args):
+    from dbmp import tracing
+    server.clear_counts()
+    read_bin_counts(log)
+    tracing.reset()
+    out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    start = time.time()
+    with _redirect(out):
+        func(*args)
+    dur = time.time() - start
+    requests = server.counts()
+    exes = sum(s['count'] for name, s in tracing.summary().items()
+               if name.startswith('exe'))
+    return {'seconds': round(dur, 4),
+            'round_trips': sum(requests.values()),
+            'requests': requests,
+            'commands': exes,
+            'binaries': read_bin_counts(log)}
+
+
+def run_size(api, server, log, n, workers, directory):
+    from dbmp.metrics import get_metrics
+    from dbmp.mount import mount_volumes, teardown
+    from dbmp.volume import create_volumes, clean_volumes, list_volumes
+    from dbmp.volume import ais_from_vols
+    from dbmp import rest
+    server.reset()
+    rest.clear()
+    vopt = 'prefix=bench-{},count={}'.format(n, n)
+    results = {}
+    results['create_volumes'] = measure(
+        server, log, create_volumes, 'local', api, vopt, workers)
+    results['list_volumes'] = measure(
+        server, log, list_volumes, 'local', api, vopt, False)
+    ais = ais_from_vols(api, vopt)
+    results['mount_volumes'] = measure(
+        server, log, mount_volumes, api, ais, False, 'xfs', '', directory,
+        workers, False)
+    # One sample per app_instance, includes get_metrics' 1s interval sleep
+    results['get_metrics'] = measure(
+        server, log, get_metrics, api, ['iops_write'], [vopt], 1, 1, None)
+    results['teardown'] = measure(
+        server, log, teardown, api, [vopt], directory, workers, False)
+    results['clean_volumes'] = measure(
+        server, log, clean_volumes, api, vopt, workers)
+    return results
+
+
+def get_bench_api(directory):
+    from dfs_sdk import get_api
+    # The SDK opens its dsdk_*.log files in the working directory, keep
+    # them in the run's tempdir so a run leaves nothing behind
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        # A private schema cache, the SDK otherwise reuses
+        # /tmp/.cached-schema of whatever cluster it last logged into
+        return get_api('127.0.0.1', 'admin', 'password', 'v2.2',
+                       secure=False,
+                       schema_loc=os.path.join(directory, 'schema.json'))
+    finally:
+        os.chdir(cwd)
+
+
+def main(args):
+    from dbmp import mount, rest, tracing
+    sizes = [int(s) for s in args.sizes.split(',')]
+    tmp = tempfile.mkdtemp(prefix='dbmp-bench-')
+    bindir = os.path.join(tmp, 'bin')
+    mntdir = os.path.join(tmp, 'mnt')
+    devdir = os.path.join(tmp, 'dev')
+    os.makedirs(bindir)
+    os.makedirs(mntdir)
+    os.makedirs(devdir)
+    io.open(os.path.join(devdir, 'sdz'), 'w').close()
+    mount.DEV_TEMPLATE = os.path.join(
+        devdir, 'ip-{ip}:3260-iscsi-{iqn}-lun-{lun}')
+    log = os.path.join(tmp, 'bin.log')
+    make_fake_bins(bindir, log, devdir)
+    os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+    server = FakeDatera(port=PORT, latency=args.latency,
+                        online_delay=args.online_delay).start()
+    # Spans are only used to count commands, their cost is a few us each
+    tracing.enable()
+    # Same REST cache as a dbmp command line run
+    rest.install(cache=not args.no_rest_cache)
+    report = {'python': platform.python_version(),
+              'workers': args.workers,
+              'latency': args.latency,
+              'online_delay': args.online_delay,
+              'rest_cache': not args.no_rest_cache,
+              'parallel_noop': {},
+              'sizes': {}}
+    try:
+        api = get_bench_api(tmp)
+        for n in sizes:
+            report['parallel_noop'][n] = bench_parallel(n, args.workers)
+            report['sizes'][n] = run_size(api, server, log, n, args.workers,
+                                          mntdir)
+            print("Finished N={}".format(n), file=sys.stderr)
+    finally:
+        server.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+    data = json.dumps(report, indent=4, sort_keys=True)
+    if args.out:
+        with io.open(args.out, 'w') as f:
+            f.write(data)
+    print(data)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='10,100,1000',
+                        help='Comma separated volume counts')
+    parser.add_argument('--workers', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='Seconds added to every fake REST request')
+    parser.add_argument('--online-delay', type=float, default=0,
+                        help='Seconds before onlined storage_instances '
+                             'become available')
+    parser.add_argument('--no-rest-cache', action='store_true',
+                        help='Benchmark without dbmp\'s REST read cache')
+    parser.add_argument('--out', help='Also write the JSON report here')
+    sys.exit(main(parser.parse_args()))
@@ -3,6 +3,7 @@
 from __future__ import unicode_literals, print_function, division
 
 import argparse
+import glob
 import io
 import os
 import stat
@@ -73,9 +74,26 @@ def main(args):
                 return 1
     if not os.path.isdir(VENV):
         exe("virtualenv {}".format(VENV))
-    exe_pip("install -U pip")
-    exe_pip("install -U -r {}".format(REQUIREMENTS))
-    exe_pip("install -e {}".format(DIR))
+    offline = False
+    if args.wheelhouse:
+        # Offline install from a pushed dbmp bundle.  Its wheels were built
+        # by the bundling host's Python, binary ones don't install on hosts
+        # with another Python version or architecture
+        wheels = glob.glob(os.path.join(args.wheelhouse, "*.whl"))
+        try:
+            exe_pip("install --no-index --find-links {} {}".format(
+                args.wheelhouse, " ".join(wheels)))
+            exe_pip("install --no-index --no-deps --no-build-isolation "
+                    "-e {}".format(DIR))
+            offline = True
+        except subprocess.CalledProcessError as e:
+            vprint(e)
+            print("Offline install from the wheelhouse failed, installing "
+                  "requirements from the network")
+    if not offline:
+        exe_pip("install -U pip")
+        exe_pip("install -U -r {}".format(REQUIREMENTS))
+        exe_pip("install -e {}".format(DIR))
 
     if not os.path.isfile(DBMP):
         # Create dbmp executable
@@ -105,5 +123,8 @@ if __name__ == "__main__":
                         help="Generate Datera Universal Config file after "
                              "install")
     parser.add_argument("-q", "--quiet", action="store_true")
+    parser.add_argument("-w", "--wheelhouse",
+                        help="Install requirements offline from this "
+                             "directory of wheels")
     args = parser.parse_args()
     sys.exit(main(args))
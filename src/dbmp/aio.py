@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio based execution core.  Python 3 only, main imports this on demand
+when --async is passed.
+
+Local commands are driven with asyncio.create_subprocess_exec, or sent to
+the privileged helper without a thread waiting on the response, so no
+thread is blocked while a command runs.  They are built and their results
+judged by the same mount.py and tuning helpers as in threaded mode, and
+exe() returns the same CmdResult and raises the same errors as utils.run.
+The waits of a mount (for storage_instances, login retries, devices,
+sessions and multipath) are coroutines too.  Only REST calls, which go
+through the synchronous Datera SDK, are offloaded to a bounded thread pool.
+Teardown has nothing to wait on and is mount.py's.  Remote commands use a
+cached asyncssh connection per host (falling back to paramiko in the
+executor when asyncssh is not installed).  Every fan-out is bounded by the
+--workers value.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import asyncio
+import concurrent.futures
+import functools
+import os
+import time
+
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+from dbmp import mount, multipath as mpath, tracing, tuning, utils
+from dbmp.mount import SiWaiter, get_dirname
+from dbmp.topology import get_topology
+from dbmp.utils import CmdResult, dprint, get_hostname
+from dbmp.utils import exe_remote as sync_exe_remote
+from dbmp.volume import ais_from_vols, get_spec, clean_volume
+from dbmp.volume import _create_volume, _create_complex_volume
+
+_LIMITS = {}
+_SSH = {}
+_EXECUTOR = None
+
+
+def run(coro, workers):
+    return asyncio.run(_run(coro, workers))
+
+
+async def _run(coro, workers):
+    global _EXECUTOR
+    _LIMITS['exe'] = asyncio.Semaphore(workers)
+    _LIMITS['ssh'] = asyncio.Semaphore(workers)
+    _EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        return await coro
+    finally:
+        for conn in _SSH.values():
+            if conn.done() and not conn.exception():
+                conn.result().close()
+        _SSH.clear()
+        _EXECUTOR.shutdown(wait=False)
+
+
+async def offload(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _EXECUTOR, functools.partial(func, *args, **kwargs))
+
+
+async def exe(argv, sudo=False, stdin=None, check=False):
+    """ utils.run for coroutines """
+    dprint("Running command:", argv)
+    async with _LIMITS['exe']:
+        with tracing.span('exe', cmd=argv):
+            helper = utils._get_helper() if sudo else None
+            msg = await _helper_run(helper, argv, stdin) if helper else None
+            if msg:
+                result = CmdResult(argv, msg['rc'], msg['stdout'],
+                                   msg['stderr'], msg['duration'])
+            elif sudo and os.geteuid() != 0:
+                if helper:
+                    dprint("Privileged helper has exited, falling back to "
+                           "sudo per command")
+                result = (await _exec(['sudo'] + argv, stdin))._replace(
+                    argv=argv)
+            else:
+                result = await _exec(argv, stdin)
+    return utils.checked(result, check)
+
+
+async def _helper_run(helper, argv, stdin):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def _set(msg):
+        if not future.done():
+            future.set_result(msg)
+
+    # The response arrives on the helper's reader thread
+    if not helper.submit(argv, stdin,
+                         lambda msg: loop.call_soon_threadsafe(_set, msg)):
+        return None
+    return await future
+
+
+async def _exec(argv, stdin):
+    start = time.time()
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *argv, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        return CmdResult(argv, 127, '', str(e), time.time() - start)
+    out, err = await proc.communicate(
+        stdin.encode('utf-8') if stdin is not None else None)
+    return CmdResult(argv, proc.returncode, out.decode('utf-8', 'replace'),
+                     err.decode('utf-8', 'replace'), time.time() - start)
+
+
+async def _get_ssh(host):
+    # Share one connection (and one connect attempt) per host
+    if host not in _SSH:
+        user, ip, creds = get_topology(host)
+        if os.path.exists(creds):
+            kwargs = {'client_keys': [creds]}
+        else:
+            kwargs = {'password': creds}
+        _SSH[host] = asyncio.ensure_future(asyncssh.connect(
+            ip, username=user, known_hosts=None, **kwargs))
+    return await _SSH[host]
+
+
+async def exe_remote(host, cmd, fail_ok=False):
+    if asyncssh is None:
+        return await offload(sync_exe_remote, host, cmd, fail_ok=fail_ok)
+    dprint("Running remote command {} on host {}:".format(cmd, host))
+    async with _LIMITS['ssh']:
+        conn = await _get_ssh(host)
+        result = await conn.run(cmd)
+    if result.exit_status == 0:
+        return result.stdout
+    elif fail_ok:
+        return result.stderr
+    raise EnvironmentError(
+        "Nonzero return code: {} stderr: {}".format(
+            result.exit_status, result.stderr))
+
+
+def create_volumes(host, api, vopt, workers):
+    return run(_create_volumes(host, api, vopt), workers)
+
+
+def clean_volumes(api, vopt, workers):
+    return run(_clean_volumes(api, vopt), workers)
+
+
+def mount_volumes(api, vols, multipath, fs, fsargs, directory, workers,
+                  login_only, preformatted=None, profile='default',
+                  sessions=1, mp_policy=None):
+    if multipath and mp_policy:
+        mpath.configure(mp_policy)
+    return run(_mount_volumes(api, vols, multipath, fs, fsargs, directory,
+                              login_only, preformatted or (), profile,
+                              sessions),
+               workers)
+
+
+def teardown(api, vopts, directory, workers, delete):
+    # Nothing in a teardown waits, it only runs commands and REST calls
+    return mount.teardown(api, vopts, directory, workers, delete)
+
+
+async def _create_volumes(host, api, vopt):
+    if host == 'local':
+        hostname = get_hostname(host)
+    else:
+        hostname = (await exe_remote(host, "hostname")).strip()
+    dprint("Creating volumes:", vopt)
+    spec = get_spec(vopt)
+    ais = await offload(ais_from_vols, api, vopt)
+    # If they already exist lets just use them
+    if ais or spec.kind == 'names':
+        return ais
+    if spec.kind == 'complex':
+        return [await offload(_create_complex_volume, api, spec.opts)]
+    results = []
+    await asyncio.gather(*[
+        offload(_create_volume, api, spec.opts, name, results)
+        for _, name in spec.plans(hostname)])
+    return results
+
+
+async def _clean_volumes(api, vopt):
+    print("Cleaning volumes matching:", vopt)
+    ais = await offload(ais_from_vols, api, vopt)
+    await asyncio.gather(*[offload(clean_volume, ai) for ai in ais])
+
+
+async def _mount_volumes(api, vols, multipath, fs, fsargs, directory,
+                         login_only, preformatted, profile, sessions):
+    results = []
+    waiter = SiWaiter(api)
+    tuning.reset()
+    await asyncio.gather(*[
+        _mount_volume(api, waiter, ai, multipath, fs, fsargs, directory,
+                      login_only, preformatted, profile, sessions, results)
+        for ai in vols])
+    tuning.print_summary(profile)
+    return results
+
+
+async def _mount_volume(api, waiter, ai, multipath, fs, fsargs, directory,
+                        login_only, preformatted, profile, sessions,
+                        results):
+    sis = await offload(ai.storage_instances.list)
+    await offload(mount._setup_acl, api, ai, sis)
+    await offload(ai.set, admin_state='online')
+    for si in sis:
+        ac = (await _wait_si(waiter, ai.name, si))['access']
+        vols = await offload(si.volumes.list)
+        for i, vol in enumerate(vols):
+            path = await _login(ac['iqn'], ac['ips'], multipath, i,
+                                profile, sessions)
+            if login_only:
+                results.append(path)
+            print("Volume device path:", path)
+            if not login_only:
+                folder = get_dirname(directory, ai.name, si.name, vol.name)
+                results.append(folder)
+                await _format_mount_device(path, fs, fsargs, folder,
+                                           ai.name in preformatted)
+
+
+async def _wait_si(waiter, ai_name, si):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def _set(data):
+        if not future.done():
+            future.set_result(data)
+
+    def _ready(data):
+        loop.call_soon_threadsafe(_set, data)
+
+    waiter.watch(ai_name, si, _ready)
+    try:
+        return await asyncio.wait_for(future, waiter.timeout)
+    except asyncio.TimeoutError:
+        waiter.unwatch(ai_name, si, _ready)
+        raise EnvironmentError(
+            "Polling ended before storage_instance {} became "
+            "available".format(si.path))
+
+
+async def _format_mount_device(path, fs, fsargs, folder, preformatted):
+    timeout = 5
+    while not preformatted:
+        mkfs = await exe(mount._mkfs_cmd(path, fs, fsargs), sudo=True)
+        found_fs = ''
+        if mkfs.rc:
+            dprint("Checking for existing filesystem on:", path)
+            found_fs = (await exe(mount._blkid_cmd(path),
+                                  sudo=True)).stdout.strip()
+        if mount._formatted(path, fs, mkfs, found_fs, timeout):
+            break
+        await asyncio.sleep(1)
+        timeout -= 1
+    opts = []
+    # Clones share their source's filesystem UUID
+    uuid = mount._uuid_cmd(path, fs) if preformatted else None
+    if uuid:
+        opts = mount._uuid_mount_opts(path, fs, await exe(uuid, sudo=True))
+    for argv in mount._mount_cmds(path, folder, opts):
+        await exe(argv, sudo=True, check=True)
+    print("Volume mount:", folder)
+
+
+async def _login_attempt(iqn, portal, profile, sessions):
+    # mount._login_portal's steps
+    result = await exe(mount._discovery_cmd(portal), sudo=True)
+    if result.rc:
+        return result
+    for target, setting, value, argv in tuning.session_cmds(iqn, portal,
+                                                            profile):
+        result = await exe(argv, sudo=True)
+        tuning._record(target, setting, value, not result.rc)
+    argv = mount._nr_sessions_cmd(iqn, portal, sessions)
+    if argv:
+        await exe(argv, sudo=True, check=True)
+    return await exe(mount._login_cmd(iqn, portal), sudo=True)
+
+
+async def _login_portal(iqn, portal, profile, sessions):
+    retries = 10
+    while True:
+        dprint("Trying to log into target:", portal)
+        retries -= 1
+        result = await _login_attempt(iqn, portal, profile, sessions)
+        if mount._login_done(portal, result, retries):
+            return
+        await asyncio.sleep(2)
+
+
+async def _login(iqn, portals, multipath, lun, profile, sessions):
+    if not multipath:
+        portals = [portals[0]]
+    if lun == 0:
+        await asyncio.gather(*[
+            _login_portal(iqn, portal, profile, sessions)
+            for portal in portals])
+    devices = await asyncio.gather(*[
+        _wait_device(portal, iqn, lun) for portal in portals])
+    if sessions > 1:
+        devices = await _wait_sessions(
+            iqn, lun, len(portals) * sessions, devices)
+    if multipath:
+        dprint('Sleeping to allow for multipath devices to finish linking')
+        await asyncio.sleep(2)
+    dpath = mount._device_path(iqn, portals, multipath, lun)
+    await _tune_devices(devices, profile)
+    return dpath
+
+
+async def _tune_device(writes):
+    # A device's settings are written in order, the scheduler first
+    for device, path, setting, value in writes:
+        result = await exe(['tee', path], sudo=True, stdin=str(value))
+        tuning._record(device, setting, value, not result.rc)
+
+
+async def _tune_devices(devices, profile):
+    # tuning.tune_devices, the devices are written concurrently
+    targets, writes = tuning.queue_writes(devices, profile)
+    await asyncio.gather(*[
+        _tune_device([w for w in writes if w[0] == device])
+        for device in targets])
+    dprint("Tuned devices {} with profile {}".format(targets, profile))
+
+
+async def _wait_device(portal, iqn, lun):
+    device = mount._portal_device(portal, iqn, lun)
+    while not device:
+        await asyncio.sleep(1)
+        device = mount._portal_device(portal, iqn, lun)
+    return device
+
+
+async def _wait_sessions(iqn, lun, expected, devices):
+    timeout = mount.SESSION_TIMEOUT
+    found = mount._sessions_ready(iqn, lun, expected, timeout)
+    while found is None:
+        await asyncio.sleep(1)
+        timeout -= 1
+        found = mount._sessions_ready(iqn, lun, expected, timeout)
+    return sorted(set(devices) | set(found))
@@ -0,0 +1,170 @@
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+
+from dfs_sdk import scaffold
+
+from dbmp.topology import get_topology
+from dbmp.utils import Parallel, dprint, exe_remote, putf_remote, locker
+
+REPO = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+REQUIREMENTS = os.path.join(REPO, 'requirements.txt')
+BUNDLE_DIR = os.path.join(REPO, '.dbmp-bundle')
+WHEELHOUSE = os.path.join(BUNDLE_DIR, 'wheelhouse')
+BUNDLE_FILES = ('install.py', 'requirements.txt', 'setup.py', 'setup.cfg')
+BUNDLE_DIRS = ('src',)
+REMOTE_HASH = '~/dbmp/.bundle-hash'
+_BUNDLE = {}
+_INSTALLED = set()
+_HOST_LOCKS = {}
+_HOST_LOCKS_LOCK = threading.Lock()
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _bundle_files():
+    files = list(BUNDLE_FILES)
+    for d in BUNDLE_DIRS:
+        for root, dirs, fnames in os.walk(os.path.join(REPO, d)):
+            dirs[:] = [x for x in dirs if x != '__pycache__']
+            for fname in fnames:
+                if not fname.endswith('.pyc'):
+                    files.append(os.path.relpath(
+                        os.path.join(root, fname), REPO))
+    return sorted(files)
+
+
+def _build_wheelhouse():
+    with io.open(REQUIREMENTS, 'rb') as f:
+        req_hash = _sha256(f.read())
+    marker = os.path.join(WHEELHOUSE, '.requirements-hash')
+    current = None
+    if os.path.exists(marker):
+        with io.open(marker) as f:
+            current = f.read().strip()
+    if current != req_hash:
+        print("Building dbmp wheelhouse:", WHEELHOUSE)
+        # Wheels of requirements (or versions) no longer required would
+        # otherwise ship in every bundle
+        for fname in os.listdir(WHEELHOUSE):
+            if fname.endswith('.whl') or fname == '.requirements-hash':
+                os.remove(os.path.join(WHEELHOUSE, fname))
+        try:
+            subprocess.check_output(
+                [sys.executable, '-m', 'pip', 'wheel', '-q',
+                 '-r', REQUIREMENTS, '-w', WHEELHOUSE],
+                stderr=subprocess.STDOUT)
+        except (subprocess.CalledProcessError, OSError) as e:
+            print("Could not build wheelhouse, run-hosts will install "
+                  "requirements from the network:", e)
+            return []
+        with io.open(marker, 'w') as f:
+            f.write(req_hash)
+    return sorted(f for f in os.listdir(WHEELHOUSE) if f.endswith('.whl'))
+
+
+@locker
+def build_bundle():
+    """
+    Builds (once per process) a tarball of the dbmp source tree plus a
+    wheelhouse of its requirements, named by the hash of its contents.
+    Returns (hash, path, has_wheels)
+    """
+    import tarfile
+    if _BUNDLE:
+        return _BUNDLE['hash'], _BUNDLE['path'], _BUNDLE['wheels']
+    if not os.path.isdir(WHEELHOUSE):
+        os.makedirs(WHEELHOUSE)
+    files = _bundle_files()
+    wheels = _build_wheelhouse()
+    h = hashlib.sha256()
+    for fname in files:
+        h.update(fname.encode('utf-8'))
+        with io.open(os.path.join(REPO, fname), 'rb') as f:
+            h.update(f.read())
+    for wheel in wheels:
+        h.update(wheel.encode('utf-8'))
+    digest = h.hexdigest()[:16]
+    path = os.path.join(BUNDLE_DIR, 'dbmp-{}.tar.gz'.format(digest))
+    if not os.path.exists(path):
+        dprint("Building dbmp bundle:", path)
+        tmp = path + '.tmp'
+        with tarfile.open(tmp, 'w:gz') as tar:
+            for fname in files:
+                tar.add(os.path.join(REPO, fname), arcname=fname)
+            for wheel in wheels:
+                tar.add(os.path.join(WHEELHOUSE, wheel),
+                        arcname=os.path.join('wheelhouse', wheel))
+        os.rename(tmp, path)
+    _BUNDLE.update(hash=digest, path=path, wheels=bool(wheels))
+    return digest, path, bool(wheels)
+
+
+def _host_lock(host):
+    with _HOST_LOCKS_LOCK:
+        return _HOST_LOCKS.setdefault(host, threading.Lock())
+
+
+def check_install(host):
+    """
+    Ensures the run-host has the current dbmp bundle and Datera config.
+    Both are compared by content hash in a single SSH round trip and only
+    pushed when they differ.  Hosts already checked during this run are
+    skipped entirely.
+    """
+    if host in _INSTALLED:
+        return
+    with _host_lock(host):
+        if host in _INSTALLED:
+            return
+        digest, path, wheels = build_bundle()
+        config = json.dumps(scaffold.get_config(), sort_keys=True,
+                            indent=4).encode('utf-8')
+        user, _, _ = get_topology(host)
+        cfile = '/home/{}/datera-config.json'.format(user)
+        out = exe_remote(
+            host,
+            'echo "bundle=$(cat {} 2>/dev/null)"; '
+            'echo "config=$(sha256sum {} 2>/dev/null | cut -d" " -f1)"'.format(
+                REMOTE_HASH, cfile))
+        remote = dict(line.split('=', 1) for line in out.splitlines()
+                      if '=' in line)
+        if remote.get('bundle', '').strip() != digest:
+            print("Pushing dbmp bundle {} to host {}".format(digest, host))
+            rpath = '/tmp/dbmp-{}.tar.gz'.format(digest)
+            putf_remote(host, path, rpath)
+            wh = '--wheelhouse ~/dbmp/wheelhouse' if wheels else ''
+            exe_remote(
+                host,
+                'mkdir -p ~/dbmp && rm -rf ~/dbmp/src ~/dbmp/wheelhouse && '
+                'tar -xzf {rpath} -C ~/dbmp && rm -f {rpath} && '
+                'cd ~/dbmp && ./install.py -q {wh} && '
+                'echo {digest} > {hfile}'.format(
+                    rpath=rpath, wh=wh, digest=digest, hfile=REMOTE_HASH))
+        else:
+            dprint("dbmp bundle up to date on host", host)
+        if remote.get('config', '').strip() != _sha256(config):
+            dprint("Pushing datera config to host", host)
+            putf_remote(host, io.BytesIO(config), cfile)
+        _INSTALLED.add(host)
+
+
+def check_installs(hosts, workers):
+    build_bundle()
+    funcs, args = [], []
+    for host in hosts:
+        funcs.append(check_install)
+        args.append((host,))
+    if funcs:
+        p = Parallel(funcs, args_list=args, max_workers=workers)
+        p.run_threads()
@@ -0,0 +1,260 @@
+"""
+Run to run performance comparison.
+
+    dbmp compare A B [--threshold 5] [--alpha 0.05] [--metric M ...]
+
+A and B are each a --metrics output file (raw points or a --metrics-op
+reduction) or a fio JSON result (--output-format=json).  Every metric is
+aligned per volume (App Instance, or fio job target) and compared:
+
+* median and p99 of A and B and their relative deltas
+* a two sided Mann-Whitney U test of B against A
+* for the metric pooled over all volumes, a bootstrap 95% confidence
+  interval of the relative median delta
+
+A metric is a regression when its median got worse (lower for rates, higher
+for latency metrics) by more than the threshold and the difference is
+significant, or by more than the threshold alone when either side has fewer
+than MIN_SAMPLES samples.  A metric with samples in A but none in B is
+MISSING.  Only the pooled rows gate the exit code, which is 1 if any metric
+regressed or went missing so nightly runs can fail on it.
+"""
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import argparse
+import io
+import json
+import math
+import random
+
+from dbmp.metrics import write_metrics
+from dbmp.utils import percentile
+
+MIN_SAMPLES = 3
+# Larger sample sets are subsampled for the bootstrap, which only widens
+# (never narrows) the interval
+BOOTSTRAP_MAX = 1000
+ALL = '(all)'
+
+
+def _fio_samples(data):
+    samples = {}
+    for i, job in enumerate(data.get('jobs', [])):
+        opts = job.get('job options', {})
+        vol = opts.get('filename') or opts.get('directory') or '{}-{}'.format(
+            job.get('jobname', 'job'), i)
+        for rw in ('read', 'write'):
+            stats = job.get(rw) or {}
+            if not stats.get('io_bytes'):
+                continue
+            clat = stats.get('clat_ns') or {}
+            metrics = {'iops_' + rw: stats.get('iops'),
+                       'bw_kb_' + rw: stats.get('bw'),
+                       'lat_avg_us_' + rw: clat.get('mean', 0) / 1000}
+            p99 = (clat.get('percentile') or {}).get('99.000000')
+            if p99 is not None:
+                metrics['lat_99_us_' + rw] = p99 / 1000
+            for metric, value in metrics.items():
+                if value is not None:
+                    samples.setdefault(metric, {}).setdefault(
+                        vol, []).append(value)
+    return samples
+
+
+def load(path):
+    """ Returns {metric: {volume: [values]}} for a metrics or fio file """
+    with io.open(path) as f:
+        data = json.load(f)
+    if 'jobs' in data and 'fio version' in data:
+        return _fio_samples(data)
+    samples = {}
+    for vol, metrics in data.items():
+        if not isinstance(metrics, dict):
+            # total-* reductions are {total_<metric>: value}
+            samples.setdefault(vol, {})[ALL] = [metrics]
+            continue
+        for metric, points in metrics.items():
+            if not isinstance(points, list):
+                points = [{'value': points}]
+            samples.setdefault(metric, {})[vol] = [
+                p['value'] for p in points if p.get('value') is not None]
+    return samples
+
+
+def _median(values):
+    return percentile(values, 50)
+
+
+def _delta(a, b):
+    if a is None or b is None or not a:
+        return None
+    return (b - a) / abs(a) * 100
+
+
+def mann_whitney(a, b):
+    """ Two sided p-value of the Mann-Whitney U test, normal approximation """
+    n1, n2 = len(a), len(b)
+    combined = sorted([(v, 0) for v in a] + [(v, 1) for v in b])
+    n = n1 + n2
+    ranks_a, ties, i = 0.0, 0, 0
+    while i < n:
+        j = i
+        while j + 1 < n and combined[j + 1][0] == combined[i][0]:
+            j += 1
+        rank = (i + j) / 2 + 1
+        t = j - i + 1
+        ties += t ** 3 - t
+        ranks_a += rank * sum(1 for k in range(i, j + 1)
+                              if combined[k][1] == 0)
+        i = j + 1
+    u = ranks_a - n1 * (n1 + 1) / 2
+    sigma = math.sqrt(n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1))))
+    if not sigma:
+        return 1.0
+    z = (u - n1 * n2 / 2) / sigma
+    return math.erfc(abs(z) / math.sqrt(2))
+
+
+def bootstrap_ci(a, b, iterations, rng):
+    """ 95% confidence interval of the relative median delta of B vs A """
+    if len(a) > BOOTSTRAP_MAX:
+        a = rng.sample(a, BOOTSTRAP_MAX)
+    if len(b) > BOOTSTRAP_MAX:
+        b = rng.sample(b, BOOTSTRAP_MAX)
+    deltas = []
+    for _ in range(iterations):
+        ma = _median([rng.choice(a) for _ in a])
+        mb = _median([rng.choice(b) for _ in b])
+        d = _delta(ma, mb)
+        if d is not None:
+            deltas.append(d)
+    if not deltas:
+        return None
+    return percentile(deltas, 2.5), percentile(deltas, 97.5)
+
+
+def compare(a, b, metric, vol, threshold, alpha, iterations=0, rng=None):
+    """ Returns the comparison row of one metric's samples `a` and `b` """
+    lower_better = 'lat_' in metric
+    row = {'metric': metric, 'volume': vol, 'n': (len(a), len(b)),
+           'median': (_median(a), _median(b)),
+           'p99': (percentile(a, 99), percentile(b, 99)), 'p': None,
+           'ci': None}
+    row['median_delta'] = _delta(*row['median'])
+    row['p99_delta'] = _delta(*row['p99'])
+    enough = min(len(a), len(b)) >= MIN_SAMPLES
+    if enough:
+        row['p'] = mann_whitney(a, b)
+        if iterations:
+            row['ci'] = bootstrap_ci(a, b, iterations, rng)
+    worse = row['median_delta']
+    if worse is not None and lower_better:
+        worse = -worse
+    row['verdict'] = 'ok'
+    if worse is not None and abs(worse) > threshold and (
+            not enough or row['p'] < alpha):
+        row['verdict'] = 'REGRESSION' if worse < 0 else 'improved'
+    if a and not b:
+        row['verdict'] = 'MISSING'
+    return row
+
+
+def _align(a, b):
+    common = sorted(set(a) & set(b))
+    if common:
+        return [(v, a[v], b[v]) for v in common]
+    # Runs with different volume names (eg prefixes) align in name order
+    return [('{}|{}'.format(va, vb), a[va], b[vb])
+            for va, vb in zip(sorted(a), sorted(b))]
+
+
+def compare_sets(a, b, threshold, alpha, iterations, metrics=None, seed=0):
+    rng = random.Random(seed)
+    rows = []
+    for metric in sorted(set(a) | set(b)):
+        if metrics and metric not in metrics:
+            continue
+        all_a = [v for vals in a.get(metric, {}).values() for v in vals]
+        if metric not in b:
+            # Whatever produced it in A is gone from B
+            if all_a:
+                rows.append(compare(all_a, [], metric, ALL, threshold, alpha))
+            continue
+        if metric not in a:
+            print("Metric {} is only in B".format(metric))
+            continue
+        aligned = _align(a[metric], b[metric])
+        for vol, va, vb in aligned:
+            if vol != ALL:
+                rows.append(compare(va, vb, metric, vol, threshold, alpha))
+        pooled_a = [v for _, va, _ in aligned for v in va]
+        pooled_b = [v for _, _, vb in aligned for v in vb]
+        if pooled_a and pooled_b:
+            rows.append(compare(pooled_a, pooled_b, metric, ALL, threshold,
+                                alpha, iterations, rng))
+        elif all_a and not pooled_b:
+            rows.append(compare(all_a, [], metric, ALL, threshold, alpha))
+    return rows
+
+
+def _fmt(v, spec='{:.1f}'):
+    return '-' if v is None else spec.format(v)
+
+
+def print_rows(rows):
+    from tabulate import tabulate
+    table = []
+    for r in rows:
+        ci = r['ci'] and '[{:+.1f}, {:+.1f}]'.format(*r['ci'])
+        table.append([
+            r['metric'], r['volume'], '{}/{}'.format(*r['n']),
+            _fmt(r['median'][0]), _fmt(r['median'][1]),
+            _fmt(r['median_delta'], '{:+.1f}%'), ci or '-',
+            _fmt(r['p99'][0]), _fmt(r['p99'][1]),
+            _fmt(r['p99_delta'], '{:+.1f}%'), _fmt(r['p'], '{:.3g}'),
+            r['verdict']])
+    print(tabulate(table, headers=[
+        'metric', 'volume', 'n A/B', 'median A', 'median B', 'delta',
+        '95% CI', 'p99 A', 'p99 B', 'delta', 'p', 'verdict']))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='dbmp compare',
+        description='Compare two --metrics output or fio JSON result files')
+    parser.add_argument('a', help='Baseline result file')
+    parser.add_argument('b', help='Result file compared to the baseline')
+    parser.add_argument('--threshold', type=float, default=5,
+                        help='Percent change of a median that counts as a '
+                             'regression if significant')
+    parser.add_argument('--alpha', type=float, default=0.05,
+                        help='Significance level of the Mann-Whitney test')
+    parser.add_argument('--bootstrap', type=int, default=1000,
+                        help='Bootstrap iterations for the confidence '
+                             'intervals, 0 to skip them')
+    parser.add_argument('--metric', action='append',
+                        help='Only compare this metric, can be repeated')
+    parser.add_argument('--out-file',
+                        help='Also write the comparison rows as JSON here')
+    args = parser.parse_args(argv)
+    rows = compare_sets(load(args.a), load(args.b), args.threshold,
+                        args.alpha, args.bootstrap, args.metric)
+    if not rows:
+        print("No common metrics to compare")
+        return 1
+    print_rows(rows)
+    if args.out_file:
+        write_metrics(rows, args.out_file)
+    failed = False
+    for verdict, label in (('MISSING', 'Missing in B'),
+                           ('REGRESSION', 'Regressions')):
+        names = [r['metric'] for r in rows
+                 if r['volume'] == ALL and r['verdict'] == verdict]
+        if names:
+            print("{}: {}".format(label, ", ".join(names)))
+            failed = True
+    if failed:
+        return 1
+    print("No regressions")
+    return 0
@@ -3,10 +3,13 @@ from __future__ import unicode_literals, print_function, division
 import io
 import os
 import tempfile
-from StringIO import StringIO
+import threading
 
-from dbmp.utils import ASSETS, exe, putf_remote, rand_file_name, check_install
-from dbmp.utils import exe_remote_py
+from six import StringIO
+
+from dbmp.bundle import check_install
+from dbmp.utils import ASSETS, putf_remote, rand_file_name, run
+from dbmp.utils import exe_remote_py, agent_enabled, remote_call
 
 FIO_DEFAULT = os.path.join(ASSETS, 'fiotemplate.fio')
 
@@ -24,21 +27,49 @@ def gen_fio(fiofile, dev_or_folders):
 def run_fio_from_file(fiofile):
     print("Running FIO job")
     print(fiofile)
-    exe("sudo fio {}".format(fiofile))
+    return run(['fio', fiofile], sudo=True, check=True).stdout
 
 
-def gen_fio_remote(host, vols, fiofile, directory):
-    fio = _setup(vols, fiofile, directory)
+def gen_fio_remote(host, fiofile, dev_or_folders, runtime=None):
+    fio = _setup(fiofile, dev_or_folders, runtime=runtime)
+    check_install(host)
+    if agent_enabled():
+        # The agent receives the job inline, no separate upload needed
+        return remote_call(host, 'fio', {'workload': fio}, None)
     fname = rand_file_name('/tmp')
     putf_remote(host, StringIO(fio), fname)
-    check_install(host)
     exe_remote_py(
         host,
         'fio.py '
         '--fio-workload {}'.format(fname))
 
 
-def _setup(fiofile, dev_or_folders):
+def start_fio(host, fiofile, dev_or_folders, runtime):
+    """
+    Runs the fio workload against `dev_or_folders` on `host` in a background
+    thread, limited to `runtime` seconds.  Returns the started thread
+    """
+    if host == 'local':
+        fname = rand_file_name('/tmp')
+        with io.open(fname, 'w') as f:
+            f.write(_setup(fiofile, dev_or_folders, runtime=runtime))
+        target, args = _run_fio_tmp, (fname,)
+    else:
+        target, args = gen_fio_remote, (host, fiofile, dev_or_folders, runtime)
+    t = threading.Thread(target=target, args=args)
+    t.daemon = True
+    t.start()
+    return t
+
+
+def _run_fio_tmp(fname):
+    try:
+        run_fio_from_file(fname)
+    finally:
+        os.remove(fname)
+
+
+def _setup(fiofile, dev_or_folders, runtime=None):
     fiobase = None
     if not fiofile:
         fiofile = FIO_DEFAULT
@@ -51,6 +82,9 @@ def _setup(fiofile, dev_or_folders):
             break
     if not found_size:
         fiobase.append('size=1G')
+    if runtime:
+        # Overrides any earlier runtime in the workload's global section
+        fiobase.extend(('time_based', 'runtime={}'.format(int(runtime))))
     for df in dev_or_folders:
         fiobase.append('[fio-job]')
         _add_directory(fiobase, df)
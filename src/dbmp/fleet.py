@@ -0,0 +1,240 @@
+"""
+Declarative fleet provisioning.
+
+A fleet file describes the desired set of app_instances.  It extends the
+complex volume format (see examples/complex.json) with simple volume
+"groups":
+
+    {
+        "groups": [
+            {"prefix": "bench", "count": 150, "size": 10,
+             "qos": {"total_iops_max": 1000}}
+        ],
+        "app_instances": [
+            {"name": "complex-app", "sis": [...]}
+        ]
+    }
+
+A plain complex volume file is accepted as a fleet of one app_instance.
+
+The current app_instances are fetched with a single list call and diffed
+against the fleet, producing the minimal set of create, resize, QoS update
+and delete actions.  Only group members (<prefix>-<index>) beyond a group's
+count are deleted, other app_instances are never touched.  Before they are
+deleted they're unmounted and logged out on the run hosts, an app_instance
+that still has active sessions afterwards is left alone.
+"""
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import re
+
+from dfs_sdk import exceptions as dat_exceptions
+
+from dbmp import rest
+from dbmp.mount import teardown, clean_mounts_remote
+from dbmp.utils import Parallel, dprint
+from dbmp.volume import STORE_NAME, VOL_NAME, QOS_KEYS
+from dbmp.volume import read_vol_opts, normalize_opts, normalize_complex
+from dbmp.volume import _create_volume, _create_complex_volume, clean_volume
+from dbmp.volume import set_qos
+
+
+def read_fleet(fname):
+    """
+    Returns {ai_name: desired} where desired is a dict with either
+    'group' (the group opts) or 'complex' (the complex opts) and 'sis',
+    {si_name: {vol_name: vol_opts}} for diffing, plus the list of groups
+    """
+    data = read_vol_opts(fname)
+    if 'sis' in data:
+        data = {'app_instances': [data]}
+    unknown = set(data) - {'groups', 'app_instances'}
+    if unknown:
+        raise EnvironmentError(
+            "Unknown fleet keys: {}".format(", ".join(sorted(unknown))))
+    desired, groups = {}, []
+    for i, group in enumerate(data.get('groups', [])):
+        where = '{} group {}'.format(fname, i)
+        if not group.get('prefix'):
+            raise EnvironmentError("{} requires a 'prefix'".format(where))
+        opts = normalize_opts(group, where)
+        groups.append(opts)
+        vol = {'size': opts['size'], 'qos': opts['qos']}
+        for n in range(opts['count']):
+            name = '{}-{}'.format(opts['prefix'], n)
+            # Template internals are owned by the template, don't diff them
+            sis = {} if opts['template'] else {STORE_NAME: {VOL_NAME: vol}}
+            _add_desired(desired, name, {'group': opts, 'sis': sis})
+    for ai in data.get('app_instances', []):
+        opts = normalize_complex(ai)
+        sis = {dsi['name']: {dvol['name']: dvol for dvol in dsi['vols']}
+               for dsi in opts['sis']}
+        _add_desired(desired, opts['name'], {'complex': opts, 'sis': sis})
+    return desired, groups
+
+
+def _add_desired(desired, name, entry):
+    if name in desired:
+        raise EnvironmentError(
+            "app_instance {} is described more than once in the "
+            "fleet".format(name))
+    desired[name] = entry
+
+
+def _current_vols(ai):
+    # The app_instances list response embeds storage_instances and volumes
+    vols = {}
+    for si in ai.get('storage_instances', []):
+        for vol in si.get('volumes', []):
+            vols[(si['name'], vol['name'])] = vol
+    return vols
+
+
+def _qos(policy):
+    # 0 means unlimited, the same as leaving the key out
+    return {k: policy[k] for k in QOS_KEYS if policy.get(k)}
+
+
+def _current_qos(ai, si_name, vol_name, vol):
+    if 'performance_policy' in vol:
+        return _qos(vol['performance_policy'] or {})
+    # Not embedded in the list response, read it from the volume
+    dprint("Fetching QoS policy of {},{},{}".format(ai.name, si_name,
+                                                     vol_name))
+    with rest.uncached():
+        try:
+            policy = ai.storage_instances.get(si_name).volumes.get(
+                vol_name).performance_policy.get()
+        except dat_exceptions.ApiNotFoundError:
+            policy = {}
+    return _qos(policy)
+
+
+def plan(api, desired, groups):
+    """
+    Returns a list of (action, ai_name, detail) tuples needed to bring the
+    cluster in line with `desired`.  Updates and deletes carry the listed
+    app_instance so applying them doesn't need to fetch it again
+    """
+    current = {ai.name: ai for ai in api.app_instances.list()}
+    actions = []
+    for name, want in sorted(desired.items()):
+        ai = current.get(name)
+        if ai is None:
+            actions.append(('create', name, want))
+            continue
+        vols = _current_vols(ai)
+        for si_name, dvols in sorted(want['sis'].items()):
+            for vol_name, dvol in sorted(dvols.items()):
+                vol = vols.get((si_name, vol_name))
+                where = (si_name, vol_name)
+                upd = (ai,)
+                if vol is None:
+                    print("WARNING: {},{},{} is missing and can only be "
+                          "fixed by recreating {}".format(
+                              name, si_name, vol_name, name))
+                    continue
+                if dvol['size'] > vol['size']:
+                    actions.append(
+                        ('resize', name, where + (dvol['size'],) + upd))
+                elif dvol['size'] < vol['size']:
+                    print("WARNING: {},{},{} can't shrink from {}GB to "
+                          "{}GB".format(name, si_name, vol_name, vol['size'],
+                                        dvol['size']))
+                qos = _current_qos(ai, si_name, vol_name, vol)
+                if qos != _qos(dvol['qos']):
+                    actions.append(
+                        ('qos', name, where + (dvol['qos'],) + upd))
+    for opts in groups:
+        pattern = re.compile(r'^{}-(\d+)$'.format(re.escape(opts['prefix'])))
+        for name in sorted(current):
+            match = pattern.match(name)
+            if (match and int(match.group(1)) >= opts['count'] and
+                    name not in desired):
+                actions.append(('delete', name, current[name]))
+    return actions
+
+
+def print_plan(actions):
+    if not actions:
+        print("Fleet is up to date, nothing to do")
+        return
+    counts = {}
+    for action, name, detail in actions:
+        counts[action] = counts.get(action, 0) + 1
+        if action == 'resize':
+            print("~ resize {},{},{} -> {}GB".format(name, *detail[:3]))
+        elif action == 'qos':
+            print("~ qos    {},{},{} -> {}".format(
+                name, detail[0], detail[1], detail[2] or 'unlimited'))
+        elif action == 'create':
+            print("+ create {}".format(name))
+        else:
+            print("- delete {}".format(name))
+    print("Plan:", ", ".join("{} {}".format(v, k)
+                             for k, v in sorted(counts.items())))
+
+
+def _active_initiators(ai):
+    with rest.uncached():
+        sis = ai.storage_instances.list()
+    return sorted(set(init for si in sis
+                      for init in si.get('active_initiators') or []))
+
+
+def _release(api, names, hosts, directory, workers):
+    # Unmount and logout on every host so nothing is deleted while in use
+    vopt = ','.join(names)
+    for host in hosts:
+        if host == 'local':
+            teardown(api, [vopt], directory, workers, False)
+        else:
+            clean_mounts_remote(host, vopt, directory, workers)
+
+
+def _apply_action(api, action, name, detail, results):
+    dprint("Applying fleet action", action, name)
+    if action == 'create' and 'group' in detail:
+        _create_volume(api, detail['group'], name, results)
+    elif action == 'create':
+        results.append(_create_complex_volume(api, detail['complex']))
+    elif action == 'delete':
+        inits = _active_initiators(detail)
+        if inits:
+            print("WARNING: not deleting {}, it still has sessions from "
+                  "{}".format(name, ", ".join(inits)))
+            return
+        clean_volume(detail)
+    else:
+        si_name, vol_name, value, ai = detail
+        vol = ai.storage_instances.get(si_name).volumes.get(vol_name)
+        if action == 'resize':
+            vol.set(size=value)
+        else:
+            set_qos(vol, value)
+        print("Updated {} for {},{},{}".format(action, name, si_name,
+                                               vol_name))
+
+
+def apply(api, actions, workers, hosts, directory):
+    deletes = [name for action, name, _ in actions if action == 'delete']
+    if deletes:
+        _release(api, deletes, hosts, directory, workers)
+    funcs, args, results = [], [], []
+    for action, name, detail in actions:
+        funcs.append(_apply_action)
+        args.append((api, action, name, detail, results))
+    if funcs:
+        p = Parallel(funcs, args_list=args, max_workers=workers)
+        p.run_threads()
+    return results
+
+
+def run_fleet(api, fname, do_apply, workers, hosts, directory):
+    desired, groups = read_fleet(fname)
+    actions = plan(api, desired, groups)
+    print_plan(actions)
+    if do_apply and actions:
+        apply(api, actions, workers, hosts, directory)
+    return actions
@@ -0,0 +1,129 @@
+"""
+Golden image provisioning.
+
+Instead of formatting (and optionally prefilling) every volume on its own,
+only the first app_instance of a simple --volume spec (<prefix>-0) is
+created, mounted, formatted and filled.  It is then unmounted, logged out
+and snapshotted and the remaining count - 1 app_instances are created in
+parallel as clones of that snapshot.  Every clone carries the source's
+filesystem and data, so they are mounted without running mkfs, after giving
+each copy of the filesystem a UUID of its own.
+"""
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import time
+
+from dbmp import rest
+from dbmp.mount import get_dirname, mount_volumes, mount_volumes_remote
+from dbmp.mount import teardown, clean_mounts_remote
+from dbmp.utils import Parallel, run, exe_remote, dprint, get_hostname
+from dbmp.volume import ais_from_vols, get_spec, set_qos, _create_volume
+
+FILL_ARGS = ['--name=golden-fill', '--rw=write', '--bs=1M', '--direct=1',
+             '--ioengine=libaio', '--iodepth=16', '--fill_device=1',
+             '--end_fsync=1']
+SNAPSHOT_TIMEOUT = 300
+
+
+def _fill(host, folder):
+    print("Prefilling golden volume:", folder)
+    argv = ['fio', '--directory={}'.format(folder)] + FILL_ARGS
+    if host == 'local':
+        run(argv, sudo=True, check=True)
+    else:
+        exe_remote(host, 'sudo ' + ' '.join(argv))
+
+
+def _prepare_source(host, api, src, multipath, fs, fsargs, directory,
+                    workers, fill):
+    if host == 'local':
+        mount_volumes(api, [src], multipath, fs, fsargs, directory, workers,
+                      False)
+    else:
+        mount_volumes_remote(host, [src], multipath, fs, fsargs, directory,
+                             workers, False)
+    if fill:
+        funcs, args = [], []
+        for si in src.storage_instances.list():
+            for vol in si.volumes.list():
+                funcs.append(_fill)
+                args.append((host, get_dirname(
+                    directory, src.name, si.name, vol.name)))
+        p = Parallel(funcs, args_list=args, max_workers=workers)
+        p.run_threads()
+    # Unmount and log out so the snapshot has a clean filesystem
+    if host == 'local':
+        teardown(api, [src.name], directory, workers, False)
+    else:
+        clean_mounts_remote(host, src.name, directory, workers)
+
+
+def _snapshot(src):
+    snap = src.snapshots.create()
+    timeout = SNAPSHOT_TIMEOUT
+    interval = 0.5
+    while snap['op_state'] != 'available':
+        if timeout <= 0:
+            raise EnvironmentError(
+                "Snapshot {} of {} did not become available".format(
+                    snap['path'], src.name))
+        dprint("Waiting for snapshot to become available:", snap['path'])
+        time.sleep(interval)
+        timeout -= interval
+        interval = min(interval * 1.5, 5)
+        with rest.uncached():
+            snap = snap.reload()
+    print("Created golden snapshot:", snap['path'])
+    return snap
+
+
+def _create_clone(api, snap, name, qos, results):
+    ai = api.app_instances.create(
+        name=name, clone_snapshot_src={'path': snap['path']})
+    if qos:
+        for si in ai.storage_instances.list():
+            for vol in si.volumes.list():
+                set_qos(vol, qos)
+    print("Created clone:", name)
+    results.append(ai)
+
+
+def create_golden_volumes(host, api, vopt, multipath, fs, fsargs, directory,
+                          workers, fill):
+    """
+    Creates the app_instances described by the simple volume spec `vopt`
+    from a single formatted (and optionally prefilled) golden volume.
+    Returns every app_instance, the source first, and the names of those
+    created here, which already carry a filesystem.  Existing app_instances
+    are returned as is and still need formatting
+    """
+    spec = get_spec(vopt)
+    if spec.kind != 'opts':
+        raise EnvironmentError(
+            "--golden requires a simple volume spec, not: {}".format(vopt))
+    ais = ais_from_vols(api, vopt)
+    # If they already exist lets just use them
+    if ais:
+        return ais, []
+    start = time.time()
+    plans = list(spec.plans(get_hostname(host)))
+    results = []
+    _create_volume(api, spec.opts, plans[0][1], results)
+    src = results[0]
+    _prepare_source(host, api, src, multipath, fs, fsargs, directory,
+                    workers, fill)
+    prepared = time.time()
+    snap = _snapshot(src)
+    funcs, args = [], []
+    for _, name in plans[1:]:
+        funcs.append(_create_clone)
+        args.append((api, snap, name, spec.opts['qos'], results))
+    if funcs:
+        p = Parallel(funcs, args_list=args, max_workers=workers)
+        p.run_threads()
+    print("Created {} volumes from golden image in {:.2f}s (source "
+          "{:.2f}s, snapshot and clones {:.2f}s)".format(
+              len(results), time.time() - start, prepared - start,
+              time.time() - prepared))
+    return results, [ai.name for ai in results]
@@ -0,0 +1,186 @@
+"""
+Initiator side block device statistics for --metrics --host-stats.
+
+Alongside the array side metrics, /proc/diskstats of each run-host is sampled
+once per metrics interval for the device every volume is accessed through
+(its dm-multipath device, or the path device without multipath) and for the
+path devices under it.  The devices are found the same way _login finds
+them: by-path links and iSCSI session LUNs, and the dm device holding them.
+Counter deltas are summed per app_instance, giving host_* metrics that sit
+next to the array's in the results:
+
+* host_iops_*, host_thpt_* (bytes/s) and host_queue_depth (average
+  requests in flight) of the volumes' devices
+* host_lat_avg_* (us), the await of a request on the host, including any
+  time it queued in the dm device
+* host_path_lat_avg (us), the await on the path devices, so the time spent
+  on the network and array
+
+So host_lat_avg well above host_path_lat_avg points at the host, and
+host_path_lat_avg well above the array's own lat_avg_* at the network.
+"""
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import io
+import json
+import time
+
+from dbmp.bundle import check_install
+from dbmp.utils import agent_enabled, dprint, remote_call
+
+DISKSTATS = '/proc/diskstats'
+# Prefix of the line remote/hoststats.py prints its result on
+HOSTSTATS_RESULT = 'dbmp-hoststats-result: '
+SECTOR = 512
+# The counters following major, minor and name, in_flight (the 9th field) is
+# a gauge and skipped
+FIELDS = ('reads', 'reads_merged', 'sectors_read', 'ms_read', 'writes',
+          'writes_merged', 'sectors_written', 'ms_write', None, 'ms_io',
+          'ms_weighted')
+METRICS = ('host_iops_read', 'host_iops_write', 'host_thpt_read',
+           'host_thpt_write', 'host_lat_avg_read', 'host_lat_avg_write',
+           'host_path_lat_avg', 'host_queue_depth')
+
+
+def read_diskstats(devices):
+    """ Returns {device: {counter: value}} for `devices` """
+    stats = {}
+    with io.open(DISKSTATS) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 14 or parts[2] not in devices:
+                continue
+            stats[parts[2]] = {field: int(value) for field, value in
+                               zip(FIELDS, parts[3:14]) if field}
+    return stats
+
+
+def sample(devices):
+    return {'time': time.time(), 'stats': read_diskstats(set(devices))}
+
+
+def get_targets(ais):
+    """ Returns (ai name, iqn, portals, lun) of every volume of `ais` """
+    targets = []
+    for ai in ais:
+        for si in ai.storage_instances.list():
+            iqn = si.access.get('iqn')
+            if not iqn:
+                continue
+            for lun, _ in enumerate(si.volumes.list()):
+                targets.append((ai.name, iqn, si.access['ips'], lun))
+    return targets
+
+
+def _remote_call(host, method, params, script):
+    result = remote_call(host, method, params, script)
+    if agent_enabled():
+        return result
+    # Without the agent the result is on a line of the script's output
+    for line in result.splitlines():
+        if line.startswith(HOSTSTATS_RESULT):
+            return json.loads(line[len(HOSTSTATS_RESULT):])
+        dprint("[{}]".format(host), line)
+    raise EnvironmentError(
+        "Remote {} on {} printed no result".format(method, host))
+
+
+def _get_devices(host, targets, multipath):
+    if host == 'local':
+        # Only needed once host stats are requested
+        from dbmp.mount import device_map
+        return device_map(targets, multipath)
+    check_install(host)
+    m = '--multipath' if multipath else ''
+    return _remote_call(
+        host, 'host_devices', {'targets': targets, 'multipath': multipath},
+        "hoststats.py --targets '{}' {}".format(json.dumps(targets), m))
+
+
+def get_devices(hosts, targets, multipath):
+    """
+    Returns {host: {ai name: [[device, [path devices]]]}} of the volumes in
+    `targets` logged in on each of `hosts`
+    """
+    devices = {}
+    for host in hosts:
+        found = _get_devices(host, targets, multipath)
+        if found:
+            devices[host] = found
+    found = set(name for d in devices.values() for name in d)
+    for name in sorted(set(t[0] for t in targets) - found):
+        print("No devices of {} found on {}, skipping its host "
+              "stats".format(name, ", ".join(hosts)))
+    return devices
+
+
+def _sample(host, devices):
+    if host == 'local':
+        return sample(devices)
+    return _remote_call(
+        host, 'diskstats', {'devices': devices},
+        'hoststats.py --devices {}'.format(','.join(devices)))
+
+
+def _sum(prev, cur, devices):
+    total = dict.fromkeys((f for f in FIELDS if f), 0)
+    for dev in devices:
+        if dev not in prev or dev not in cur:
+            continue
+        for field in total:
+            delta = cur[dev][field] - prev[dev][field]
+            # The counters restart when a device is recreated
+            total[field] += delta if delta >= 0 else cur[dev][field]
+    return total
+
+
+def rates(prev, cur, volumes):
+    """
+    Returns the host_* metric values between the samples `prev` and `cur`
+    for `volumes`, a list of [device, [path devices]].  Latencies are
+    left out when there was no I/O to average over
+    """
+    dt = cur['time'] - prev['time']
+    if dt <= 0:
+        return {}
+    dev = _sum(prev['stats'], cur['stats'], [v[0] for v in volumes])
+    # Without multipath the device is its own (only) path
+    paths = _sum(prev['stats'], cur['stats'],
+                 [p for v in volumes for p in v[1]])
+    values = {'host_iops_read': dev['reads'] / dt,
+              'host_iops_write': dev['writes'] / dt,
+              'host_thpt_read': dev['sectors_read'] * SECTOR / dt,
+              'host_thpt_write': dev['sectors_written'] * SECTOR / dt,
+              'host_queue_depth': dev['ms_weighted'] / (dt * 1000)}
+    for rw in ('read', 'write'):
+        ios = dev[rw + 's']
+        if ios:
+            values['host_lat_avg_' + rw] = dev['ms_' + rw] * 1000 / ios
+    ios = paths['reads'] + paths['writes']
+    if ios:
+        values['host_path_lat_avg'] = (
+            paths['ms_read'] + paths['ms_write']) * 1000 / ios
+    return values
+
+
+def collect(host, results, devices, interval, timeout):
+    """
+    Samples the devices of every app_instance in `devices` every `interval`
+    seconds until `timeout` and appends the host_* points to `results`
+    """
+    names = sorted(set(d for vols in devices.values() for v in vols
+                       for d in [v[0]] + v[1]))
+    dprint("Sampling host stats of devices {} on {}".format(names, host))
+    prev = _sample(host, names)
+    time.sleep(interval)
+    while timeout > 0:
+        cur = _sample(host, names)
+        point_time = int(cur['time'] * 1000)
+        for name, volumes in devices.items():
+            for metric, value in rates(prev, cur, volumes).items():
+                results[name][metric].append(
+                    {'time': point_time, 'value': value})
+        prev = cur
+        time.sleep(interval)
+        timeout -= interval
@@ -0,0 +1,148 @@
+"""
+Run-host inventory and capacity weighted volume placement.
+
+Every host is probed with a single shell command (over SSH for topology
+hosts) for its CPU count, NUMA nodes, NIC link speeds, existing iSCSI
+sessions and free memory.  Probes run in parallel and their results are
+cached in INVENTORY_FILE, a host is only probed again once its entry is
+older than the TTL.
+
+A host's capacity weight is its CPU count times its total NIC speed in
+Gbps, the two limits of an initiator, shared with the iSCSI sessions the
+host already has (each one takes a CPU's worth).  Volumes spread over
+several run-hosts are placed one by one on the host with the fewest
+volumes per unit of weight.
+"""
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import io
+import json
+import time
+
+from dbmp.utils import Parallel, dprint, exe, exe_remote
+
+INVENTORY_FILE = 'dbmp-inventory.json'
+INVENTORY_TTL = 3600
+# Link speeds are in Mbps, -1 or empty when the link is down or unknown
+PROBE = ('echo "cpus=$(nproc)"; '
+         'echo "numa_nodes=$(ls -d /sys/devices/system/node/node[0-9]* | '
+         'wc -l)"; '
+         'echo "mem_free_kb=$(awk \'/^MemAvailable:/ {print $2}\' '
+         '/proc/meminfo)"; '
+         'echo "iscsi_sessions=$(ls /sys/class/iscsi_session | wc -l)"; '
+         'for n in /sys/class/net/*; do '
+         '[ -e $n/device ] && echo "nic.${n##*/}=$(cat $n/speed)"; '
+         'done; true')
+
+
+def parse_probe(out):
+    info = {'nics': {}}
+    for line in out.splitlines():
+        key, _, value = line.partition('=')
+        try:
+            value = int(value.strip())
+        except ValueError:
+            value = -1
+        if key.startswith('nic.'):
+            info['nics'][key[len('nic.'):]] = value
+        elif key:
+            info[key] = value
+    return info
+
+
+def probe(host):
+    """ Returns the inventory entry of `host` """
+    if host == 'local':
+        out = exe(PROBE)
+    else:
+        out = exe_remote(host, PROBE)
+    info = parse_probe(out)
+    info['time'] = time.time()
+    return info
+
+
+def _probe(host, results):
+    try:
+        results[host] = probe(host)
+    except Exception as e:
+        print("Could not probe host {}: {}".format(host, e))
+
+
+def read_inventory(path=INVENTORY_FILE):
+    try:
+        with io.open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_inventory(inventory, path=INVENTORY_FILE):
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(inventory, indent=4, sort_keys=True))
+
+
+def get_inventory(hosts, workers, ttl=INVENTORY_TTL):
+    """
+    Returns {host: entry} for `hosts`, probing in parallel only the hosts
+    without a cached entry younger than `ttl` seconds.  Hosts that couldn't
+    be probed are left out
+    """
+    inventory = read_inventory()
+    now = time.time()
+    stale = [h for h in hosts
+             if now - inventory.get(h, {}).get('time', 0) >= ttl]
+    dprint("Probing hosts {}, cached {}".format(
+        stale, sorted(set(hosts) - set(stale))))
+    if stale:
+        probed = {}
+        p = Parallel([_probe] * len(stale),
+                     args_list=[(h, probed) for h in stale],
+                     max_workers=workers)
+        p.run_threads()
+        inventory.update(probed)
+        write_inventory(inventory)
+    return {h: inventory[h] for h in hosts if h in inventory}
+
+
+def weight(info):
+    cpus = max(info.get('cpus', 1), 1)
+    gbps = sum(s for s in info.get('nics', {}).values() if s > 0) / 1000
+    return cpus * (gbps or 1) / (1 + max(info.get('iscsi_sessions', 0), 0) /
+                                 cpus)
+
+
+def place(vols, inventory):
+    """
+    Returns {host: [vols]} spreading `vols` over the hosts of `inventory`
+    proportional to their weight
+    """
+    if not inventory:
+        raise EnvironmentError("No run-host could be probed for placement")
+    weights = {h: weight(info) for h, info in inventory.items()}
+    placed = {h: [] for h in weights}
+    for vol in vols:
+        host = min(weights, key=lambda h: (
+            (len(placed[h]) + 1) / weights[h], h))
+        placed[host].append(vol)
+    for host, hvols in sorted(placed.items()):
+        print("Placing {} volumes on host {} (weight {:.1f})".format(
+            len(hvols), host, weights[host]))
+    return placed
+
+
+def print_inventory(inventory):
+    from tabulate import tabulate
+    now = time.time()
+    table = []
+    for host, info in sorted(inventory.items()):
+        table.append([
+            host, info.get('cpus'), info.get('numa_nodes'),
+            info.get('mem_free_kb', 0) // (1024 * 1024),
+            ", ".join("{}:{}".format(n, s) for n, s in
+                      sorted(info.get('nics', {}).items())),
+            info.get('iscsi_sessions'), '{:.1f}'.format(weight(info)),
+            '{:.0f}s'.format(now - info.get('time', now))])
+    print(tabulate(table, headers=[
+        'host', 'cpus', 'numa', 'free GB', 'nics (Mbps)', 'sessions',
+        'weight', 'age']))
@@ -10,13 +10,12 @@ import textwrap
 from dfs_sdk import scaffold
 # from dfs_sdk import exceptions as dexceptions
 
-from dbmp.metrics import get_metrics, write_metrics
-from dbmp.mount import mount_volumes, mount_volumes_remote, clean_mounts
-from dbmp.mount import clean_mounts_remote, list_mounts
-from dbmp.fio import gen_fio, gen_fio_remote
+# Only lightweight dbmp modules are imported here.  Everything else is
+# imported on the code path that needs it so that simple invocations like
+# --list templates or --health don't pay for mount/fio/metrics, paramiko or
+# the bundle machinery.  benchmarks/import_budget.py enforces this.
+from dbmp import rest, utils
 from dbmp.utils import exe
-from dbmp.volume import create_volumes, clean_volumes, list_volumes
-from dbmp.volume import list_templates
 
 SUCCESS = 0
 FAILURE = 1
@@ -27,6 +26,8 @@ METRIC_CHOICES = ('reads', 'writes', 'bytes_read',
                   'lat_avg_write', 'lat_50_read', 'lat_90_read',
                   'lat_100_read', 'lat_50_write',
                   'lat_90_write', 'lat_100_write')
+# The profiles of dbmp.tuning, which is only imported when mounting
+TUNING_PROFILES = ('default', 'latency', 'throughput')
 
 
 def hf(txt):
@@ -61,71 +62,239 @@ def run_health(api):
     return True
 
 
+def _mount_host(args, api, mount_f, host, vols, preformatted, devs):
+    login_only = not args.mount and args.login
+    if host == 'local':
+        devs[host] = mount_f(
+            api, vols, not args.no_multipath, args.fstype, args.fsargs,
+            args.directory, args.workers, login_only, preformatted,
+            args.tuning_profile, args.sessions_per_portal,
+            args.multipath_policy)
+        return
+    from dbmp.mount import mount_volumes_remote
+    devs[host] = mount_volumes_remote(
+        host, vols, not args.no_multipath, args.fstype, args.fsargs,
+        args.directory, args.workers, login_only, preformatted,
+        args.tuning_profile, args.sessions_per_portal,
+        args.multipath_policy)
+
+
 def main(args):
+    rest.install(cache=not args.no_rest_cache)
     api = scaffold.get_api()
     print('Using Config:')
     scaffold.print_config()
 
+    utils.REMOTE_AGENT = args.remote_agent
+    utils.PRIV_HELPER = not args.no_priv_helper
+
     if args.health:
         if not run_health(api):
             return FAILURE
         return SUCCESS
 
+    if args.bootstrap:
+        from dbmp.bundle import check_installs
+        from dbmp.topology import get_hosts
+        hosts = args.bootstrap.split(',')
+        if args.bootstrap == 'all':
+            hosts = get_hosts()
+        check_installs(hosts, args.workers)
+        return SUCCESS
+
+    hosts = [args.run_host]
+    if args.run_host == 'all' or ',' in args.run_host:
+        from dbmp.topology import get_hosts
+        hosts = args.run_host.split(',')
+        if args.run_host == 'all':
+            hosts = get_hosts()
+    run_host = hosts[0]
+
+    if args.inventory:
+        from dbmp.inventory import get_inventory, print_inventory
+        from dbmp.topology import get_hosts
+        if args.run_host == 'local':
+            hosts = get_hosts()
+        print_inventory(get_inventory(hosts, args.workers,
+                                      args.inventory_ttl))
+        return SUCCESS
+
+    if len(hosts) > 1 and (args.list or args.qos_step or
+                           (args.fio and args.watch)):
+        print("--list, --qos-step and --fio with --watch only support a "
+              "single --run-host")
+        return FAILURE
+
+    if args.fleet:
+        from dbmp.fleet import run_fleet
+        run_fleet(api, args.fleet, args.apply, args.workers, hosts,
+                  args.directory)
+        return SUCCESS
+
+    if args.update:
+        from dbmp.volume import update_volumes
+        for vol in args.volume:
+            update_volumes(api, vol, args.update, args.workers,
+                           args.update_rate)
+        return SUCCESS
+
     if 'volumes' in args.list:
+        from dbmp.volume import list_volumes
         for vol in args.volume:
-            list_volumes(args.run_host, api, vol, detail='detail' in args.list)
+            list_volumes(run_host, api, vol, detail='detail' in args.list)
         return SUCCESS
     elif 'templates' in args.list:
+        from dbmp.volume import list_templates
         list_templates(api, detail='detail' in args.list)
     elif 'mounts' in args.list:
+        from dbmp.mount import list_mounts, list_mounts_remote
         for vol in args.volume:
-            list_mounts(args.run_host, api, vol, 'detail' in args.list,
+            if run_host != 'local' and args.remote_agent:
+                list_mounts_remote(run_host, vol, 'detail' in args.list,
+                                   not args.no_multipath)
+                continue
+            list_mounts(run_host, api, vol, 'detail' in args.list,
                         not args.no_multipath)
         return SUCCESS
 
+    from dbmp.mount import mount_volumes, teardown
+    from dbmp.mount import clean_mounts_remote
+    from dbmp.volume import create_volumes, clean_volumes
+    teardown_f, clean_f, create_f, mount_f = (
+        teardown, clean_volumes, create_volumes, mount_volumes)
+    if args.use_async:
+        # Python 3 only, so only imported when requested
+        from dbmp import aio
+        teardown_f, clean_f, create_f, mount_f = (
+            aio.teardown, aio.clean_volumes, aio.create_volumes,
+            aio.mount_volumes)
+
     if any((args.unmount, args.logout, args.clean)):
-        for vol in args.volume:
-            if args.run_host == 'local':
-                clean_mounts(api, vol, args.directory, args.workers)
-            else:
+        # Remote hosts first, the local teardown also deletes with --clean
+        for host in hosts:
+            if host == 'local':
+                continue
+            for vol in args.volume:
                 clean_mounts_remote(
-                    args.run_host, vol, args.directory, args.workers)
-            if args.unmount:
-                return SUCCESS
-    if args.clean:
-        for vol in args.volume:
-            clean_volumes(api, vol, args.workers)
-        return SUCCESS
-    if args.logout:
+                    host, vol, args.directory, args.workers)
+        if 'local' in hosts:
+            teardown_f(api, args.volume, args.directory, args.workers,
+                       args.clean)
+        elif args.clean:
+            for vol in args.volume:
+                clean_f(api, vol, args.workers)
         return SUCCESS
 
+    if args.sessions_per_portal < 1:
+        print("--sessions-per-portal must be at least 1")
+        return FAILURE
+    if args.sessions_per_portal > 1 and args.no_multipath:
+        print("--sessions-per-portal can't be used with --no-multipath")
+        return FAILURE
+
+    if args.multipath_policy:
+        from dbmp.multipath import parse_policy
+        # Fail before anything is created or logged in
+        try:
+            parse_policy(args.multipath_policy)
+        except EnvironmentError as e:
+            print(e)
+            return FAILURE
+
+    steps = None
+    if args.qos_step:
+        if not args.mount and not args.login:
+            print("--mount or --login MUST be specified when using "
+                  "--qos-step")
+            return FAILURE
+        from dbmp.qos_step import parse_schedule
+        steps = parse_schedule(args.qos_step, args.qos_step_hold)
+
     vols = None
+    preformatted = []
     for vol in args.volume:
-        vols = create_volumes(args.run_host, api, vol, args.workers)
+        if args.golden:
+            from dbmp.golden import create_golden_volumes
+            vols, preformatted = create_golden_volumes(
+                run_host, api, vol, not args.no_multipath, args.fstype,
+                args.fsargs, args.directory, args.workers, args.golden_fill)
+            continue
+        vols = create_f(run_host, api, vol, args.workers)
 
-    login_only = not args.mount and args.login
-    if (args.mount or args.login) and vols and args.run_host == 'local':
-        dev_or_folders = mount_volumes(
-            api, vols, not args.no_multipath, args.fstype, args.fsargs,
-            args.directory, args.workers, login_only)
-    elif (args.mount or args.login) and vols and args.run_host != 'local':
-        dev_or_folders = mount_volumes_remote(
-            args.run_host, vols, not args.no_multipath, args.fstype,
-            args.fsargs, args.directory, args.workers, login_only)
+    devs = {}
+    if (args.mount or args.login) and vols:
+        if len(hosts) == 1:
+            _mount_host(args, api, mount_f, run_host, vols, preformatted,
+                        devs)
+        else:
+            from dbmp.inventory import get_inventory, place
+            placed = place(vols, get_inventory(hosts, args.workers,
+                                               args.inventory_ttl))
+            funcs, fargs = [], []
+            for host, hvols in sorted(placed.items()):
+                if hvols:
+                    funcs.append(_mount_host)
+                    fargs.append((args, api, mount_f, host, hvols,
+                                  preformatted, devs))
+            p = utils.Parallel(funcs, args_list=fargs,
+                               max_workers=len(funcs))
+            p.run_threads()
+        if args.tuning_out_file:
+            from dbmp.tuning import write_summaries
+            write_summaries(sorted(devs), args.tuning_profile,
+                            args.tuning_out_file)
+    dev_or_folders = devs.get(run_host)
+
+    if steps and vols:
+        from dbmp.qos_step import run_qos_step
+        run_qos_step(run_host, api, vols, dev_or_folders,
+                     args.fio_workload, steps, args.qos_step_interval,
+                     args.qos_step_band, args.workers,
+                     args.qos_step_out_file)
+        return SUCCESS
 
     if args.fio:
         try:
             exe("which fio")
         except EnvironmentError:
             print("FIO is not installed")
+    # With --watch fio is started alongside the metrics collection below
+    watch_fio = args.fio and args.watch and args.metrics
     if args.fio and (not args.mount and not args.login):
         print("--mount or --login MUST be specified when using --fio")
-    elif args.fio and args.run_host == 'local':
-        gen_fio(args.fio_workload, dev_or_folders)
-    elif args.fio and args.run_host != 'local':
-        gen_fio_remote(args.run_host, args.fio_workload, dev_or_folders)
+        watch_fio = False
+    elif args.fio and devs and not watch_fio:
+        from dbmp.fio import gen_fio, gen_fio_remote
+        funcs, fargs = [], []
+        for host, hdevs in sorted(devs.items()):
+            if host == 'local':
+                funcs.append(gen_fio)
+                fargs.append((args.fio_workload, hdevs))
+            else:
+                funcs.append(gen_fio_remote)
+                fargs.append((host, args.fio_workload, hdevs))
+        p = utils.Parallel(funcs, args_list=fargs, max_workers=len(funcs))
+        p.run_threads()
+
+    if args.metrics_range:
+        from dbmp.metrics import get_metrics_range, parse_range
+        from dbmp.metrics import write_metrics
+        try:
+            # Relative times are taken from now, ie once fio has finished
+            start, end = parse_range(args.metrics_range)
+        except EnvironmentError as e:
+            print(e)
+            return FAILURE
+        data = get_metrics_range(
+            api, args.metrics_type or ['iops_write'], args.volume, start,
+            end, args.workers, args.metrics_op)
+        if not data:
+            print("No data recieved from metrics")
+            return FAILURE
+        write_metrics(data, args.metrics_out_file)
 
     if args.metrics:
+        from dbmp.metrics import get_metrics, write_metrics
         data = None
         try:
             interval, timeout = map(int, args.metrics.split(','))
@@ -134,9 +303,18 @@ def main(args):
             mtypes = args.metrics_type
             if not args.metrics_type:
                 mtypes = ['iops_write']
+            fio = None
+            if watch_fio:
+                from dbmp.fio import start_fio
+                from dbmp.watch import FioProgress
+                fio = FioProgress(start_fio(
+                    run_host, args.fio_workload, dev_or_folders,
+                    timeout), timeout)
             data = get_metrics(
                 api, mtypes, args.volume, interval, timeout,
-                args.metrics_op)
+                args.metrics_op, args.watch, fio,
+                hosts if args.host_stats else None,
+                not args.no_multipath)
         except ValueError:
             print("--metrics argument must be in format '--metrics i,t' where"
                   "'i' is the interval in seconds and 't' is the timeout in "
@@ -151,6 +329,10 @@ def main(args):
 
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['compare']:
+        # Offline subcommand, needs neither a cluster nor dbmp's options
+        from dbmp.compare import main as compare_main
+        sys.exit(compare_main(sys.argv[2:]))
     tparser = scaffold.get_argparser(add_help=False)
     parser = argparse.ArgumentParser(
         parents=[tparser], formatter_class=argparse.RawTextHelpFormatter)
@@ -158,7 +340,32 @@ if __name__ == '__main__':
                         help=hf('Host on which targets should be logged in.'
                                 ' This value will be a key in your '
                                 '"dbmp-topology.json" file. Use "local" for'
-                                'the current host'))
+                                'the current host.  A comma separated list '
+                                '(or "all" hosts in the topology) spreads '
+                                'mounted volumes over the hosts weighted by '
+                                'their --inventory capacity'))
+    parser.add_argument('--remote-agent', action='store_true',
+                        help=hf('Start a persistent dbmp agent on the '
+                                '--run-host and send every remote action to '
+                                'it over a single SSH channel instead of '
+                                'starting a new remote process per action'))
+    parser.add_argument('--bootstrap',
+                        help=hf('Push the current dbmp bundle and config to '
+                                'the given comma separated run-hosts (or '
+                                '"all" hosts in the topology) in parallel.  '
+                                'Hosts that are already up to date are '
+                                'skipped'))
+    parser.add_argument('--inventory', action='store_true',
+                        help=hf('Probe the hosts of the topology (or the '
+                                '--run-host list) in parallel for CPUs, NUMA '
+                                'nodes, NIC speeds, iSCSI sessions and free '
+                                'memory and print them with their placement '
+                                'weight.  Results are cached in '
+                                '"dbmp-inventory.json"'))
+    parser.add_argument('--inventory-ttl', default=3600, type=int,
+                        help=hf('Seconds a cached host inventory entry is '
+                                'used before the host is probed again, 0 to '
+                                'always probe'))
     parser.add_argument('--health', action='store_true',
                         help='Run a quick health check')
     parser.add_argument('--list', choices=('volumes', 'volumes-detail',
@@ -180,6 +387,23 @@ if __name__ == '__main__':
                              'Example: prefix=test,size=2,replica=2\n \n'
                              'Alternatively a json file with the above\n'
                              'parameters can be specified')
+    parser.add_argument('--fleet',
+                        help=hf('Desired state fleet file, see README.  '
+                                'Prints the create/resize/qos/delete actions '
+                                'needed to reach it (--plan, the default) or '
+                                'executes them in parallel (--apply)'))
+    fleet_mode = parser.add_mutually_exclusive_group()
+    fleet_mode.add_argument('--plan', action='store_true',
+                            help='Only print the --fleet plan (default)')
+    fleet_mode.add_argument('--apply', action='store_true',
+                            help='Apply the --fleet plan')
+    parser.add_argument('--update',
+                        help=hf('Update every volume matching --volume in '
+                                'place.  Takes comma separated size and/or '
+                                'QoS params, eg: total_iops_max=500,size=10'))
+    parser.add_argument('--update-rate', default=0, type=float,
+                        help=hf('Maximum --update PUTs per second across all '
+                                'workers, 0 for unlimited'))
     parser.add_argument('--login', action='store_true',
                         help='Login volumes (implied by --mount)')
     parser.add_argument('--logout', action='store_true',
@@ -193,6 +417,13 @@ if __name__ == '__main__':
                              '--logout)')
     parser.add_argument('--workers', default=5, type=int,
                         help='Number of worker threads for this action')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help=hf('Run create, mount and clean operations on '
+                                'the asyncio core (Python 3 only).  '
+                                '--workers then bounds concurrent '
+                                'subprocesses and SSH commands, which don\'t '
+                                'take a thread, and the threads making REST '
+                                'calls'))
     parser.add_argument('--no-multipath', action='store_true')
     parser.add_argument('--fstype', default='xfs',
                         help='Filesystem to use when formatting devices')
@@ -202,6 +433,29 @@ if __name__ == '__main__':
                                 ' the args you are passing in'))
     parser.add_argument('--directory', default='/mnt',
                         help='Directory under which to mount devices')
+    parser.add_argument('--tuning-profile', default='default',
+                        choices=TUNING_PROFILES,
+                        help=hf('Block device queue and iSCSI session '
+                                'settings applied to every logged in device '
+                                'and its multipath device.  "default" only '
+                                'sets the noop (or none) scheduler'))
+    parser.add_argument('--tuning-out-file',
+                        help=hf('Write the tuning settings applied on each '
+                                'run-host while mounting to this file, eg. '
+                                'tuning-out.json.  Use "stdout" to print '
+                                'them to STDOUT'))
+    parser.add_argument('--sessions-per-portal', default=1, type=int,
+                        help=hf('Number of iSCSI sessions to open to each '
+                                'portal of a target.  Each session adds a '
+                                'path to the target\'s multipath device, '
+                                'requires multipath'))
+    parser.add_argument('--multipath-policy',
+                        help=hf('Multipath settings for Datera LUNs written '
+                                'to a dbmp owned multipath.conf.d file before '
+                                'login, eg: path_selector=queue-length,'
+                                'rr_min_io_rq=1,no_path_retry=queue.  '
+                                'path_selector is one of service-time, '
+                                'round-robin or queue-length'))
     parser.add_argument('--fio', action='store_true',
                         help='Run fio workload against mounted volumes')
     parser.add_argument('--fio-workload',
@@ -211,6 +465,25 @@ if __name__ == '__main__':
                         'Run metrics with specified report interval and '
                         'timeout in seconds --metrics 5,60 would get metrics '
                         'every 5 seconds for 60 seconds'))
+    parser.add_argument('--watch', action='store_true',
+                        help=hf('While --metrics runs show a refreshing table '
+                                'of the latest value of each metric per App '
+                                'Instance, worst latency first.  With --fio '
+                                'the workload runs alongside the collection '
+                                'for its timeout and its elapsed time is '
+                                'shown'))
+    parser.add_argument('--host-stats', action='store_true',
+                        help=hf('While --metrics runs also sample '
+                                '/proc/diskstats of the volumes\' devices '
+                                '(and their multipath paths) on the '
+                                '--run-host at the same interval and add '
+                                'host side iops, throughput, latency and '
+                                'queue depth as host_* metrics'))
+    parser.add_argument('--metrics-range', help=hf(
+                        'Fetch the historical metrics between START,END '
+                        'instead of polling live.  Each is epoch seconds, '
+                        '"now" or a duration before now, eg: -1h,now.  '
+                        'Fetched in parallel chunks using --workers threads'))
     parser.add_argument('--metrics-type',
                         metavar='',
                         action='append',
@@ -226,5 +499,56 @@ if __name__ == '__main__':
     parser.add_argument('--metrics-out-file', default='metrics-out.json',
                         help='Output file for metrics report.  Use "stdout" to'
                         ' print metrics to STDOUT')
+    parser.add_argument('--golden', action='store_true',
+                        help=hf('Create, format and mount only the first '
+                                'volume of --volume, snapshot it and create '
+                                'the rest as clones of that snapshot which '
+                                'are mounted without running mkfs'))
+    parser.add_argument('--golden-fill', action='store_true',
+                        help=hf('Fill the --golden source volume\'s '
+                                'filesystem with fio before snapshotting it'))
+    parser.add_argument('--qos-step',
+                        help=hf('Run the fio workload against the mounted '
+                                'volumes while stepping total_iops_max '
+                                'through a schedule and report each step\'s '
+                                'settle time, overshoot and steady state '
+                                'error.  Comma separated values and '
+                                'start-end/steps ramps, eg: '
+                                '1000,5000,500,1000-5000/4'))
+    parser.add_argument('--qos-step-hold', default=30, type=float,
+                        help='Seconds each --qos-step value is held')
+    parser.add_argument('--qos-step-interval', default=0.5, type=float,
+                        help='Seconds between --qos-step metrics samples')
+    parser.add_argument('--qos-step-band', default=10, type=float,
+                        help=hf('Percent band around the steady state IOPS '
+                                'a step has to stay within to be settled'))
+    parser.add_argument('--qos-step-out-file', default='qos-step-out.json',
+                        help=hf('Output file for the --qos-step samples and '
+                                'results.  Use "stdout" to print to STDOUT'))
+    parser.add_argument('--trace',
+                        help=hf('Record timed spans of every command, REST '
+                                'call and parallel task and write them to '
+                                'this file as a Chrome trace.  A per '
+                                'operation latency summary is printed at '
+                                'the end of the run'))
+    parser.add_argument('--no-rest-cache', action='store_true',
+                        help=hf('Send every REST read to the cluster instead '
+                                'of reusing responses already fetched during '
+                                'this run'))
+    parser.add_argument('--no-priv-helper', action='store_true',
+                        help=hf('Run every privileged command through its '
+                                'own sudo instead of the persistent '
+                                'privileged helper'))
     args = parser.parse_args()
-    sys.exit(main(args))
+    if args.trace:
+        from dbmp import tracing
+        tracing.enable()
+    try:
+        result = main(args)
+    finally:
+        if args.trace:
+            tracing.write(args.trace)
+            tracing.print_summary()
+        if scaffold.VERBOSE:
+            rest.print_counts()
+    sys.exit(result)
@@ -15,16 +15,145 @@ try:
 except NameError:
     unicode = str
 
+# Rates derived client side from the counter endpoint they're the rate of
+DERIVED = {'iops_read': 'reads', 'iops_write': 'writes',
+           'thpt_read': 'bytes_read', 'thpt_write': 'bytes_written'}
+# Historical series are fetched in chunks of this many seconds
+RANGE_CHUNK = 600
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
 
-def get_metrics(api, metrics, vols, interval, timeout, op):
+
+def get_metrics(api, metrics, vols, interval, timeout, op, watch=False,
+                fio=None, host_stats=None, multipath=True):
+    """
+    Polls `metrics` of the app_instances matching `vols` every `interval`
+    seconds until `timeout`.  With `host_stats` set to a list of run-hosts
+    the host_* stats of the volumes' devices on them are sampled alongside
+    """
     ais = []
     for vol in vols:
         ais.extend(ais_from_vols(api, vol))
     results = {ai.name: {metric: [] for metric in metrics} for ai in ais}
     args = [(api, results, ai, metrics, interval, timeout) for ai in ais]
     funcs = [_get_metric for _ in ais]
-    p = Parallel(funcs, args_list=args, max_workers=len(funcs))
-    p.run_threads()
+    shown = list(metrics)
+    if host_stats:
+        from dbmp import hoststats
+        hosts = hoststats.get_devices(
+            host_stats, hoststats.get_targets(ais), multipath)
+        for host, devices in sorted(hosts.items()):
+            for name in devices:
+                results[name].update((m, []) for m in hoststats.METRICS)
+            funcs.append(hoststats.collect)
+            args.append((host, results, devices, interval, timeout))
+        if hosts:
+            shown.extend(hoststats.METRICS)
+    dashboard = None
+    if watch:
+        from dbmp.watch import Dashboard
+        dashboard = Dashboard(results, shown, fio).start()
+    try:
+        p = Parallel(funcs, args_list=args, max_workers=len(funcs))
+        p.run_threads()
+    finally:
+        if dashboard:
+            dashboard.stop()
+    _apply_op(results, op)
+    return results
+
+
+def _parse_time(s, now):
+    s = s.strip()
+    if s == 'now':
+        return now
+    if s.startswith('-') and s[-1:] in UNITS:
+        return now - float(s[1:-1]) * UNITS[s[-1]]
+    return float(s)
+
+
+def parse_range(s):
+    """
+    Parses 'START,END' where each is epoch seconds, 'now' or a duration
+    before now like '-1h', '-30m' or '-90s'.  Returns epoch seconds
+    """
+    now = time.time()
+    try:
+        start, end = [_parse_time(t, now) for t in s.split(',')]
+    except ValueError:
+        raise EnvironmentError(
+            "--metrics-range must be in format START,END, eg: -1h,now or "
+            "1532722856,1532726456")
+    if start >= end:
+        raise EnvironmentError("--metrics-range START must be before END")
+    return start, end
+
+
+def _points(data):
+    points = []
+    for entry in data:
+        if 'points' in entry:
+            points.extend(entry['points'])
+        elif 'point' in entry:
+            points.append(entry['point'])
+    return points
+
+
+def _get_chunk(api, ai, ep, start, end, chunks):
+    dprint("Getting metric {} data from ai {} for {}-{}".format(
+        ep, ai.name, start, end))
+    data = getattr(api.metrics.io, ep).get(
+        uuid=ai.id, start_time=int(start * 1000), end_time=int(end * 1000))
+    chunks.append((ai.name, ep, _points(data)))
+
+
+def get_metrics_range(api, metrics, vols, start, end, workers, op):
+    """
+    Fetches the historical series of `metrics` between the epoch seconds
+    `start` and `end`, split in RANGE_CHUNK chunks per app_instance and
+    endpoint that are fetched in parallel.  Returns the same results as
+    get_metrics
+    """
+    ais = []
+    for vol in vols:
+        ais.extend(ais_from_vols(api, vol))
+    eps = get_endpoints(metrics)
+    funcs, args, chunks = [], [], []
+    for ai in ais:
+        for ep in eps:
+            t = start
+            while t < end:
+                funcs.append(_get_chunk)
+                args.append((api, ai, ep, t, min(t + RANGE_CHUNK, end),
+                             chunks))
+                t += RANGE_CHUNK
+    if funcs:
+        p = Parallel(funcs, args_list=args, max_workers=workers)
+        p.run_threads()
+    # Keyed by time to drop points repeated at chunk boundaries
+    series = {}
+    for name, ep, points in chunks:
+        by_time = series.setdefault((name, ep), {})
+        for point in points:
+            if start <= _seconds(point['time']) <= end:
+                by_time[point['time']] = point
+    results = {}
+    for ai in ais:
+        results[ai.name] = {}
+        for metric in metrics:
+            ep = DERIVED.get(metric, metric)
+            points = sorted(series.get((ai.name, ep), {}).values(),
+                            key=lambda x: x['time'])
+            if metric in DERIVED:
+                points = [r for r in (derive_rate(a, b) for a, b in
+                                      zip(points, points[1:])) if r]
+            results[ai.name][metric] = points
+    print("Fetched {} chunks of metrics for {} app_instances".format(
+        len(funcs), len(ais)))
+    _apply_op(results, op)
+    return results
+
+
+def _apply_op(results, op):
     if op == 'average':
         _do_average(results)
     elif op == 'max':
@@ -37,7 +166,6 @@ def get_metrics(api, metrics, vols, interval, timeout, op):
         _do_total_max(results)
     elif op == 'total-min':
         _do_total_min(results)
-    return results
 
 
 def write_metrics(data, outfile):
@@ -50,13 +178,64 @@ def write_metrics(data, outfile):
             f.write(unicode(json.dumps(data, indent=4)))
 
 
+def get_endpoints(metrics):
+    """ Returns the minimal list of metric endpoints needed for `metrics` """
+    eps = []
+    for metric in metrics:
+        ep = DERIVED.get(metric, metric)
+        if ep not in eps:
+            eps.append(ep)
+    return eps
+
+
+def _seconds(t):
+    # Point times are epoch seconds or milliseconds
+    return t / 1000 if t > 1e11 else t
+
+
+def derive_rate(prev, point):
+    """
+    Returns the per second rate point between two counter points, or None if
+    the counter wasn't updated in between.  A counter that went backwards
+    was reset, so its whole value is the increase since the reset
+    """
+    dt = _seconds(point['time']) - _seconds(prev['time'])
+    if dt <= 0:
+        return None
+    delta = point['value'] - prev['value']
+    if delta < 0:
+        delta = point['value']
+    return {'time': point['time'], 'value': delta / dt}
+
+
+def _poll(ai, eps):
+    points = {}
+    for ep, name in eps:
+        dprint("Getting metric {} data from ai {}".format(name, ai.name))
+        points[name] = ep.latest.get(uuid=ai.id)[0]['point']
+    return points
+
+
 def _get_metric(api, results, ai, metrics, interval, timeout):
-    eps = [(getattr(api.metrics.io, metric), metric) for metric in metrics]
+    eps = [(getattr(api.metrics.io, ep), ep) for ep in get_endpoints(metrics)]
+    dprint("Polling {} endpoints for metrics {}".format(
+        len(eps), ", ".join(metrics)))
+    last = {}
+    if any(metric in DERIVED for metric in metrics):
+        # Rates need a counter point to start from
+        last = _poll(ai, eps)
+        time.sleep(interval)
     while timeout > 0:
-        for ep, metric in eps:
-            dprint("Getting metric {} data from ai {}".format(metric, ai.name))
-            data = ep.latest.get(uuid=ai.id)[0]['point']
-            results[ai.name][metric].append(data)
+        points = _poll(ai, eps)
+        for metric in metrics:
+            if metric not in DERIVED:
+                results[ai.name][metric].append(points[metric])
+                continue
+            counter = DERIVED[metric]
+            rate = derive_rate(last[counter], points[counter])
+            if rate is not None:
+                results[ai.name][metric].append(rate)
+        last = points
         time.sleep(interval)
         timeout -= interval
 
@@ -93,7 +272,8 @@ def _func_helper(results, func):
     for name, v1 in results.items():
         for m, v2 in v1.items():
             v = [elem['value'] for elem in v2]
-            results[name][m] = func(v)
+            # A derived rate has no points if its counter never moved
+            results[name][m] = func(v) if v else None
 
 
 def _total_helper(results, func):
@@ -105,7 +285,7 @@ def _total_helper(results, func):
                 newr[name] = []
             newr[name].extend([elem['value'] for elem in v2])
     for k, v in newr.items():
-        newr[k] = func(v)
+        newr[k] = func(v) if v else None
     for k in results.keys():
         del results[k]
     results.update(newr)
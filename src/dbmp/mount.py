@@ -1,27 +1,46 @@
 from __future__ import unicode_literals, print_function, division
 
 import glob
+import json
 import os
+import shlex
+import threading
 import time
 
 from dfs_sdk import exceptions as dat_exceptions
 
-from dbmp.volume import ais_from_vols, parse_vol_opt
-from dbmp.utils import Parallel, exe, check_install, exe_remote_py
+from dbmp import multipath as mpath, rest, tracing, tuning
+from dbmp.volume import ais_from_vols, get_spec, clean_volume
+from dbmp.bundle import check_install
+from dbmp.utils import Parallel, run, remote_call, get_agent, agent_enabled
 from dbmp.utils import get_hostname, dprint, locker
 
 DEV_TEMPLATE = "/dev/disk/by-path/ip-{ip}:3260-iscsi-{iqn}-lun-{lun}"
+SESSIONS = "/sys/class/iscsi_session"
+SESSION_TIMEOUT = 30
+# Prefix of the line remote/mount.py prints its result on
+MOUNT_RESULT = 'dbmp-mount-result: '
+REGEX_SPECIAL = frozenset('\\.^$*+?{}[]|()')
+_INITIATORS = {}
 
 
 def mount_volumes_remote(host, vols, multipath, fs, fsargs, directory,
-                         workers, login_only):
+                         workers, login_only, preformatted=None,
+                         profile='default', sessions=1, mp_policy=None):
     check_install(host)
     m = '--multipath' if multipath else ''
     vs = ','.join([v.name for v in vols])
     fa = '"{}"'.format(fsargs)
     lo = '--login-only' if login_only else ''
-    exe_remote_py(
-        host,
+    pf = ('--preformatted {}'.format(','.join(preformatted))
+          if preformatted else '')
+    mp = '--multipath-policy {}'.format(mp_policy) if mp_policy else ''
+    result = remote_call(
+        host, 'mount',
+        {'vols': [v.name for v in vols], 'multipath': multipath, 'fs': fs,
+         'fsargs': fsargs, 'directory': directory, 'workers': workers,
+         'login_only': login_only, 'preformatted': preformatted,
+         'profile': profile, 'sessions': sessions, 'mp_policy': mp_policy},
         'mount.py '
         '--vols {} '
         '{} '
@@ -29,62 +48,164 @@ def mount_volumes_remote(host, vols, multipath, fs, fsargs, directory,
         '--fsargs {} '
         '--directory {} '
         '--workers {} '
-        '{}'.format(vs, m, fs, fa, directory, workers, lo))
+        '--tuning-profile {} '
+        '--sessions-per-portal {} '
+        '{} {} {}'.format(vs, m, fs, fa, directory, workers, profile,
+                          sessions, lo, pf, mp))
+    if not agent_enabled():
+        result = _parse_mount_output(host, result)
+    # fio is generated from the same list whichever way it came back
+    if not isinstance(result, list):
+        raise EnvironmentError(
+            "Remote mount on {} returned {} instead of a list of devices or "
+            "folders".format(host, type(result).__name__))
+    return result
+
+
+def _parse_mount_output(host, out):
+    """
+    Returns the device/folder list remote/mount.py printed, its other output
+    is shown the same way as the agent's progress
+    """
+    result = None
+    for line in out.splitlines():
+        if line.startswith(MOUNT_RESULT):
+            result = json.loads(line[len(MOUNT_RESULT):])
+        else:
+            print("[{}]".format(host), line)
+    if result is None:
+        raise EnvironmentError(
+            "Remote mount on {} printed no result".format(host))
+    return result
 
 
 def clean_mounts_remote(host, vols, directory, workers):
     check_install(host)
-    exe_remote_py(
-        host,
+    remote_call(
+        host, 'clean',
+        {'vols': vols, 'directory': directory, 'workers': workers},
         'clean_mount.py '
         '--vols {} '
         '--directory {} '
         '--workers {}'.format(vols, directory, workers))
 
 
+def list_mounts_remote(host, vopt, detail, multipath):
+    check_install(host)
+    get_agent(host).call(
+        'list', vols=vopt, detail=detail, multipath=multipath)
+
+
 def clean_mounts(api, vols, directory, workers):
-    ais = ais_from_vols(api, vols)
-    funcs, args = [], []
+    teardown(api, [vols], directory, workers, False)
+
+
+def teardown(api, vopts, directory, workers, delete):
+    start = time.time()
+    timings = []
+    ais = {}
+    for vopt in vopts:
+        for ai in ais_from_vols(api, vopt):
+            ais[ai.name] = ai
+    ais = sorted(ais.values(), key=lambda x: x.name)
+    if not ais:
+        return
+
+    # Gather storage_instances and volumes for every app_instance up front
+    # so unmount and logout don't have to refetch them
+    targets = {}
+    _run_parallel(_gather_targets, [(ai, targets) for ai in ais], workers)
+    iqns = set(t[1] for ai in ais for t in targets[ai.name])
+    # Only the maps of these targets are flushed once they're logged out
+    maps = _get_maps(iqns)
+    timings.append(('gather', time.time() - start))
+
+    # Unmount every volume in parallel before any logout begins
+    tstart = time.time()
+    args = []
     for ai in ais:
-        for si in ai.storage_instances.list():
-            iqn = si.access.get('iqn')
-            dprint("Cleaning {},{} portals {}, iqn {}".format(
-                ai.name, si.name, si.access['ips'], si.access.get('iqn')))
-            if not iqn:
-                dprint("{},{} did not have an iqn field".format(
-                    ai.name, si.name))
-                continue
-            portals = si.access['ips']
-            for vol in si.volumes.list():
-                _unmount(ai.name, si.name, vol.name, directory)
-            funcs.append(_logout)
-            args.append((iqn, portals))
-    if funcs:
-        p = Parallel(funcs, args_list=args)
+        for si_name, _, _, vol_names in targets[ai.name]:
+            for vol_name in vol_names:
+                args.append((ai.name, si_name, vol_name, directory))
+    _run_parallel(_unmount, args, workers)
+    timings.append(('unmount', time.time() - tstart))
+
+    # Logout all sessions for an app_instance in a single batch, then hand
+    # it straight to offline/delete without waiting for the others
+    tstart = time.time()
+    _run_parallel(_teardown_ai,
+                  [(ai, targets[ai.name], delete) for ai in ais], workers)
+    timings.append(('logout/delete' if delete else 'logout',
+                    time.time() - tstart))
+
+    tstart = time.time()
+    _logout_sessions(iqns)
+    _logout_flush(maps, workers)
+    timings.append(('flush', time.time() - tstart))
+    print("Teardown of {} app_instances completed in {:.2f}s ({})".format(
+        len(ais), time.time() - start,
+        ", ".join("{} {:.2f}s".format(n, t) for n, t in timings)))
+
+
+def _run_parallel(func, args, workers):
+    if args:
+        p = Parallel([func] * len(args), args_list=args, max_workers=workers)
         p.run_threads()
 
 
+def _gather_targets(ai, targets):
+    result = []
+    for si in ai.storage_instances.list():
+        iqn = si.access.get('iqn')
+        dprint("Cleaning {},{} portals {}, iqn {}".format(
+            ai.name, si.name, si.access['ips'], iqn))
+        if not iqn:
+            dprint("{},{} did not have an iqn field".format(
+                ai.name, si.name))
+            continue
+        result.append((si.name, iqn, si.access['ips'],
+                       [vol.name for vol in si.volumes.list()]))
+    targets[ai.name] = result
+
+
+def _teardown_ai(ai, ai_targets, delete):
+    for _, iqn, portals, _ in ai_targets:
+        for argv in _logout_cmds(iqn, portals):
+            run(argv, sudo=True)
+    if delete:
+        clean_volume(ai)
+
+
 def _unmount(ai_name, si_name, vol_name, directory):
     folder = get_dirname(directory, ai_name, si_name, vol_name)
-    try:
-        exe("sudo umount {}".format(folder))
-    except EnvironmentError as e:
-        dprint(e)
+    if run(['umount', folder], sudo=True).rc:
         return
-    exe("sudo rmdir {}".format(folder))
+    run(['rmdir', folder], sudo=True, check=True)
 
 
 def mount_volumes(api, vols, multipath, fs, fsargs, directory, workers,
-                  login_only):
+                  login_only, preformatted=None, profile='default',
+                  sessions=1, mp_policy=None):
+    """
+    Logs in (and unless `login_only` formats and mounts) every app_instance
+    of `vols`.  App_instances named in `preformatted` already carry a
+    filesystem and are mounted without mkfs
+    """
     funcs, args = [], []
     results = []
+    waiter = SiWaiter(api)
+    tuning.reset()
+    if multipath and mp_policy:
+        mpath.configure(mp_policy)
     for ai in vols:
         funcs.append(_mount_volume)
-        args.append((api, ai, multipath, fs, fsargs, directory, login_only,
+        args.append((api, waiter, ai, multipath, fs, fsargs, directory,
+                     login_only, preformatted or (), profile, sessions,
                      results))
     if funcs:
         p = Parallel(funcs, args_list=args, max_workers=workers)
         p.run_threads()
+    tuning.print_summary(profile)
     return results
 
 
@@ -92,74 +213,239 @@ def get_dirname(directory, ai_name, si_name, vol_name):
     return os.path.join(directory, "-".join((ai_name, si_name, vol_name)))
 
 
-def _mount_volume(api, ai, multipath, fs, fsargs, directory, login_only,
-                  results):
-    _setup_acl(api, ai)
+def _mount_volume(api, waiter, ai, multipath, fs, fsargs, directory,
+                  login_only, preformatted, profile, sessions, results):
+    sis = ai.storage_instances.list()
+    _setup_acl(api, ai, sis)
     ai.set(admin_state='online')
-    for si in ai.storage_instances.list():
-        _si_poll(si)
-        si = si.reload()
-        ac = si.access
+    for si in sis:
+        ac = waiter.wait(ai.name, si)['access']
         for i, vol in enumerate(si.volumes.list()):
-            path = _login(ac['iqn'], ac['ips'], multipath, i)
+            path = _login(ac['iqn'], ac['ips'], multipath, i, profile,
+                          sessions)
             if login_only:
                 results.append(path)
             print("Volume device path:", path)
             if not login_only:
                 folder = get_dirname(directory, ai.name, si.name, vol.name)
                 results.append(folder)
-                _format_mount_device(path, fs, fsargs, folder)
+                _format_mount_device(path, fs, fsargs, folder,
+                                     ai.name in preformatted)
+
+
+def _mkfs_cmd(path, fs, fsargs):
+    return ['mkfs.{}'.format(fs)] + shlex.split(fsargs) + [path]
+
+
+def _blkid_cmd(path):
+    return ['blkid', '-o', 'value', '-s', 'TYPE', path]
+
 
+def _formatted(path, fs, mkfs, found_fs, timeout):
+    """
+    Returns True once `path` holds an `fs` filesystem, either made by `mkfs`
+    or already there (`found_fs`, blkid's TYPE after a failed mkfs), False
+    to retry and raises when no `timeout` is left
+    """
+    if not mkfs.rc:
+        return True
+    if found_fs.lower() == fs.lower():
+        dprint("Found existing filesystem, continuing")
+        return True
+    dprint("Failed to format {}. Waiting for device to be "
+           "ready".format(path))
+    if not timeout:
+        raise EnvironmentError("Failed to format {}: {}".format(
+            path, mkfs.stderr.strip()))
+    return False
 
-def _format_mount_device(path, fs, fsargs, folder):
+
+def _uuid_cmd(path, fs):
+    """ The command giving a copied filesystem a new UUID, if fs has one """
+    fs = fs.lower()
+    if fs == 'xfs':
+        return ['xfs_admin', '-U', 'generate', path]
+    if fs.startswith('ext'):
+        return ['tune2fs', '-U', 'random', path]
+    return None
+
+
+def _uuid_mount_opts(path, fs, result):
+    """ Returns the mount options needed after the _uuid_cmd `result` """
+    if not result.rc:
+        return []
+    dprint("Could not change filesystem UUID of {}: {}".format(
+        path, result.stderr.strip()))
+    # XFS refuses to mount a second filesystem with the same UUID
+    return ['-o', 'nouuid'] if fs.lower() == 'xfs' else []
+
+
+def _mount_cmds(path, folder, opts):
+    return (['mkdir', '-p', '/' + folder.strip('/')],
+            ['mount'] + opts + [path, folder])
+
+
+def _format_mount_device(path, fs, fsargs, folder, preformatted=False):
     timeout = 5
-    while True:
-        try:
-            exe("sudo mkfs.{} {} {} ".format(fs, fsargs, path))
-            break
-        except EnvironmentError:
+    while not preformatted:
+        mkfs = run(_mkfs_cmd(path, fs, fsargs), sudo=True)
+        found_fs = ''
+        if mkfs.rc:
             dprint("Checking for existing filesystem on:", path)
-            try:
-                out = exe(
-                    "sudo blkid {} | grep -Eo '(TYPE=\".*\")'".format(
-                        path))
-                parts = out.split("=")
-                if len(parts) == 2:
-                    found_fs = parts[-1].lower().strip().strip('"')
-                    if found_fs == fs.lower():
-                        dprint("Found existing filesystem, continuing")
-                        break
-            except EnvironmentError:
-                pass
-            dprint("Failed to format {}. Waiting for device to be "
-                   "ready".format(path))
-            if not timeout:
-                raise
-            time.sleep(1)
-            timeout -= 1
-    exe("sudo mkdir -p /{}".format(folder.strip("/")))
-    exe("sudo mount {} {}".format(path, folder))
+            found_fs = run(_blkid_cmd(path), sudo=True).stdout.strip()
+        if _formatted(path, fs, mkfs, found_fs, timeout):
+            break
+        time.sleep(1)
+        timeout -= 1
+    opts = []
+    # Clones share their source's filesystem UUID
+    uuid = _uuid_cmd(path, fs) if preformatted else None
+    if uuid:
+        opts = _uuid_mount_opts(path, fs, run(uuid, sudo=True))
+    for argv in _mount_cmds(path, folder, opts):
+        run(argv, sudo=True, check=True)
     print("Volume mount:", folder)
 
 
-def _si_poll(si):
-    timeout = 10
-    while True:
-        si = si.reload()
-        if si.op_state == 'available':
-            break
-        if not timeout:
+class SiWaiter(object):
+
+    """
+    Shared readiness tracker for storage_instances that mount workers are
+    waiting on.  Rather than each worker reloading its own storage_instance
+    every second, a single poller thread checks op_state for every pending
+    storage_instance with one app_instances list call per tick and wakes
+    each worker as soon as its storage_instance becomes available.  The
+    tick interval backs off while nothing changes and resets whenever a
+    storage_instance becomes ready.
+    """
+
+    def __init__(self, api, min_interval=0.5, max_interval=5, timeout=300):
+        """
+
+        :param api: Datera api object used for the list calls
+        :param min_interval: Starting (and reset) tick interval in seconds
+        :param max_interval: Maximum tick interval in seconds
+        :param timeout: Maximum time a single worker will wait
+        """
+        self.api = api
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.poller = None
+
+    def watch(self, ai_name, si, callback):
+        """
+        Registers `callback` to be called from the poller thread with the
+        freshly fetched storage_instance data once `si` of app_instance
+        `ai_name` is available
+        """
+        with self.lock:
+            self.pending.setdefault(ai_name, {}).setdefault(
+                si.path, []).append(callback)
+            if self.poller is None:
+                self.poller = threading.Thread(target=self._poll)
+                self.poller.setDaemon(True)
+                self.poller.start()
+
+    def unwatch(self, ai_name, si, callback):
+        with self.lock:
+            sis = self.pending.get(ai_name, {})
+            callbacks = sis.get(si.path, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                sis.pop(si.path, None)
+            if not sis:
+                self.pending.pop(ai_name, None)
+
+    def wait(self, ai_name, si):
+        """
+        Blocks until `si` is available and returns its freshly fetched
+        storage_instance data
+        """
+        result = {}
+        event = threading.Event()
+
+        def _ready(data):
+            result['data'] = data
+            event.set()
+
+        self.watch(ai_name, si, _ready)
+        with tracing.span('wait:si', si=si.path):
+            ready = event.wait(self.timeout)
+        if not ready:
+            self.unwatch(ai_name, si, _ready)
             raise EnvironmentError(
-                "Polling ended before storage_instance {} was still "
-                "unavailable".format(si.path))
-        time.sleep(1)
-        timeout -= 1
+                "Polling ended before storage_instance {} became "
+                "available".format(si.path))
+        return result['data']
+
+    def _poll(self):
+        interval = self.min_interval
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.poller = None
+                    return
+                # Pending entries are keyed by name since storage_instance
+                # paths carry the app_instance id, not its name
+                ai_names = list(self.pending)
+            try:
+                states = self._fetch(ai_names)
+            except Exception as e:
+                dprint("Error polling storage_instances:", e)
+                states = {}
+            ready = []
+            with self.lock:
+                for ai_name, sis in list(self.pending.items()):
+                    for path in list(sis):
+                        data = states.get(path)
+                        if data and data.get('op_state') == 'available':
+                            ready.append((sis.pop(path), data))
+                    if not sis:
+                        del self.pending[ai_name]
+            for callbacks, data in ready:
+                for callback in callbacks:
+                    callback(data)
+            if ready:
+                interval = self.min_interval
+            else:
+                interval = min(interval * 1.5, self.max_interval)
+            dprint("{} storage_instances ready, {} pending, next poll in "
+                   "{:.1f}s".format(len(ready), sum(
+                       len(sis) for sis in self.pending.values()), interval))
+            time.sleep(interval)
+
+    def _fetch(self, ai_names):
+        # Narrow the list call to the longest common name prefix of the
+        # pending app_instances, typically the --volume prefix
+        prefix = _escape(os.path.commonprefix(ai_names))
+        # op_state is changed by the cluster, never serve it from cache
+        with rest.uncached():
+            if prefix:
+                ais = self.api.app_instances.list(
+                    filter='match(name,{}.*)'.format(prefix))
+            else:
+                ais = self.api.app_instances.list()
+        states = {}
+        for ai in ais:
+            for si in ai.get('storage_instances', []):
+                states[si['path']] = si
+        return states
+
+
+def _escape(s):
+    # Only the regex metacharacters, unlike py2's re.escape which escapes
+    # '_' and '-' too
+    return ''.join('\\' + c if c in REGEX_SPECIAL else c for c in s)
 
 
 def _get_initiator():
     file_path = '/etc/iscsi/initiatorname.iscsi'
     try:
-        out = exe('sudo cat {}'.format(file_path))
+        out = run(['cat', file_path], sudo=True, check=True).stdout
         for line in out.splitlines():
             if line.startswith('InitiatorName='):
                 return line.split("=", 1)[-1].strip()
@@ -168,28 +454,58 @@ def _get_initiator():
         raise
 
 
-@locker
 def _setup_initiator(api):
+    # Lock-free fast path once the initiator has been resolved for this
+    # process/tenant, only the first caller pays for the lookup
+    initiator_obj = _INITIATORS.get(_tenant(api))
+    if initiator_obj is None:
+        initiator_obj = _resolve_initiator(api)
+    return initiator_obj
+
+
+@locker
+def _resolve_initiator(api):
+    tenant = _tenant(api)
+    if tenant in _INITIATORS:
+        return _INITIATORS[tenant]
     initiator = _get_initiator()
-    host = exe('hostname').strip()
+    host = get_hostname('local')
     initiator_obj = None
     try:
         initiator_obj = api.initiators.get(initiator)
         # Handle case where initiator exists in parent tenant
         # We want to create a new initiator in the case
-        tenant = api.context.tenant
-        if not tenant:
-            tenant = '/root'
         if initiator_obj.tenant != tenant:
             raise dat_exceptions.ApiNotFoundError()
     except dat_exceptions.ApiNotFoundError:
         initiator_obj = api.initiators.create(name=host, id=initiator)
+    _INITIATORS[tenant] = initiator_obj
     return initiator_obj
 
 
-def _setup_acl(api, ai):
+def _tenant(api):
+    tenant = api.context.tenant
+    if not tenant:
+        tenant = '/root'
+    return tenant
+
+
+def _acl_initiators(si):
+    policy = si.get('acl_policy') or {}
+    paths = set()
+    for init in policy.get('initiators', []):
+        paths.add(init.get('path') if hasattr(init, 'get') else init)
+    return paths
+
+
+def _setup_acl(api, ai, sis):
     initiator = _setup_initiator(api)
-    for si in ai.storage_instances.list():
+    for si in sis:
+        # Skip the PUT entirely if the storage_instance we already fetched
+        # has this initiator in its ACL
+        if initiator.path in _acl_initiators(si):
+            dprint("ACL already registered for {},{}".format(ai.name, si.name))
+            continue
         try:
             si.acl_policy.initiators.add(initiator.path)
         except dat_exceptions.ApiConflictError:
@@ -229,75 +545,253 @@ def _get_multipath_disk(path):
             path, device_path))
 
 
-def _set_noop_scheduler(portals, iqn, lun):
+def _get_sessions():
+    """ Returns {session id: (target iqn, session sysfs device dir)} """
+    sessions = {}
+    for path in glob.glob(os.path.join(SESSIONS, 'session*')):
+        try:
+            with open(os.path.join(path, 'targetname')) as f:
+                iqn = f.read().strip()
+        except (IOError, OSError):
+            continue
+        # .../hostN/sessionM/iscsi_session/sessionM -> .../hostN/sessionM
+        sessions[os.path.basename(path)[len('session'):]] = (
+            iqn, os.path.dirname(os.path.dirname(os.path.realpath(path))))
+    return sessions
+
+
+def _session_devices(iqn, lun):
+    devices = set()
+    for target, path in _get_sessions().values():
+        if target != iqn:
+            continue
+        for dev in glob.glob(os.path.join(
+                path, 'target*', '*:*:*:{}'.format(lun), 'block', '*')):
+            devices.add(os.path.basename(dev))
+    return sorted(devices)
+
+
+def _portal_device(portal, iqn, lun):
+    """ Returns the device name behind `portal`'s by-path link, if any yet """
+    path = DEV_TEMPLATE.format(ip=portal, iqn=iqn, lun=lun)
+    if os.path.exists(path):
+        return os.path.basename(os.path.realpath(path))
+    dprint("Waiting for device to be ready:", path)
+    return None
+
+
+def _sessions_ready(iqn, lun, expected, remaining):
+    """
+    Returns the session devices of `iqn` `lun` once `expected` of them are
+    there or no wait time is `remaining`, None while still waiting
+    """
+    found = _session_devices(iqn, lun)
+    if len(found) >= expected:
+        return found
+    if remaining <= 0:
+        print("Only found {} of {} session devices for {} lun {}".format(
+            len(found), expected, iqn, lun))
+        return found
+    dprint("Waiting for session devices: {}/{}".format(len(found), expected))
+    return None
+
+
+def _wait_devices(portals, iqn, lun, sessions=1):
+    devices = []
     for portal in portals:
         path = DEV_TEMPLATE.format(ip=portal, iqn=iqn, lun=lun)
-        device = None
-        while True:
-            out = exe("ls -l {} | awk '{{print $NF}}'".format(path))
-            device = out.split("/")[-1].strip()
-            if device:
-                break
-            dprint("Waiting for device to be ready:", path)
+        with tracing.span('wait:device', path=path, portal=portal):
+            device = _portal_device(portal, iqn, lun)
+            while not device:
+                time.sleep(1)
+                device = _portal_device(portal, iqn, lun)
+        devices.append(device)
+    if sessions == 1:
+        return devices
+    # The by-path links only point at one session's device per portal
+    timeout = SESSION_TIMEOUT
+    with tracing.span('wait:sessions', iqn=iqn, lun=lun):
+        found = _sessions_ready(iqn, lun, len(portals) * sessions, timeout)
+        while found is None:
             time.sleep(1)
-        dprint("Setting noop scheduler for device:", device)
-        exe("echo 'noop' | sudo tee /sys/block/{}/queue/scheduler".format(
-            device))
+            timeout -= 1
+            found = _sessions_ready(iqn, lun, len(portals) * sessions,
+                                    timeout)
+    return sorted(set(devices) | set(found))
 
 
-def _login(iqn, portals, multipath, lun):
-    retries = 10
+def volume_devices(iqn, portals, lun, multipath):
+    """
+    Returns the device I/O to the volume at `lun` goes through (the dm
+    device holding its paths with multipath) and its path devices
+    """
+    paths = set(_session_devices(iqn, lun))
+    for portal in portals:
+        path = DEV_TEMPLATE.format(ip=portal, iqn=iqn, lun=lun)
+        if os.path.exists(path):
+            paths.add(os.path.basename(os.path.realpath(path)))
+    if not paths:
+        return None, []
+    paths = sorted(paths)
+    if multipath:
+        for dev in paths:
+            holders = glob.glob(os.path.join(
+                tuning.SYS_BLOCK, dev, 'holders', 'dm-*'))
+            if holders:
+                return os.path.basename(holders[0]), paths
+    return paths[0], paths
+
+
+def device_map(targets, multipath):
+    """
+    Returns {ai name: [[device, [path devices]]]} for `targets`, a list of
+    (ai name, iqn, portals, lun), skipping volumes not logged in
+    """
+    devices = {}
+    for name, iqn, portals, lun in targets:
+        device, paths = volume_devices(iqn, portals, lun, multipath)
+        if device:
+            devices.setdefault(name, []).append([device, paths])
+    return devices
+
+
+def _discovery_cmd(portal):
+    return ['iscsiadm', '-m', 'discovery', '-t', 'st',
+            '-p', '{}:3260'.format(portal)]
+
+
+def _login_cmd(iqn, portal):
+    return ['iscsiadm', '-m', 'node', '-T', iqn,
+            '-p', '{}:3260'.format(portal), '--login']
+
+
+def _login_portal(iqn, portal, profile, sessions):
+    """
+    Makes one discovery and login attempt on `portal`, returns the
+    CmdResult of the failed step or of the login
+    """
+    result = run(_discovery_cmd(portal), sudo=True)
+    if result.rc:
+        return result
+    tuning.set_session(iqn, portal, profile)
+    _set_nr_sessions(iqn, portal, sessions)
+    return run(_login_cmd(iqn, portal), sudo=True)
+
+
+def _login_done(portal, result, retries):
+    # 15 is ISCSI_ERR_SESS_EXISTS, already logged in
+    if result.rc in (0, 15):
+        return True
+    if not retries:
+        raise EnvironmentError(
+            "Could not log into portal {} before end of polling period: "
+            "{}".format(portal, result.stderr.strip()))
+    dprint("Failed to login to portal, retrying")
+    return False
+
+
+def _device_path(iqn, portals, multipath, lun):
+    path = DEV_TEMPLATE.format(ip=portals[0], iqn=iqn, lun=lun)
+    return _get_multipath_disk(path) if multipath else path
+
+
+def _login_path(iqn, portals, multipath, lun, devices, profile):
+    """ Returns the device path of a logged in volume and tunes it """
+    dpath = _device_path(iqn, portals, multipath, lun)
+    # After the multipath sleep so the dm device holding the paths is tuned
+    tuning.tune_devices(devices, profile)
+    return dpath
+
+
+def _login(iqn, portals, multipath, lun, profile='default', sessions=1):
     if not multipath:
         portals = [portals[0]]
     if lun == 0:
         for portal in portals:
-            while True:
-                dprint("Trying to log into target:", portal)
-                try:
-                    exe("sudo iscsiadm -m discovery -t st -p {}:3260".format(
-                        portal))
-                    exe("sudo iscsiadm -m node -T {iqn} -p {ip}:3260 "
-                        "--login".format(iqn=iqn, ip=portal))
-                    break
-                except EnvironmentError as e:
-                    if 'returned non-zero exit status 15' in str(e):
-                        break
+            retries = 10
+            with tracing.span('login', portal=portal, iqn=iqn):
+                while True:
+                    dprint("Trying to log into target:", portal)
                     retries -= 1
-                    if not retries:
-                        dprint("Could not log into portal before end of "
-                               "polling period")
-                        raise
-                    dprint("Failed to login to portal, retrying")
+                    result = _login_portal(iqn, portal, profile, sessions)
+                    if _login_done(portal, result, retries):
+                        break
                     time.sleep(2)
-    _set_noop_scheduler(portals, iqn, lun)
-    path = DEV_TEMPLATE.format(ip=portals[0], iqn=iqn, lun=lun)
+    devices = _wait_devices(portals, iqn, lun, sessions)
     if multipath:
         dprint('Sleeping to allow for multipath devices to finish linking')
         time.sleep(2)
-        dpath = _get_multipath_disk(path)
-    else:
-        dpath = path
-    return dpath
+    return _login_path(iqn, portals, multipath, lun, devices, profile)
 
 
-def _logout(iqn, portals):
+def _logout_cmds(iqn, portals):
+    cmds = []
     for portal in portals:
-        exe("sudo iscsiadm -m node -T {iqn} -p {ip}:3260 --logout".format(
-            iqn=iqn, ip=portal), fail_ok=True)
-        exe("sudo iscsiadm -m node -T {iqn} -p {ip}:3260 --op delete".format(
-            iqn=iqn, ip=portal), fail_ok=True)
-        exe("sudo iscsiadm -m discoverydb -p {ip}:3260 --op delete".format(
-            ip=portal),
-            fail_ok=True)
-    exe("sudo iscsiadm -m session --rescan", fail_ok=True)
-    exe("sudo multipath -F", fail_ok=True)
+        ip = '{}:3260'.format(portal)
+        cmds.append(['iscsiadm', '-m', 'node', '-T', iqn, '-p', ip,
+                     '--logout'])
+        cmds.append(['iscsiadm', '-m', 'node', '-T', iqn, '-p', ip,
+                     '--op', 'delete'])
+        cmds.append(['iscsiadm', '-m', 'discoverydb', '-p', ip,
+                     '--op', 'delete'])
+    return cmds
+
+
+def _nr_sessions_cmd(iqn, portal, sessions):
+    if sessions > 1:
+        return ['iscsiadm', '-m', 'node', '-T', iqn,
+                '-p', '{}:3260'.format(portal), '-o', 'update',
+                '-n', 'node.session.nr_sessions', '-v', str(sessions)]
+    return None
+
+
+def _set_nr_sessions(iqn, portal, sessions):
+    argv = _nr_sessions_cmd(iqn, portal, sessions)
+    if argv:
+        run(argv, sudo=True, check=True)
+
+
+def _logout_sessions(iqns):
+    # Node logout covers every session of the node record, any session of
+    # these targets still left (eg one whose record was already deleted) is
+    # logged out by id
+    for sid, (iqn, _) in sorted(_get_sessions().items()):
+        if iqn in iqns:
+            dprint("Logging out remaining session {} of {}".format(sid, iqn))
+            run(['iscsiadm', '-m', 'session', '-r', sid, '--logout'],
+                sudo=True)
+
+
+def _get_maps(iqns):
+    """ Returns the names of the multipath maps holding devices of `iqns` """
+    maps = set()
+    for iqn, path in _get_sessions().values():
+        if iqn not in iqns:
+            continue
+        for holder in glob.glob(os.path.join(
+                path, 'target*', '*:*:*:*', 'block', '*', 'holders', '*')):
+            try:
+                with open(os.path.join(holder, 'dm', 'name')) as f:
+                    maps.add(f.read().strip())
+            except (IOError, OSError):
+                continue
+    return sorted(maps)
+
+
+def _logout_flush(maps, workers):
+    run(['iscsiadm', '-m', 'session', '--rescan'], sudo=True)
+    # Flush only the maps of the torn down targets, not the host's others
+    _run_parallel(mpath.flush_map, [(m,) for m in maps], workers)
+    if not any(iqn.startswith(mpath.DATERA_IQN)
+               for iqn, _ in _get_sessions().values()):
+        mpath.unconfigure()
     dprint("Sleeping to wait for logout")
     time.sleep(2)
     dprint("Logout complete")
 
 
 def list_mounts(host, api, vopt, detail, multipath):
-    opts = parse_vol_opt(vopt)
+    spec = get_spec(vopt)
     hostname = get_hostname(host)
     if detail:
         print("\nMOUNTS-DETAIL")
@@ -306,9 +800,7 @@ def list_mounts(host, api, vopt, detail, multipath):
         print("\nMOUNTS")
         print("------")
     for ai in sorted(api.app_instances.list(), key=lambda x: x.name):
-        if (opts.get('prefix') == 'all' or
-                opts.get('name') == ai.name or
-                ai.name.startswith(opts.get('prefix', hostname))):
+        if spec.matches(ai.name, hostname):
             for si in ai.storage_instances.list():
                 for i, vol in enumerate(si.volumes.list()):
                     mount, path, device = _find_mount(ai, si, i, multipath)
@@ -326,10 +818,14 @@ def _find_mount(ai, si, lun, multipath):
     path = DEV_TEMPLATE.format(ip=ip, iqn=iqn, lun=lun)
     if multipath:
         path = _get_multipath_disk(path)
-    out = exe("ls -l {} | awk '{{print $NF}}'".format(path))
-    device = out.split("/")[-1].strip()
-    if not device:
-        return None, path, device
-    mount = exe("cat /proc/mounts | grep {} | awk '{{print $2}}'".format(
-        device))
-    return mount.strip(), path, device
+    if not path or not os.path.exists(path):
+        return None, path, ''
+    device = os.path.basename(os.path.realpath(path))
+    mounts = []
+    with open('/proc/mounts') as f:
+        for line in f:
+            fields = line.split()
+            if (len(fields) > 1 and os.path.basename(
+                    os.path.realpath(fields[0])) == device):
+                mounts.append(fields[1])
+    return "\n".join(mounts), path, device
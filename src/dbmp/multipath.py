@@ -0,0 +1,102 @@
+"""
+Multipath configuration for the Datera LUNs dbmp logs in.
+
+With --multipath-policy a device section for Datera LUNs is written to CONF
+and multipathd is reconfigured once, before the logins of a mount batch, so
+every map created for them uses the given path selector and queueing
+settings instead of whatever the host's multipath.conf has.  Maps of other
+vendors are untouched.  The file is removed again by the teardown that logs
+out the host's last Datera session.
+"""
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import io
+import os
+
+from dbmp.utils import dprint, run
+
+CONF_DIR = '/etc/multipath/conf.d'
+CONF = os.path.join(CONF_DIR, 'dbmp.conf')
+DATERA_IQN = 'iqn.2013-05.com.daterainc'
+SELECTORS = {'service-time': 'service-time 0',
+             'round-robin': 'round-robin 0',
+             'queue-length': 'queue-length 0'}
+KEYS = ('path_selector', 'rr_min_io_rq', 'no_path_retry')
+TEMPLATE = """# Generated by dbmp, removed with the host's last Datera session
+devices {{
+    device {{
+        vendor "DATERA"
+        product "IBLOCK"
+{}
+    }}
+}}
+"""
+
+
+def parse_policy(s):
+    """
+    Parses a policy like 'path_selector=service-time,no_path_retry=queue'
+    into a list of (multipath.conf key, value)
+    """
+    policy = []
+    for part in s.split(','):
+        key, _, value = [p.strip() for p in part.partition('=')]
+        if key not in KEYS or not value:
+            raise EnvironmentError(
+                "Invalid multipath policy entry: {}.  Valid keys are: "
+                "{}".format(part, ", ".join(KEYS)))
+        if key == 'path_selector':
+            if value not in SELECTORS:
+                raise EnvironmentError(
+                    "Invalid path_selector: {}.  Choices are: {}".format(
+                        value, ", ".join(sorted(SELECTORS))))
+            value = '"{}"'.format(SELECTORS[value])
+        elif not value.isdigit() and (key == 'rr_min_io_rq' or
+                                      value not in ('queue', 'fail')):
+            raise EnvironmentError(
+                "Invalid {} value: {}".format(key, value))
+        policy.append((key, value))
+    return policy
+
+
+def _read(path):
+    try:
+        with io.open(path) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def reconfigure():
+    if run(['multipathd', 'reconfigure'], sudo=True).rc:
+        # Older multipath-tools only take commands through -k
+        run(['multipathd', '-k', 'reconfigure'], sudo=True, check=True)
+
+
+def configure(policy):
+    """ Writes the device section for `policy` and reloads multipathd """
+    conf = TEMPLATE.format("\n".join(
+        "        {} {}".format(k, v) for k, v in parse_policy(policy)))
+    if _read(CONF) == conf:
+        dprint("Multipath policy already configured in", CONF)
+        return
+    run(['mkdir', '-p', CONF_DIR], sudo=True, check=True)
+    run(['tee', CONF], sudo=True, stdin=conf, check=True)
+    reconfigure()
+    print("Multipath policy for Datera LUNs written to:", CONF)
+
+
+def unconfigure():
+    if not os.path.exists(CONF):
+        return
+    run(['rm', '-f', CONF], sudo=True, check=True)
+    reconfigure()
+    print("Removed multipath policy:", CONF)
+
+
+def flush_map(name):
+    result = run(['multipath', '-f', name], sudo=True)
+    if result.rc:
+        dprint("Could not flush multipath map {}: {}".format(
+            name, result.stderr.strip()))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Privileged command executor.
+
+Started once per run under sudo (see utils.run), it reads newline delimited
+JSON requests on stdin and runs each argv without a shell in its own thread,
+so concurrent requests don't wait on each other:
+
+    {"id": 1, "argv": ["iscsiadm", "-m", "session"], "input": null}
+
+Each request gets exactly one response, in completion order:
+
+    {"id": 1, "rc": 0, "stdout": "...", "stderr": "...", "duration": 0.012}
+
+A command that can't be started is reported with rc 127 and the error as
+stderr.  The helper exits when stdin is closed, ie when the dbmp process
+that started it exits.  Only the standard library may be used here.
+"""
+from __future__ import unicode_literals, print_function, division
+
+import json
+import subprocess
+import sys
+import threading
+import time
+
+_OUT = sys.stdout
+_LOCK = threading.Lock()
+
+
+def send(msg):
+    with _LOCK:
+        _OUT.write(json.dumps(msg) + '\n')
+        _OUT.flush()
+
+
+def execute(req):
+    start = time.time()
+    data = req.get('input')
+    try:
+        proc = subprocess.Popen(
+            req['argv'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        out, err = proc.communicate(
+            data.encode('utf-8') if data is not None else None)
+        rc = proc.returncode
+        out = out.decode('utf-8', 'replace')
+        err = err.decode('utf-8', 'replace')
+    except OSError as e:
+        rc, out, err = 127, '', str(e)
+    send({'id': req.get('id'), 'rc': rc, 'stdout': out, 'stderr': err,
+          'duration': time.time() - start})
+
+
+def main():
+    send({'id': None, 'rc': 0, 'stdout': 'ready', 'stderr': '',
+          'duration': 0})
+    threads = []
+    for line in iter(sys.stdin.readline, ''):
+        line = line.strip()
+        if not line:
+            continue
+        t = threading.Thread(target=execute, args=(json.loads(line),))
+        t.daemon = True
+        t.start()
+        threads = [x for x in threads if x.is_alive()] + [t]
+    # Let commands already running finish before exiting
+    for t in threads:
+        t.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
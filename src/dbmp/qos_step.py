@@ -0,0 +1,258 @@
+"""
+QoS step response harness.
+
+A schedule of total_iops_max values is applied to every volume while a fio
+workload runs against them.  Each value is held for --qos-step-hold seconds,
+a ramp "a-b/n" expands to n evenly spaced values from a to b which share a
+single hold period:
+
+    1000,5000,500,1000-5000/4
+
+The first value is applied before the workload starts and its hold serves as
+warm up.  IOPS (read + write) and average latency of every app_instance are
+sampled every --qos-step-interval seconds for the whole run.  For every
+following change the response of each app_instance is reduced to:
+
+* steady state, the mean IOPS over the last quarter of the hold
+* steady state error, (steady state - limit) / limit in percent
+* overshoot, how far IOPS went past the steady state in the direction of the
+  change, in percent of the size of the change
+* settle time, seconds from the change until IOPS stays within
+  --qos-step-band percent of the steady state
+
+The volumes' original QoS policies are restored once the run ends.
+"""
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import threading
+import time
+
+from dfs_sdk import exceptions as dat_exceptions
+
+from dbmp.fio import start_fio
+from dbmp.metrics import _seconds, write_metrics
+from dbmp.utils import Parallel, dprint, percentile
+from dbmp.volume import QOS_KEYS, set_qos, update_qos
+
+SAMPLE_METRICS = ('iops_read', 'iops_write', 'lat_avg_read', 'lat_avg_write')
+# Extra fio runtime so the workload outlasts the last hold
+FIO_MARGIN = 10
+
+
+def parse_schedule(s, hold):
+    """ Returns a list of (total_iops_max, hold seconds) steps """
+    steps = []
+    for part in s.split(','):
+        try:
+            if '-' in part:
+                span, n = part.split('/') if '/' in part else (part, 2)
+                start, end = map(int, span.split('-'))
+                n = int(n)
+                if n < 2:
+                    raise ValueError()
+                inc = (end - start) / (n - 1)
+                steps.extend((int(round(start + inc * i)), hold / n)
+                             for i in range(n))
+            else:
+                steps.append((int(part), hold))
+        except ValueError:
+            raise EnvironmentError(
+                "QoS step schedule entry: '{}' must be a total_iops_max value "
+                "or a ramp in the form 'start-end/steps'".format(part))
+    if len(steps) < 2 or any(v < 1 for v, _ in steps):
+        raise EnvironmentError(
+            "QoS step schedule: '{}' needs at least two values and every "
+            "value must be >= 1".format(s))
+    return steps
+
+
+def _sample(api, ai, interval, stop, samples):
+    eps = [(m, getattr(api.metrics.io, m)) for m in SAMPLE_METRICS]
+    while not stop.is_set():
+        start = time.time()
+        point = {}
+        try:
+            for m, ep in eps:
+                point[m] = ep.latest.get(uuid=ai.id)[0]['point']
+            t = _seconds(point['iops_read']['time'])
+        except (IndexError, KeyError):
+            dprint("Missing metrics point for ai", ai.name)
+        else:
+            # Polling faster than the array updates returns the same point
+            # again, it's only counted once
+            if not samples or t > samples[-1][0]:
+                samples.append((t, point['iops_read']['value'] +
+                                point['iops_write']['value'],
+                                point['lat_avg_read']['value'],
+                                point['lat_avg_write']['value']))
+        stop.wait(max(0, interval - (time.time() - start)))
+
+
+def _set_limit(name, vol, value, changed):
+    update_qos(vol, {'total_iops_max': value})
+    now = time.time()
+    # An app_instance has changed once its last volume has
+    with changed['lock']:
+        changed[name] = max(changed.get(name, 0), now)
+
+
+def _apply_limit(vols, value, workers):
+    changed = {'lock': threading.Lock()}
+    funcs, args = [], []
+    for name, vol in vols:
+        funcs.append(_set_limit)
+        args.append((name, vol, value, changed))
+    p = Parallel(funcs, args_list=args, max_workers=workers)
+    p.run_threads()
+    del changed['lock']
+    return changed
+
+
+def _get_policy(vol, originals):
+    try:
+        policy = vol.performance_policy.get()
+        originals.append((vol, {k: policy[k] for k in QOS_KEYS
+                                if policy.get(k)}))
+    except dat_exceptions.ApiNotFoundError:
+        originals.append((vol, {}))
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else None
+
+
+def _steady(window, start, end):
+    quarter = end - (end - start) / 4
+    return [s for s in window if s[0] >= quarter] or window[-1:]
+
+
+def analyze(samples, changes, steps, end, band):
+    """
+    Returns the response to each step after the first for a single
+    app_instance.  `changes` holds the time each step was applied and `end`
+    the time the run ended.  Steps that were never applied have no response
+    """
+    bounds = list(zip(changes, changes[1:] + [end]))
+    windows = [[s for s in samples if start <= s[0] < stop]
+               for start, stop in bounds]
+    results = []
+    for i in range(1, min(len(steps), len(bounds))):
+        start, stop = bounds[i]
+        window = windows[i]
+        result = {'from': steps[i - 1][0], 'to': steps[i][0],
+                  'steady_state': None, 'steady_state_error': None,
+                  'overshoot': None, 'settle_time': None,
+                  'lat_avg_read': None, 'lat_avg_write': None}
+        results.append(result)
+        if not window or not windows[i - 1]:
+            continue
+        steady = _steady(window, start, stop)
+        final = _mean([s[1] for s in steady])
+        initial = _mean(
+            [s[1] for s in _steady(windows[i - 1], *bounds[i - 1])])
+        limit = steps[i][0]
+        result.update(
+            steady_state=round(final, 1),
+            steady_state_error=round((final - limit) / limit * 100, 2),
+            lat_avg_read=_mean([s[2] for s in steady]),
+            lat_avg_write=_mean([s[3] for s in steady]))
+        tolerance = max(1, abs(final) * band / 100)
+        delta = final - initial
+        # A change lost in the noise has no meaningful overshoot
+        if abs(delta) > tolerance:
+            peak = (max if delta > 0 else min)(s[1] for s in window)
+            result['overshoot'] = round(
+                max(0, (peak - final) / delta * 100), 2)
+        outside = [j for j, s in enumerate(window)
+                   if abs(s[1] - final) > tolerance]
+        if not outside:
+            result['settle_time'] = round(window[0][0] - start, 2)
+        elif outside[-1] < len(window) - 1:
+            result['settle_time'] = round(
+                window[outside[-1] + 1][0] - start, 2)
+    return results
+
+
+def print_results(steps, results):
+    for i in range(1, len(steps)):
+        print("Step {}: total_iops_max {} -> {}".format(
+            i, steps[i - 1][0], steps[i][0]))
+        print("    {:<30} {:>10} {:>9} {:>10} {:>9}".format(
+            'app_instance', 'steady', 'error %', 'overshoot', 'settle s'))
+        settles = []
+        for name, rs in sorted(results.items()):
+            if len(rs) < i:
+                print("    {:<30} {:>10}".format(name, 'not applied'))
+                continue
+            r = rs[i - 1]
+            if r['settle_time'] is not None:
+                settles.append(r['settle_time'])
+            print("    {:<30} {:>10} {:>9} {:>10} {:>9}".format(
+                name, *['-' if r[k] is None else r[k] for k in (
+                    'steady_state', 'steady_state_error', 'overshoot',
+                    'settle_time')]))
+        print("    settled: {}/{} p50 {} max {}".format(
+            len(settles), len(results), percentile(settles, 50),
+            max(settles) if settles else None))
+
+
+def run_qos_step(host, api, ais, dev_or_folders, fiofile, steps, interval,
+                 band, workers, outfile):
+    vols = [(ai.name, vol) for ai in ais
+            for si in ai.storage_instances.list()
+            for vol in si.volumes.list()]
+    originals = []
+    p = Parallel([_get_policy] * len(vols),
+                 args_list=[(vol, originals) for _, vol in vols],
+                 max_workers=workers)
+    p.run_threads()
+    changes = {ai.name: [] for ai in ais}
+    samples = {ai.name: [] for ai in ais}
+    stop = threading.Event()
+    duration = sum(d for _, d in steps)
+    print("Running QoS step schedule: {} over {:.0f}s".format(
+        ", ".join(str(v) for v, _ in steps), duration))
+    try:
+        first = _apply_limit(vols, steps[0][0], workers)
+        for name, t in first.items():
+            changes[name].append(t)
+        samplers = []
+        for ai in ais:
+            t = threading.Thread(target=_sample, args=(
+                api, ai, interval, stop, samples[ai.name]))
+            t.daemon = True
+            t.start()
+            samplers.append(t)
+        fio = start_fio(host, fiofile, dev_or_folders,
+                        duration + FIO_MARGIN)
+        begin = time.time()
+        offset = 0
+        for i, (value, hold) in enumerate(steps):
+            if i:
+                print("Setting total_iops_max to", value)
+                for name, t in _apply_limit(vols, value, workers).items():
+                    changes[name].append(t)
+            offset += hold
+            time.sleep(max(0, begin + offset - time.time()))
+        end = time.time()
+        stop.set()
+        for t in samplers:
+            t.join()
+    finally:
+        stop.set()
+        print("Restoring original QoS policies")
+        p = Parallel([set_qos] * len(originals), args_list=originals,
+                     max_workers=workers)
+        p.run_threads()
+    results = {name: analyze(samples[name], changes[name], steps, end, band)
+               for name in changes}
+    print_results(steps, results)
+    write_metrics({'schedule': steps,
+                   'results': results,
+                   'changes': {k: [t - begin for t in v]
+                               for k, v in changes.items()},
+                   'samples': {k: [[s[0] - begin] + list(s[1:]) for s in v]
+                               for k, v in samples.items()}}, outfile)
+    fio.join(FIO_MARGIN * 2)
+    return results
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Long running dbmp agent for run-hosts.
+
+Started once per run over SSH, it logs into the Datera API a single time and
+then serves newline delimited JSON-RPC requests on stdin:
+
+    {"id": 1, "method": "mount", "params": {...}}
+
+Anything printed while a request is running is streamed back as a progress
+message before the final response:
+
+    {"id": 1, "progress": "Volume device path: /dev/dm-3"}
+    {"id": 1, "result": [...]}
+    {"id": 1, "error": "..."}
+"""
+from __future__ import unicode_literals, print_function, division
+
+import io
+import json
+import os
+import sys
+import threading
+import traceback
+
+from dfs_sdk import scaffold
+
+from dbmp.fio import run_fio_from_file
+from dbmp.hoststats import sample
+from dbmp.mount import mount_volumes, clean_mounts, list_mounts, device_map
+from dbmp.tuning import summary
+from dbmp.utils import rand_file_name
+
+SUCCESS = 0
+FAILURE = 1
+
+_OUT = sys.stdout
+_LOCK = threading.Lock()
+_CURRENT = {'id': None}
+
+
+def send(msg):
+    with _LOCK:
+        _OUT.write(json.dumps(msg) + '\n')
+        _OUT.flush()
+
+
+class ProgressWriter(object):
+
+    """
+    Stands in for sys.stdout while a request runs, forwarding every complete
+    line as a progress message for that request
+    """
+
+    def __init__(self):
+        self.buf = ''
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        with self.lock:
+            self.buf += data
+            lines = self.buf.split('\n')
+            self.buf = lines.pop()
+        for line in lines:
+            send({'id': _CURRENT['id'], 'progress': line})
+
+    def flush(self):
+        pass
+
+
+def do_ping(api):
+    return 'pong'
+
+
+def do_mount(api, vols, multipath, fs, fsargs, directory, workers,
+             login_only, preformatted=None, profile='default', sessions=1,
+             mp_policy=None):
+    ais = [api.app_instances.get(v) for v in vols]
+    return mount_volumes(api, ais, multipath, fs, fsargs, directory, workers,
+                         login_only, preformatted, profile, sessions,
+                         mp_policy)
+
+
+def do_clean(api, vols, directory, workers):
+    clean_mounts(api, vols, directory, workers)
+
+
+def do_fio(api, workload):
+    fname = rand_file_name('/tmp')
+    with io.open(fname, 'w') as f:
+        f.write(workload)
+    try:
+        print(run_fio_from_file(fname))
+    finally:
+        os.remove(fname)
+
+
+def do_list(api, vols, detail, multipath):
+    list_mounts('local', api, vols, detail, multipath)
+
+
+def do_host_devices(api, targets, multipath):
+    return device_map(targets, multipath)
+
+
+def do_diskstats(api, devices):
+    return sample(devices)
+
+
+def do_tuning(api):
+    return summary()
+
+
+METHODS = {'ping': do_ping,
+           'mount': do_mount,
+           'clean': do_clean,
+           'fio': do_fio,
+           'list': do_list,
+           'host_devices': do_host_devices,
+           'diskstats': do_diskstats,
+           'tuning': do_tuning}
+
+
+def handle(api, req):
+    method = METHODS.get(req.get('method'))
+    if not method:
+        return {'id': req.get('id'),
+                'error': 'Unknown method: {}'.format(req.get('method'))}
+    _CURRENT['id'] = req.get('id')
+    try:
+        result = method(api, **req.get('params', {}))
+        return {'id': req.get('id'), 'result': result}
+    except Exception as e:
+        traceback.print_exc(file=sys.stderr)
+        return {'id': req.get('id'), 'error': str(e)}
+
+
+def main(args):
+    api = scaffold.get_api()
+    sys.stdout = ProgressWriter()
+    send({'id': None, 'result': 'ready'})
+    for line in iter(sys.stdin.readline, ''):
+        line = line.strip()
+        if not line:
+            continue
+        req = json.loads(line)
+        if req.get('method') == 'shutdown':
+            send({'id': req.get('id'), 'result': None})
+            break
+        send(handle(api, req))
+    return SUCCESS
+
+
+if __name__ == '__main__':
+    parser = scaffold.get_argparser()
+    args = parser.parse_args()
+    sys.exit(main(args))
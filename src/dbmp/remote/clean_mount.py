@@ -4,13 +4,12 @@ import sys
 
 from dfs_sdk import scaffold
 
-from dbmp.mount import clean_mounts
-
 SUCCESS = 0
 FAILURE = 1
 
 
 def main(args):
+    from dbmp.mount import clean_mounts
     api = scaffold.get_api()
     print('Using Config:')
     scaffold.print_config()
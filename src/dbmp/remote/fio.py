@@ -5,13 +5,12 @@ import sys
 
 from dfs_sdk import scaffold
 
-from dbmp.fio import run_fio_from_file
-
 SUCCESS = 0
 FAILURE = 1
 
 
 def main(args):
+    from dbmp.fio import run_fio_from_file
     run_fio_from_file(args.fio_workload)
     os.remove(args.fio_workload)
     return SUCCESS
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import sys
+
+SUCCESS = 0
+FAILURE = 1
+
+
+def main(args):
+    from dbmp.hoststats import HOSTSTATS_RESULT, sample
+    if args.targets:
+        from dbmp.mount import device_map
+        result = device_map(json.loads(args.targets), args.multipath)
+    else:
+        result = sample(args.devices.split(',') if args.devices else [])
+    # The caller parses this line, see hoststats._remote_call
+    print(HOSTSTATS_RESULT + json.dumps(result))
+    return SUCCESS
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # Either the devices of --targets or a diskstats sample of --devices
+    parser.add_argument('--targets')
+    parser.add_argument('--multipath', action='store_true')
+    parser.add_argument('--devices')
+    args = parser.parse_args()
+    sys.exit(main(args))
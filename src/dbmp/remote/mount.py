@@ -1,24 +1,29 @@
 #!/usr/bin/env python
 
+import json
 import sys
 
 from dfs_sdk import scaffold
 
-from dbmp.mount import mount_volumes
-
 SUCCESS = 0
 FAILURE = 1
 
 
 def main(args):
+    from dbmp.mount import MOUNT_RESULT, mount_volumes
     api = scaffold.get_api()
     print('Using Config:')
     scaffold.print_config()
     ais = []
     for v in args.vols.split(','):
         ais.append(api.app_instances.get(v))
-    mount_volumes(api, ais, args.multipath, args.fs, args.fsargs,
-                  args.directory, args.workers, args.login_only)
+    preformatted = args.preformatted.split(',') if args.preformatted else None
+    results = mount_volumes(api, ais, args.multipath, args.fs, args.fsargs,
+                            args.directory, args.workers, args.login_only,
+                            preformatted, args.tuning_profile,
+                            args.sessions_per_portal, args.multipath_policy)
+    # The caller parses this line, see mount_volumes_remote
+    print(MOUNT_RESULT + json.dumps(results))
     return SUCCESS
 
 
@@ -30,6 +35,12 @@ if __name__ == '__main__':
     parser.add_argument('--fsargs')
     parser.add_argument('--directory')
     parser.add_argument('--workers', type=int)
-    parser.add_argument('--login_only', action='store_true')
+    # mount_volumes_remote passes --login-only
+    parser.add_argument('--login-only', '--login_only', dest='login_only',
+                        action='store_true')
+    parser.add_argument('--preformatted')
+    parser.add_argument('--tuning-profile', default='default')
+    parser.add_argument('--sessions-per-portal', type=int, default=1)
+    parser.add_argument('--multipath-policy')
     args = parser.parse_args()
     sys.exit(main(args))
@@ -0,0 +1,157 @@
+"""
+REST call accounting and a per-run read-through cache for the Datera API.
+
+install() wraps requests.Session.request (which the Datera SDK uses for
+every call) so that:
+
+* every call is counted per endpoint, ids and names folded to '*'
+* successful GETs are cached by URL and parameters for the rest of the run
+  and repeated GETs are answered with a copy of the cached response
+* any other method invalidates every cached path under the top level
+  collection it wrote to (and the root), since list and parent responses
+  embed their children and the same entity can be read by id or by name
+* metrics and login are never cached
+
+Code that polls for state changes made by the cluster itself (op_state of
+storage_instances or snapshots) must read inside `with uncached():`.
+"""
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import contextlib
+import copy
+import json
+import threading
+
+from dbmp.tracing import api_name
+
+CACHE = True
+NEVER_CACHE = ('/metrics', '/login')
+_CACHE = {}
+_COUNTS = {}
+_LOCK = threading.Lock()
+_LOCAL = threading.local()
+# Bumped by every write, a GET is only cached if none happened while it ran
+_GEN = [0]
+_INSTALLED = []
+
+
+def _path(url):
+    parts = [p for p in url.split('?')[0].split('/')[3:] if p]
+    if parts and parts[0].startswith('v') and parts[0][1:2].isdigit():
+        parts = parts[1:]
+    return '/' + '/'.join(parts)
+
+
+def _related(a, b):
+    return (a == b or a.startswith(b.rstrip('/') + '/') or
+            b.startswith(a.rstrip('/') + '/'))
+
+
+def _collection(path):
+    # /app_instances/<id>/... -> /app_instances
+    return '/' + path.split('/')[1]
+
+
+def _count(name, hit):
+    with _LOCK:
+        counts = _COUNTS.setdefault(name, [0, 0])
+        counts[1 if hit else 0] += 1
+
+
+def _invalidate(path):
+    path = _collection(path)
+    with _LOCK:
+        _GEN[0] += 1
+        for key in [k for k, (p, _) in _CACHE.items() if _related(p, path)]:
+            del _CACHE[key]
+
+
+def _copy(resp):
+    # Callers on other threads must not share one Response object
+    resp = copy.copy(resp)
+    resp.headers = resp.headers.copy()
+    return resp
+
+
+@contextlib.contextmanager
+def uncached():
+    """ Reads inside this block always go to the cluster """
+    prev = getattr(_LOCAL, 'bypass', False)
+    _LOCAL.bypass = True
+    try:
+        yield
+    finally:
+        _LOCAL.bypass = prev
+
+
+def install(cache=True):
+    global CACHE
+    CACHE = cache
+    if _INSTALLED:
+        return
+    import requests
+    orig = requests.Session.request
+
+    def request(self, method, url, *args, **kwargs):
+        name = api_name(method, url)
+        path = _path(url)
+        method = method.upper()
+        if method != 'GET':
+            try:
+                return orig(self, method, url, *args, **kwargs)
+            finally:
+                _count(name, False)
+                _invalidate(path)
+        cacheable = (CACHE and not getattr(_LOCAL, 'bypass', False) and
+                     not path.startswith(NEVER_CACHE))
+        if not cacheable:
+            _count(name, False)
+            return orig(self, method, url, *args, **kwargs)
+        key = (url, json.dumps(kwargs.get('params'), sort_keys=True,
+                               default=str))
+        with _LOCK:
+            hit = _CACHE.get(key)
+            gen = _GEN[0]
+        if hit is not None:
+            _count(name, True)
+            return _copy(hit[1])
+        _count(name, False)
+        resp = orig(self, method, url, *args, **kwargs)
+        if resp.status_code == 200:
+            # Load the body now so every cache hit can read it
+            resp.content
+            with _LOCK:
+                if gen == _GEN[0]:
+                    _CACHE[key] = (path, _copy(resp))
+        return resp
+    requests.Session.request = request
+    _INSTALLED.append(orig)
+
+
+def clear():
+    with _LOCK:
+        _GEN[0] += 1
+        _CACHE.clear()
+        _COUNTS.clear()
+
+
+def counts():
+    """ Returns {endpoint: (sent, cached)} """
+    with _LOCK:
+        return {k: tuple(v) for k, v in _COUNTS.items()}
+
+
+def print_counts():
+    stats = counts()
+    if not stats:
+        return
+    width = max(len(n) for n in stats)
+    print("REST calls by endpoint:")
+    print("  {:<{w}} {:>6} {:>7}".format('endpoint', 'sent', 'cached',
+                                         w=width))
+    for name, (sent, hit) in sorted(stats.items(),
+                                    key=lambda x: (-x[1][0], x[0])):
+        print("  {:<{w}} {:>6} {:>7}".format(name, sent, hit, w=width))
+    print("  {} calls sent, {} answered from cache".format(
+        sum(v[0] for v in stats.values()), sum(v[1] for v in stats.values())))
@@ -14,16 +14,25 @@ def read_topology_file(tfile):
         return json.loads(f.read())
 
 
-def get_topology(host):
+def _load_topology():
     global _TOPOLOGY
-    if host == 'local':
-        return 'local'
     if not _TOPOLOGY:
         config = scaffold.get_config()
         if 'topology' in config:
             _TOPOLOGY = config['topology']
-        elif host != 'local':
+        else:
             _TOPOLOGY = read_topology_file(TFILE)
+
+
+def get_hosts():
+    _load_topology()
+    return sorted(_TOPOLOGY)
+
+
+def get_topology(host):
+    if host == 'local':
+        return 'local'
+    _load_topology()
     if host != 'local' and not _TOPOLOGY:
         raise EnvironmentError(
             "Non-local host specified, but no topology file found")
@@ -0,0 +1,202 @@
+"""
+Lightweight span tracing for dbmp operations.
+
+Tracing is off unless enable() is called (--trace on the command line).
+While disabled span() hands back a shared no-op context manager, so the
+instrumented call sites (exe, exe_remote, Parallel tasks, REST calls and the
+mount waits) cost a single function call.
+
+When enabled every span records its name, attributes, thread and wall clock
+start/duration.  At the end of the run write() emits the spans as a Chrome
+trace (load it in chrome://tracing or https://ui.perfetto.dev) and
+print_summary() prints count, p50, p95, max and total per operation.
+"""
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import io
+import json
+import os
+import re
+import threading
+import time
+
+from six import string_types
+
+ENABLED = False
+_SPANS = []
+_LOCK = threading.Lock()
+# REST path segments following these are ids/names, folded for grouping
+_COLLECTIONS = frozenset(('app_instances', 'storage_instances', 'volumes',
+                          'snapshots', 'app_templates', 'storage_templates',
+                          'volume_templates', 'initiators', 'tenants',
+                          'initiator_groups', 'storage_nodes'))
+_VERSION = re.compile(r'^v\d')
+
+
+class _NoopSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class Span(object):
+
+    """
+    A timed operation.  Use as a context manager, attributes can be added
+    while it runs with set()
+    """
+
+    __slots__ = ('name', 'attrs', 'start')
+
+    def __init__(self, name, attrs):
+        # Group by the command/function/method as well as the span type
+        detail = attrs.get('func') or attrs.get('method')
+        if 'cmd' in attrs:
+            detail = cmd_name(attrs['cmd'])
+        if 'args' in attrs:
+            attrs['args'] = describe(attrs['args'])
+        self.name = '{}:{}'.format(name, detail) if detail else name
+        self.attrs = attrs
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, etype, *exc):
+        end = time.time()
+        if etype is not None:
+            self.attrs['error'] = etype.__name__
+        record = (self.name, self.start, end - self.start,
+                  threading.current_thread().name, self.attrs)
+        with _LOCK:
+            _SPANS.append(record)
+        return False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+def span(name, **attrs):
+    if not ENABLED:
+        return _NOOP
+    return Span(name, attrs)
+
+
+def cmd_name(cmd):
+    """ Operation name for a shell command, eg 'iscsiadm' for sudo iscsiadm """
+    parts = cmd if isinstance(cmd, (list, tuple)) else cmd.split()
+    for part in parts:
+        if part not in ('sudo', '{') and '=' not in part:
+            return os.path.basename(part)
+    return cmd
+
+
+def describe(args):
+    """ Short printable form of Parallel task args for span attributes """
+    out = []
+    for arg in args:
+        try:
+            name = getattr(arg, 'name', arg)
+        except Exception:
+            # Strict SDK endpoints raise on unknown attributes
+            continue
+        if isinstance(name, string_types):
+            out.append(name)
+    return out[:4]
+
+
+def api_name(method, url):
+    parts = url.split('?')[0].split('/')[3:]
+    out = []
+    fold = False
+    for part in parts:
+        if not part or _VERSION.match(part):
+            continue
+        out.append('*' if fold else part)
+        fold = part in _COLLECTIONS and not fold
+    return '{} /{}'.format(method.upper(), '/'.join(out))
+
+
+def _patch_requests():
+    import requests
+    orig = requests.Session.request
+
+    def request(self, method, url, *args, **kwargs):
+        with span('api:' + api_name(method, url), url=url) as s:
+            resp = orig(self, method, url, *args, **kwargs)
+            s.set(status=resp.status_code)
+            return resp
+    requests.Session.request = request
+
+
+def enable():
+    global ENABLED
+    if not ENABLED:
+        ENABLED = True
+        _patch_requests()
+
+
+def reset():
+    with _LOCK:
+        del _SPANS[:]
+
+
+def _op_type(name):
+    return name.split(':', 1)[0]
+
+
+def write(fname):
+    pid = os.getpid()
+    tids = {}
+    events = []
+    with _LOCK:
+        spans = list(_SPANS)
+    for name, start, dur, thread, attrs in spans:
+        tid = tids.setdefault(thread, len(tids) + 1)
+        events.append({'name': name, 'cat': _op_type(name), 'ph': 'X',
+                       'ts': int(start * 1e6), 'dur': int(dur * 1e6),
+                       'pid': pid, 'tid': tid, 'args': attrs})
+    for thread, tid in tids.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': tid, 'args': {'name': thread}})
+    with io.open(fname, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({'traceEvents': events}, default=str,
+                           ensure_ascii=False))
+    print("Wrote {} trace spans to: {}".format(len(spans), fname))
+
+
+def summary():
+    """ Returns {operation: {count, p50, p95, max, total}} in seconds """
+    from dbmp.utils import percentile
+    durs = {}
+    with _LOCK:
+        for name, _, dur, _, _ in _SPANS:
+            durs.setdefault(name, []).append(dur)
+    return {name: {'count': len(v), 'p50': percentile(v, 50),
+                   'p95': percentile(v, 95), 'max': max(v),
+                   'total': sum(v)}
+            for name, v in durs.items()}
+
+
+def print_summary():
+    stats = summary()
+    if not stats:
+        return
+    width = max(len(n) for n in stats)
+    print("{:<{w}} {:>6} {:>9} {:>9} {:>9} {:>10}".format(
+        'operation', 'count', 'p50', 'p95', 'max', 'total', w=width))
+    for name, s in sorted(stats.items(), key=lambda x: -x[1]['total']):
+        print("{:<{w}} {:>6} {:>8.3f}s {:>8.3f}s {:>8.3f}s {:>9.3f}s".format(
+            name, s['count'], s['p50'], s['p95'], s['max'], s['total'],
+            w=width))
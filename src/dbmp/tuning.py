@@ -0,0 +1,207 @@
+"""
+Block device and iSCSI session tuning profiles.
+
+A profile is applied to every target and device mount_volumes logs in: its
+iSCSI settings are written to the node record of each portal before login
+and its queue settings to the sysfs queue of every path device and of the
+dm-multipath device holding it.  Only settings the running kernel exposes
+are written and the scheduler is picked from the profile's preferences
+among the ones the kernel offers ('none' on blk-mq kernels, which have no
+'noop').  Every setting written is recorded, summarized at the end of the
+mount and written to the run's tuning output file.
+"""
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import io
+import json
+import os
+import sys
+import threading
+
+from dbmp.utils import agent_enabled, dprint, get_agent, run
+
+# Queue settings are written in order, the scheduler first since it changes
+# the limits of nr_requests.  'max' means the device's hardware maximum.
+# main.TUNING_PROFILES lists the same names
+PROFILES = {
+    'default': {
+        'iscsi': (),
+        'queue': (('scheduler', ('noop', 'none')),),
+    },
+    'latency': {
+        'iscsi': (('node.session.cmds_max', 128),
+                  ('node.session.queue_depth', 32)),
+        'queue': (('scheduler', ('none', 'noop')),
+                  ('nr_requests', 64),
+                  ('read_ahead_kb', 0),
+                  ('rq_affinity', 2)),
+    },
+    'throughput': {
+        'iscsi': (('node.session.cmds_max', 1024),
+                  ('node.session.queue_depth', 128)),
+        'queue': (('scheduler', ('mq-deadline', 'deadline', 'none', 'noop')),
+                  ('nr_requests', 1024),
+                  ('read_ahead_kb', 4096),
+                  ('rq_affinity', 2),
+                  ('max_sectors_kb', 'max')),
+    },
+}
+SYS_BLOCK = '/sys/block'
+
+_APPLIED = []
+_LOCK = threading.Lock()
+
+
+def _record(target, setting, value, ok):
+    with _LOCK:
+        _APPLIED.append((target, setting, value, ok))
+
+
+def _read(path):
+    try:
+        with io.open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _scheduler(current, prefs):
+    available = [s.strip('[]') for s in current.split()]
+    for pref in prefs:
+        if pref in available:
+            return pref
+    return None
+
+
+def session_cmds(iqn, portal, profile):
+    """ Returns (target, setting, value, argv) of each iSCSI setting """
+    return [('{} {}'.format(portal, iqn), setting, value,
+             ['iscsiadm', '-m', 'node', '-T', iqn,
+              '-p', '{}:3260'.format(portal), '-o', 'update',
+              '-n', setting, '-v', str(value)])
+            for setting, value in PROFILES[profile]['iscsi']]
+
+
+def set_session(iqn, portal, profile):
+    """ Writes the profile's iSCSI settings to the node record of `portal` """
+    for target, setting, value, argv in session_cmds(iqn, portal, profile):
+        result = run(argv, sudo=True)
+        _record(target, setting, value, not result.rc)
+
+
+def _queue_writes(device, profile):
+    queue = os.path.join(SYS_BLOCK, device, 'queue')
+    writes = []
+    for setting, value in PROFILES[profile]['queue']:
+        current = _read(os.path.join(queue, setting))
+        if current is None:
+            dprint("Kernel has no {} setting for {}, skipping".format(
+                setting, device))
+            continue
+        if setting == 'scheduler':
+            value = _scheduler(current, value)
+            if value is None:
+                continue
+            if '[{}]'.format(value) in current.split():
+                _record(device, setting, value, True)
+                continue
+        elif value == 'max':
+            value = _read(os.path.join(queue, 'max_hw_sectors_kb'))
+        if value is None:
+            continue
+        if str(value) == current:
+            _record(device, setting, value, True)
+            continue
+        writes.append((device, os.path.join(queue, setting), setting, value))
+    return writes
+
+
+def queue_writes(devices, profile):
+    """
+    Returns the targets (`devices` and every dm device holding them) and
+    the (device, path, setting, value) sysfs writes the profile needs on
+    them.  Settings already in place are recorded
+    """
+    targets = []
+    for device in devices:
+        if device not in targets:
+            targets.append(device)
+        try:
+            holders = os.listdir(os.path.join(SYS_BLOCK, device, 'holders'))
+        except OSError:
+            holders = []
+        targets.extend(h for h in holders if h not in targets)
+    writes = []
+    for device in targets:
+        writes.extend(_queue_writes(device, profile))
+    return targets, writes
+
+
+def tune_devices(devices, profile):
+    """
+    Applies the profile's queue settings to `devices` (names under
+    /sys/block) and to every dm device holding them
+    """
+    targets, writes = queue_writes(devices, profile)
+    for device, path, setting, value in writes:
+        result = run(['tee', path], sudo=True, stdin=str(value))
+        _record(device, setting, value, not result.rc)
+    dprint("Tuned devices {} with profile {}".format(targets, profile))
+
+
+def reset():
+    with _LOCK:
+        del _APPLIED[:]
+
+
+def summary():
+    """
+    Returns every setting recorded since reset() as a list of
+    {setting, value, ok, targets}
+    """
+    with _LOCK:
+        applied = list(_APPLIED)
+    counts = {}
+    for target, setting, value, ok in applied:
+        counts.setdefault((setting, str(value), ok), set()).add(target)
+    return [{'setting': setting, 'value': value, 'ok': ok,
+             'targets': sorted(targets)}
+            for (setting, value, ok), targets in sorted(counts.items())]
+
+
+def print_summary(profile):
+    settings = summary()
+    if not settings:
+        return
+    print("Tuning profile '{}' applied:".format(profile))
+    for s in settings:
+        if s['ok']:
+            print("  {}={} on {}".format(
+                s['setting'], s['value'], len(s['targets'])))
+        else:
+            print("  {}={} FAILED on {}".format(
+                s['setting'], s['value'], ", ".join(s['targets'])))
+
+
+def write_summaries(hosts, profile, outfile):
+    """
+    Writes the settings applied on each of `hosts` to `outfile`.  Remote
+    hosts only report them through the agent
+    """
+    summaries = {}
+    for host in hosts:
+        if host == 'local':
+            summaries[host] = summary()
+        elif agent_enabled():
+            summaries[host] = get_agent(host).call('tuning')
+        else:
+            dprint("Tuning settings of {} are only printed on that host "
+                   "without the agent".format(host))
+    data = json.dumps({'profile': profile, 'hosts': summaries}, indent=4)
+    print("Writing tuning settings to:", outfile)
+    if outfile == 'stdout':
+        sys.stdout.write(data + '\n')
+    else:
+        with io.open(outfile, 'w', encoding='utf-8') as f:
+            f.write(data)
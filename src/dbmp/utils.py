@@ -1,8 +1,11 @@
 from __future__ import (unicode_literals, print_function, absolute_import,
                         division)
 
+import atexit
+import collections
 import logging
 import json
+import math
 # Py2-3 compatibility
 try:
     import queue
@@ -14,22 +17,33 @@ import random
 import string
 import subprocess
 import sys
-import tempfile
 import threading
+import time
 from time import sleep
 
-from six import reraise as raise_
+from six import reraise as raise_, string_types
+from six.moves import range
 from six.moves import zip_longest
-import paramiko
 from dfs_sdk import scaffold
 
+from dbmp import tracing
 from dbmp.topology import get_topology
 
-DBMP_REPO = 'http://github.com/Datera/dbmp'
 ASSETS = os.path.join(
         os.path.dirname(
             os.path.dirname(os.path.abspath(__file__))), 'assets')
 LOCKS = {}
+AGENTS = {}
+AGENT_LOCK = threading.Lock()
+REMOTE_AGENT = False
+PRIV_HELPER = True
+HELPER_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'privhelper.py')
+HELPER_LOCK = threading.Lock()
+_HELPER = []
+
+CmdResult = collections.namedtuple(
+    'CmdResult', ('argv', 'rc', 'stdout', 'stderr', 'duration'))
 
 
 class Parallel(object):
@@ -88,7 +102,8 @@ class Parallel(object):
                 orig_name = threading.current_thread().name
                 self._set_current_thread_name_from_func_name(func)
                 # Call the function:
-                func(*args, **kwargs)
+                with tracing.span('task', func=func.__name__, args=args):
+                    func(*args, **kwargs)
                 # Reset this thread name to its original (e.g. "Thread-9")
                 threading.current_thread().name = orig_name
             except Exception:
@@ -109,12 +124,12 @@ class Parallel(object):
                     self.funcs, self.args_list, self.kwargs_list,
                     fillvalue={}):
                 # Flag a common (and confusing) user error:
-                if isinstance(args, str) or isinstance(args, unicode):
+                if isinstance(args, string_types):
                     msg = "args_list must be list of lists not list of strings"
                     raise ValueError(msg)
                 self.queue.put((func, args, kwargs))
 
-            for _ in xrange(self.max_workers):
+            for _ in range(self.max_workers):
                 thread = threading.Thread(target=self._wrapped)
                 thread.setDaemon(True)
                 thread.start()
@@ -155,12 +170,57 @@ class Parallel(object):
                 pass
 
 
+class RateLimiter(object):
+
+    """
+    Thread safe token bucket limiting callers of wait() to `rate` calls per
+    second, with bursts of up to `burst` calls.  A rate of 0 disables the
+    limit.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            sleep(delay)
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile of `values`, p in [0, 100] """
+    if not values:
+        return None
+    values = sorted(values)
+    k = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(1, k) - 1]
+
+
 def exe(cmd, fail_ok=False):
+    with tracing.span('exe', cmd=cmd):
+        return _exe(cmd, fail_ok)
+
+
+def _exe(cmd, fail_ok):
     cmd = '{{ {}; }} 2>/dev/null'.format(cmd)
     dprint("Running command:", cmd)
     try:
         # Redirect stderr
-        return subprocess.check_output(cmd, shell=True)
+        return subprocess.check_output(cmd, shell=True).decode('utf-8')
     except subprocess.CalledProcessError as e:
         if fail_ok:
             dprint(e)
@@ -169,7 +229,182 @@ def exe(cmd, fail_ok=False):
             "Encountered error running command: {}, error : {}".format(cmd, e))
 
 
+class PrivHelper(object):
+
+    """
+    Client for the privileged command executor (privhelper.py).  It is
+    started once per process under sudo and runs every privileged argv sent
+    to it without a shell, saving a shell and a sudo fork per command.
+    Requests from any number of threads are multiplexed over its pipe and
+    matched to their responses by id.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.pending = {}
+        self.dead = False
+        with open(os.devnull, 'w') as devnull:
+            self.proc = subprocess.Popen(
+                ['sudo', '-n', sys.executable, HELPER_SCRIPT],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=devnull)
+        ready = self._read()
+        if ready is None or ready.get('stdout') != 'ready':
+            self.proc.wait()
+            raise EnvironmentError(
+                "Could not start the privileged helper, passwordless sudo "
+                "is required")
+        reader = threading.Thread(target=self._dispatch)
+        reader.daemon = True
+        reader.start()
+
+    def _read(self):
+        line = self.proc.stdout.readline()
+        if not line:
+            return None
+        return json.loads(line.decode('utf-8'))
+
+    def _dispatch(self):
+        while True:
+            msg = self._read()
+            with self.lock:
+                if msg is None:
+                    self.dead = True
+                    waiting = list(self.pending.values())
+                    self.pending.clear()
+                else:
+                    waiting = [self.pending.pop(msg['id'], None)]
+            for callback in waiting:
+                if callback:
+                    callback(msg)
+            if msg is None:
+                return
+
+    def submit(self, argv, stdin, callback):
+        """
+        Sends `argv` to the helper without waiting, `callback` is called
+        with the response (None if the helper exited) from the reader
+        thread.  Returns False if the helper has already exited
+        """
+        with self.lock:
+            if self.dead:
+                return False
+            self.next_id += 1
+            self.pending[self.next_id] = callback
+            try:
+                self.proc.stdin.write((json.dumps(
+                    {'id': self.next_id, 'argv': argv, 'input': stdin}) +
+                    '\n').encode('utf-8'))
+                self.proc.stdin.flush()
+            except (IOError, OSError):
+                self.dead = True
+                del self.pending[self.next_id]
+                return False
+        return True
+
+    def run(self, argv, stdin=None):
+        """ Returns the helper's response, or None if it has exited """
+        done = threading.Event()
+        result = []
+
+        def _set(msg):
+            result.append(msg)
+            done.set()
+
+        if not self.submit(argv, stdin, _set):
+            return None
+        done.wait()
+        return result[0]
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            # Already gone
+            pass
+        self.proc.wait()
+
+
+def _get_helper():
+    if not PRIV_HELPER or os.geteuid() == 0:
+        return None
+    if not _HELPER:
+        with HELPER_LOCK:
+            if not _HELPER:
+                helper = None
+                try:
+                    helper = PrivHelper()
+                except EnvironmentError as e:
+                    dprint(e, "falling back to sudo per command")
+                _HELPER.append(helper)
+    helper = _HELPER[0]
+    return helper if helper and not helper.dead else None
+
+
+def close_helper():
+    if _HELPER and _HELPER[0]:
+        _HELPER[0].close()
+    del _HELPER[:]
+
+
+def _run_local(argv, stdin):
+    start = time.time()
+    try:
+        proc = subprocess.Popen(argv, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate(
+            stdin.encode('utf-8') if stdin is not None else None)
+    except OSError as e:
+        return CmdResult(argv, 127, '', str(e), time.time() - start)
+    return CmdResult(argv, proc.returncode, out.decode('utf-8', 'replace'),
+                     err.decode('utf-8', 'replace'), time.time() - start)
+
+
+def run(argv, sudo=False, stdin=None, check=False):
+    """
+    Runs `argv` without a shell, writing `stdin` to it, and returns a
+    CmdResult with its exit code, stdout, stderr and duration.  `sudo`
+    commands go through the privileged helper while it's running, otherwise
+    through sudo directly.  With `check` a nonzero exit code raises
+    EnvironmentError including stderr
+    """
+    with tracing.span('exe', cmd=argv):
+        dprint("Running command:", argv)
+        helper = _get_helper() if sudo else None
+        msg = helper.run(argv, stdin) if helper else None
+        if msg:
+            result = CmdResult(argv, msg['rc'], msg['stdout'], msg['stderr'],
+                               msg['duration'])
+        elif sudo and os.geteuid() != 0:
+            if helper:
+                dprint("Privileged helper has exited, falling back to sudo "
+                       "per command")
+            result = _run_local(['sudo'] + argv, stdin)._replace(argv=argv)
+        else:
+            result = _run_local(argv, stdin)
+    return checked(result, check)
+
+
+def checked(result, check):
+    """
+    Logs a failed CmdResult and with `check` raises EnvironmentError for
+    it, shared with the asyncio core's run
+    """
+    if result.rc:
+        dprint("Command {} returned {}: {}".format(
+            result.argv, result.rc, result.stderr.strip()))
+        if check:
+            raise EnvironmentError(
+                "Command '{}' returned non-zero exit status {}: {}".format(
+                    " ".join(result.argv), result.rc, result.stderr.strip()))
+    return result
+
+
 def get_ssh(host):
+    # paramiko pulls in the crypto stack, only load it for remote hosts
+    import paramiko
     ssh = paramiko.SSHClient()
     ssh.set_missing_host_key_policy(
         paramiko.AutoAddPolicy())
@@ -188,6 +423,11 @@ def get_ssh(host):
 
 
 def exe_remote(host, cmd, fail_ok=False):
+    with tracing.span('exe_remote', cmd=cmd, host=host):
+        return _exe_remote(host, cmd, fail_ok)
+
+
+def _exe_remote(host, cmd, fail_ok):
     dprint("Running remote command {} on host {}:".format(cmd, host))
     ssh = get_ssh(host)
     _, stdout, stderr = ssh.exec_command(cmd)
@@ -212,18 +452,97 @@ def exe_remote_py(host, cmd):
     return exe_remote(host, prefix.format(cmd))
 
 
-def check_install(host):
-    try:
-        exe_remote(host, 'test -d ~/dbmp')
-    except EnvironmentError:
-        exe_remote(host, 'git clone {} && ~/dbmp/install.py'.format(DBMP_REPO))
-    with tempfile.NamedTemporaryFile() as tf:
-        config = scaffold.get_config()
-        tf.write(json.dumps(config))
-        tf.flush()
-        user, _, _ = get_topology(host)
-        putf_remote(host, tf.name,
-                    '/home/{}/datera-config.json'.format(user))
+class RemoteAgent(object):
+
+    """
+    Client for the dbmp agent (remote/agent.py) running on a run-host.  The
+    agent is started once over SSH and then reused for every remote action,
+    so each action only costs a JSON round trip over the open channel
+    instead of an SSH connection, interpreter start and API login.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.ssh = get_ssh(host)
+        self.stdin, self.stdout, _ = self.ssh.exec_command(
+            'cd ~/dbmp/src && ~/dbmp/.dbmp/bin/python '
+            '~/dbmp/src/dbmp/remote/agent.py 2>>~/dbmp/agent.log')
+        ready = self._read()
+        if ready is None or ready.get('result') != 'ready':
+            self.ssh.close()
+            raise EnvironmentError(
+                "Could not start dbmp agent on host {}".format(host))
+
+    def _read(self):
+        line = self.stdout.readline()
+        if not line:
+            return None
+        return json.loads(line)
+
+    def call(self, method, **params):
+        """
+        Runs `method` on the agent and returns its result, printing any
+        progress output as it arrives
+        """
+        with self.lock, tracing.span('agent', method=method, host=self.host):
+            self.next_id += 1
+            rid = self.next_id
+            dprint("Calling agent method {} on host {}".format(
+                method, self.host))
+            self.stdin.write(json.dumps(
+                {'id': rid, 'method': method, 'params': params}) + '\n')
+            self.stdin.flush()
+            while True:
+                msg = self._read()
+                if msg is None:
+                    raise EnvironmentError(
+                        "dbmp agent on host {} exited".format(self.host))
+                if msg.get('id') != rid:
+                    continue
+                if 'progress' in msg:
+                    print("[{}]".format(self.host), msg['progress'])
+                elif 'error' in msg:
+                    raise EnvironmentError(
+                        "Agent error on host {}: {}".format(
+                            self.host, msg['error']))
+                else:
+                    return msg.get('result')
+
+    def close(self):
+        try:
+            self.call('shutdown')
+        except EnvironmentError as e:
+            dprint(e)
+        self.ssh.close()
+
+
+def get_agent(host):
+    with AGENT_LOCK:
+        if host not in AGENTS:
+            AGENTS[host] = RemoteAgent(host)
+        return AGENTS[host]
+
+
+def close_agents():
+    for agent in AGENTS.values():
+        agent.close()
+    AGENTS.clear()
+
+
+def agent_enabled():
+    return REMOTE_AGENT
+
+
+def remote_call(host, method, params, script):
+    """
+    Runs a remote action through the run-host's agent when agent mode is
+    enabled, otherwise execs the equivalent remote/ `script` over SSH
+    """
+    if agent_enabled():
+        return get_agent(host).call(method, **params)
+    return exe_remote_py(host, script)
 
 
 def putf_remote(host, local, file):
@@ -262,3 +581,7 @@ def locker(func):
         with LOCKS[n]:
             return func(*args, **kwargs)
     return _wrapper
+
+
+atexit.register(close_agents)
+atexit.register(close_helper)
@@ -4,9 +4,12 @@ from __future__ import unicode_literals, print_function, division
 import copy
 import io
 import json
+import os
+import time
 from dfs_sdk import exceptions as dat_exceptions
 
-from dbmp.utils import Parallel, get_hostname, dprint
+from dbmp.utils import Parallel, RateLimiter, get_hostname, dprint
+from dbmp.utils import percentile
 
 STORE_NAME = 'storage-1'
 VOL_NAME = 'volume-1'
@@ -46,15 +49,20 @@ MULTI_VOL_TEMPLATE = {'name': 'app-1',
                                 'qos': {}}]}]}
 
 
+QOS_KEYS = frozenset(('read_iops_max',
+                      'write_iops_max',
+                      'total_iops_max',
+                      'read_bandwidth_max',
+                      'write_bandwidth_max',
+                      'total_bandwidth_max'))
+PLACEMENT_MODES = frozenset(('hybrid', 'single_flash', 'all_flash'))
+_SPECS = {}
+
+
 def _is_valid(k):
     if k in VOL_DEFAULTS:
         return True
-    if k in {'read_iops_max',
-             'write_iops_max',
-             'total_iops_max',
-             'read_bandwidth_max',
-             'write_bandwidth_max',
-             'total_bandwidth_max'}:
+    if k in QOS_KEYS:
         return True
     return False
 
@@ -64,53 +72,219 @@ def read_vol_opts(ifile):
         return json.loads(f.read())
 
 
-def parse_vol_opt(s):
-    parts = s.split(',')
+def _to_int(k, v, minimum=0):
+    try:
+        v = int(v)
+    except (TypeError, ValueError):
+        raise EnvironmentError(
+            "Volume key: {} must be an integer, got: {}".format(k, v))
+    if v < minimum:
+        raise EnvironmentError(
+            "Volume key: {} must be >= {}, got: {}".format(k, minimum, v))
+    return v
+
+
+def _check_qos(qos, where):
+    if not isinstance(qos, dict):
+        raise EnvironmentError("qos for {} must be an object".format(where))
+    for k, v in qos.items():
+        if k not in QOS_KEYS:
+            raise EnvironmentError(
+                "QoS key: {} for {} is not valid".format(k, where))
+        qos[k] = _to_int(k, v)
+    return qos
+
+
+def _check_vol(opts, where):
+    for k in ('size', 'replica'):
+        opts[k] = _to_int(k, opts[k], minimum=1)
+    if opts['placement_mode'] not in PLACEMENT_MODES:
+        raise EnvironmentError(
+            "placement_mode for {} must be one of {}, got: {}".format(
+                where, sorted(PLACEMENT_MODES), opts['placement_mode']))
+    _check_qos(opts['qos'], where)
+
+
+def _check_complex(opts):
+    if not opts.get('name'):
+        raise EnvironmentError("Complex volume requires a 'name'")
+    sis = opts['sis']
+    if not isinstance(sis, list) or not sis:
+        raise EnvironmentError(
+            "Complex volume {} requires a non-empty 'sis' list".format(
+                opts['name']))
+    for dsi in sis:
+        if not dsi.get('name') or not dsi.get('vols'):
+            raise EnvironmentError(
+                "Every storage_instance of {} requires a 'name' and a "
+                "non-empty 'vols' list".format(opts['name']))
+        vols = []
+        for dvol in dsi['vols']:
+            if not dvol.get('name'):
+                raise EnvironmentError(
+                    "Every volume of {},{} requires a 'name'".format(
+                        opts['name'], dsi['name']))
+            # Fill in defaults once here rather than on every create
+            tvol = {k: v for k, v in VOL_DEFAULTS.items()
+                    if k not in ('prefix', 'count', 'template', 'qos')}
+            tvol['qos'] = {}
+            tvol.update(dvol)
+            _check_vol(tvol, ",".join((opts['name'], dsi['name'],
+                                       tvol['name'])))
+            vols.append(tvol)
+        dsi['vols'] = vols
+
+
+def _check_opts(opts, where):
+    opts['count'] = _to_int('count', opts['count'], minimum=1)
+    if not opts['template']:
+        _check_vol(opts, where)
+    else:
+        _check_qos(opts['qos'], where)
+
+
+def normalize_opts(ropts, where):
+    """
+    Returns a validated copy of the simple volume options in `ropts` with
+    defaults filled in and any top-level QoS keys moved under 'qos'
+    """
     opts = copy.deepcopy(VOL_DEFAULTS)
-    if len(parts) == 1 and '=' not in parts[0]:
-        ropts = read_vol_opts(parts[0])
-        for k, v in ropts.items():
+    for k, v in ropts.items():
+        if k in QOS_KEYS:
+            opts['qos'][k] = v
+        elif k == 'qos':
+            opts['qos'].update(v)
+        elif _is_valid(k):
             opts[k] = v
-        return opts
-    elif len(parts) < 1:
-        return opts
-    for p in parts:
-        k, v = p.split('=')
-        if not _is_valid(k):
-            raise EnvironmentError("Volume key: {} is not valid".format(k))
-        if 'max' in k:
-            opts['qos'][k] = int(v)
         else:
-            try:
-                opts[k] = int(v)
-            except (TypeError, ValueError):
-                opts[k] = v
+            raise EnvironmentError("Volume key: {} is not valid".format(k))
+    _check_opts(opts, where)
     return opts
 
 
+def normalize_complex(ropts):
+    """
+    Returns a validated copy of the complex volume in `ropts` with volume
+    defaults filled in
+    """
+    opts = copy.deepcopy(VOL_DEFAULTS)
+    opts.update(copy.deepcopy(ropts))
+    _check_complex(opts)
+    return opts
+
+
+class VolumeSpec(object):
+
+    """
+    Parsed and validated form of a --volume string.  Specs are memoized by
+    their input string (see get_spec) so every caller shares one parse, and
+    their opts are shared as well, so they must be treated as read-only.
+
+    A spec is one of three kinds:
+
+    * 'opts'    -- key=value options (or a JSON file of them) describing
+                   `count` identical app_instances named <prefix>-<i>
+    * 'complex' -- a JSON file with a 'sis' list describing one app_instance
+    * 'names'   -- a comma separated list of existing app_instance names
+    """
+
+    __slots__ = ('raw', 'kind', 'opts', 'names')
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.names = ()
+        self.opts = copy.deepcopy(VOL_DEFAULTS)
+        parts = raw.split(',')
+        if not any('=' in p for p in parts):
+            if len(parts) == 1 and os.path.isfile(parts[0]):
+                self._parse_file(parts[0])
+            else:
+                self.kind = 'names'
+                self.names = tuple(p.strip() for p in parts if p.strip())
+            return
+        self.kind = 'opts'
+        for p in parts:
+            if '=' not in p:
+                raise EnvironmentError(
+                    "Volume option: {} must be in key=value form".format(p))
+            k, v = p.split('=', 1)
+            if not _is_valid(k):
+                raise EnvironmentError("Volume key: {} is not valid".format(k))
+            if k in QOS_KEYS:
+                self.opts['qos'][k] = v
+            else:
+                try:
+                    self.opts[k] = int(v)
+                except (TypeError, ValueError):
+                    self.opts[k] = v
+        self._check_opts()
+
+    def _parse_file(self, fname):
+        ropts = read_vol_opts(fname)
+        if 'sis' in ropts:
+            self.kind = 'complex'
+            self.opts = normalize_complex(ropts)
+        else:
+            self.kind = 'opts'
+            self.opts = normalize_opts(ropts, fname)
+
+    def _check_opts(self):
+        _check_opts(self.opts, self.raw)
+
+    @property
+    def prefix(self):
+        return self.opts.get('prefix')
+
+    def matches(self, name, hostname):
+        if self.kind == 'names':
+            return name in self.names
+        if self.kind == 'complex':
+            return name == self.opts['name']
+        return (self.prefix == 'all' or
+                name.startswith(self.opts.get('prefix', hostname)))
+
+    def plans(self, hostname):
+        """
+        Lazily yields an (index, app_instance name) create plan per
+        instance.  The opts themselves are shared, never copied per
+        instance, so large counts stay cheap
+        """
+        prefix = self.opts.get('prefix', hostname)
+        for i in range(self.opts['count']):
+            yield i, '{}-{}'.format(prefix, i)
+
+
+def get_spec(s):
+    spec = _SPECS.get(s)
+    if spec is None:
+        spec = _SPECS[s] = VolumeSpec(s)
+    return spec
+
+
+def parse_vol_opt(s):
+    spec = get_spec(s)
+    if spec.kind == 'names':
+        raise EnvironmentError(
+            "Volume option: {} is a list of names, not options".format(s))
+    return spec.opts
+
+
 def ais_from_vols(api, vols):
     ais = []
-    try:
-        opts = parse_vol_opt(vols)
-    except Exception:
-        for name in vols.split(','):
+    spec = get_spec(vols)
+    if spec.kind in ('names', 'complex'):
+        names = spec.names or (spec.opts['name'],)
+        for name in names:
             try:
                 ais.append(api.app_instances.get(name))
             except dat_exceptions.ApiNotFoundError:
                 print("No app_instance found matching name: {}".format(name))
         return ais
-    if 'sis' in opts:
-        try:
-            ais.append(api.app_instances.get(opts['name']))
-        except dat_exceptions.ApiNotFoundError:
-            print("No app_instance found matching name: {}".format(
-                opts['name']))
-        return ais
     ais = api.app_instances.list(filter='match(name,{}.*)'.format(
-        opts['prefix']))
+        spec.prefix))
     if not ais:
         print("No app_instance found matching prefix: {}".format(
-            opts['prefix']))
+            spec.prefix))
     return ais
 
 
@@ -156,12 +330,10 @@ def _print_tmpl_tree(tmpl, detail):
 
 
 def list_volumes(host, api, vopt, detail):
-    opts = parse_vol_opt(vopt)
+    spec = get_spec(vopt)
     hostname = get_hostname(host)
     for ai in sorted(api.app_instances.list(), key=lambda x: x.name):
-        if (opts.get('prefix') == 'all' or
-                opts.get('name') == ai.name or
-                ai.name.startswith(opts.get('prefix', hostname))):
+        if spec.matches(ai.name, hostname):
             print('-------')
             _print_vol_tree(ai, detail)
     print('-------')
@@ -174,8 +346,7 @@ def list_templates(api, detail):
     print('--------')
 
 
-def _create_volume(hostname, api, opts, i, results):
-    name = opts.get('prefix', hostname) + '-' + str(i)
+def _create_volume(api, opts, name, results):
     if opts['template']:
         at = {'path': '/app_templates/{}'.format(opts['template'])}
         ai = api.app_instances.create(name=name, app_template=at)
@@ -198,9 +369,7 @@ def _create_complex_volume(api, opts):
     ai = api.app_instances.create(name=opts['name'])
     for dsi in opts['sis']:
         si = ai.storage_instances.create(name=dsi['name'])
-        for dvol in dsi['vols']:
-            tvol = copy.deepcopy(VOL_DEFAULTS)
-            tvol.update(**dvol)
+        for tvol in dsi['vols']:
             vol = si.volumes.create(
                 name=tvol['name'],
                 replica_count=tvol['replica'],
@@ -212,26 +381,135 @@ def _create_complex_volume(api, opts):
     return ai
 
 
+def set_qos(vol, qos):
+    """
+    Sets the full QoS policy for `vol`, any QoS key not in `qos` is reset
+    to 0 (unlimited).  An empty `qos` removes the policy
+    """
+    if not qos:
+        try:
+            vol.performance_policy.delete()
+        except dat_exceptions.ApiNotFoundError:
+            pass
+        return
+    qos = {k: qos.get(k, 0) for k in QOS_KEYS}
+    try:
+        vol.performance_policy.set(**qos)
+    except dat_exceptions.ApiNotFoundError:
+        vol.performance_policy.create(**qos)
+
+
+def update_qos(vol, qos):
+    """ Changes only the QoS keys in `qos`, the rest of the policy is kept """
+    try:
+        vol.performance_policy.set(**qos)
+    except dat_exceptions.ApiNotFoundError:
+        vol.performance_policy.create(**qos)
+
+
+def parse_update(s):
+    """
+    Parses an --update string of comma separated key=value pairs, only
+    'size' and QoS keys may be changed
+    """
+    changes = {'qos': {}}
+    for p in s.split(','):
+        if '=' not in p:
+            raise EnvironmentError(
+                "Update option: {} must be in key=value form".format(p))
+        k, v = p.split('=', 1)
+        if k in QOS_KEYS:
+            changes['qos'][k] = _to_int(k, v)
+        elif k == 'size':
+            changes['size'] = _to_int(k, v, minimum=1)
+        else:
+            raise EnvironmentError(
+                "Update key: {} is not valid, only size and QoS keys can "
+                "be updated".format(k))
+    return changes
+
+
+def _update_volume(ai, si, vol, changes, limiter, results):
+    name = ",".join((ai.name, si.name, vol.name))
+    # Each PUT is charged to the limiter, the waits aren't timed
+    put = 0
+    if 'size' in changes and vol.size != changes['size']:
+        limiter.wait()
+        start = time.time()
+        vol = vol.set(size=changes['size'])
+        put += time.time() - start
+    qos = changes['qos']
+    if qos:
+        limiter.wait()
+        start = time.time()
+        update_qos(vol, qos)
+        put += time.time() - start
+    start = time.time()
+    # Confirm the change through the API before timing it as done
+    if 'size' in changes and vol.reload().size != changes['size']:
+        raise EnvironmentError(
+            "Size update for {} was not applied".format(name))
+    if qos:
+        policy = vol.performance_policy.get()
+        wrong = [k for k, v in qos.items() if policy.get(k) != v]
+        if wrong:
+            raise EnvironmentError(
+                "QoS update for {} was not applied: {}".format(
+                    name, ", ".join(wrong)))
+    total = put + time.time() - start
+    print("Updated volume: {} put {:.3f}s confirmed {:.3f}s".format(
+        name, put, total))
+    results.append((name, put, total))
+
+
+def _update_ai(ai, changes, limiter, results):
+    for si in ai.storage_instances.list():
+        for vol in si.volumes.list():
+            _update_volume(ai, si, vol, changes, limiter, results)
+
+
+def update_volumes(api, vopt, update, workers, rate):
+    changes = parse_update(update)
+    print("Updating volumes matching: {} with: {}".format(vopt, update))
+    limiter = RateLimiter(rate, burst=max(1, int(rate)))
+    ais = ais_from_vols(api, vopt)
+    funcs, args, results = [], [], []
+    for ai in ais:
+        funcs.append(_update_ai)
+        args.append((ai, changes, limiter, results))
+    if funcs:
+        p = Parallel(funcs, args_list=args, max_workers=workers)
+        p.run_threads()
+    if results:
+        for i, label in ((1, 'put'), (2, 'confirmed')):
+            lats = [r[i] for r in results]
+            print("Update {} latency for {} volumes: min {:.3f}s p50 {:.3f}s "
+                  "p95 {:.3f}s max {:.3f}s".format(
+                      label, len(lats), min(lats), percentile(lats, 50),
+                      percentile(lats, 95), max(lats)))
+    return results
+
+
 def create_volumes(host, api, vopt, workers):
     hostname = get_hostname(host)
     dprint("Creating volumes:", vopt)
-    opts = parse_vol_opt(vopt)
+    spec = get_spec(vopt)
     ais = ais_from_vols(api, vopt)
     # If they already exist lets just use them
-    if ais:
+    if ais or spec.kind == 'names':
         return ais
-    if 'sis' in opts:
-        return [_create_complex_volume(api, opts)]
+    if spec.kind == 'complex':
+        return [_create_complex_volume(api, spec.opts)]
     funcs, args, results = [], [], []
-    for i in range(int(opts['count'])):
+    for _, name in spec.plans(hostname):
         funcs.append(_create_volume)
-        args.append((hostname, api, opts, i, results))
+        args.append((api, spec.opts, name, results))
     p = Parallel(funcs, args_list=args, max_workers=workers)
     p.run_threads()
     return results
 
 
-def _clean_volume(ai):
+def clean_volume(ai):
     dprint("Cleaning volume:", ai.name)
     ai.set(admin_state='offline', force=True)
     ai.delete(force=True)
@@ -242,7 +520,7 @@ def clean_volumes(api, vopt, workers):
     ais = ais_from_vols(api, vopt)
     funcs, args = [], []
     for ai in ais:
-        funcs.append(_clean_volume)
+        funcs.append(clean_volume)
         args.append((ai,))
     p = Parallel(funcs, args_list=args, max_workers=workers)
     p.run_threads()
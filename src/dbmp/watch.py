@@ -0,0 +1,117 @@
+"""
+Live terminal dashboard for --metrics --watch.
+
+The dashboard only reads the results the metrics collector threads are
+filling in, so it makes no REST calls of its own.  It redraws at most once
+per RENDER_INTERVAL and only when a new point arrived or the fio status
+changed, rebuilding just the rows of app_instances with new points.  Only
+the MAX_ROWS app_instances with the worst latency are shown so the table
+stays readable (and cheap) with hundreds of volumes.
+"""
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import sys
+import threading
+import time
+
+MAX_ROWS = 40
+RENDER_INTERVAL = 1.0
+_CLEAR = '\033[H\033[2J'
+
+
+class FioProgress(object):
+
+    """
+    Elapsed time of a fio job started by fio.start_fio, out of its `runtime`
+    seconds.  fio's own status output isn't read
+    """
+
+    def __init__(self, thread, runtime):
+        self.thread = thread
+        self.runtime = runtime
+        self.start = time.time()
+
+    def __str__(self):
+        if not self.thread.is_alive():
+            return "fio: finished"
+        elapsed = min(time.time() - self.start, self.runtime)
+        return "fio: running, {:.0f}s/{}s elapsed ({:.0f}%)".format(
+            elapsed, self.runtime, elapsed / self.runtime * 100)
+
+
+class Dashboard(object):
+
+    """
+    Renders the latest value of each metric per app_instance of a running
+    metrics collection as a table, worst latency first.  `results` is the
+    collector's {ai_name: {metric: [points]}}
+    """
+
+    def __init__(self, results, metrics, fio=None, out=None):
+        self.results = results
+        self.metrics = metrics
+        self.fio = fio
+        self.out = out or sys.stdout
+        self.tty = hasattr(self.out, 'isatty') and self.out.isatty()
+        self.rows = {}
+        self.last_fio = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.render()
+
+    def _loop(self):
+        while not self.stopped.wait(RENDER_INTERVAL):
+            self.render()
+
+    def _row(self, name, data):
+        counts = tuple(len(data.get(m, ())) for m in self.metrics)
+        cached = self.rows.get(name)
+        if cached and cached[0] == counts:
+            return cached[1], False
+        values = [data[m][-1]['value'] if data.get(m) else None
+                  for m in self.metrics]
+        lats = [v for m, v in zip(self.metrics, values)
+                if 'lat_' in m and v is not None]
+        row = (max(lats) if lats else -1, name, values)
+        self.rows[name] = (counts, row)
+        return row, True
+
+    def render(self):
+        rows, changed = [], False
+        for name, data in list(self.results.items()):
+            row, new = self._row(name, data)
+            rows.append(row)
+            changed = changed or new
+        fio = str(self.fio) if self.fio else None
+        if not changed and fio == self.last_fio:
+            return
+        self.last_fio = fio
+        # Only needed once there's something to draw
+        from tabulate import tabulate
+        rows.sort(key=lambda r: (-r[0], r[1]))
+        table = tabulate(
+            [[name] + values for _, name, values in rows[:MAX_ROWS]],
+            headers=['app_instance'] + list(self.metrics), floatfmt='.1f',
+            missingval='-')
+        lines = ["dbmp metrics {}  {} app_instances".format(
+            time.strftime('%H:%M:%S'), len(rows))]
+        if fio:
+            lines.append(fio)
+        lines.append(table)
+        if len(rows) > MAX_ROWS:
+            lines.append("... {} more".format(len(rows) - MAX_ROWS))
+        self.out.write((_CLEAR if self.tty else '\n') + '\n'.join(lines) +
+                       '\n')
+        self.out.flush()